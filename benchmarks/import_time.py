@@ -0,0 +1,91 @@
+"""Import time of each module of the package, from -X importtime.
+
+Each target is imported --repeat times in a fresh interpreter. A run's
+time is the sum of the self times of the modules it loaded beyond what
+interpreter start-up loads; the median is reported, along with the heavy
+dependencies (tkinter, ftplib, sqlite3, requests, NumPy) each import
+pulls in. Sources are byte-compiled first, as an interpreter that cannot
+write .pyc files would otherwise be timing the compiler.
+
+--budget fails the run (exit 1) when importing the validation module
+takes longer than that many milliseconds, which is what process-pool
+workers and short cron jobs pay at start-up.
+
+    python benchmarks/import_time.py --repeat 20 --budget 10
+"""
+import argparse
+import compileall
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = [
+    "ftp_csv_validator",
+    "ftp_csv_validator.validation",
+    "ftp_csv_validator.schema",
+    "ftp_csv_validator.sidecar",
+    "ftp_csv_validator.state",
+    "ftp_csv_validator.errorlog",
+    "ftp_csv_validator.transport",
+    "ftp_csv_validator.processing",
+    "ftp_csv_validator.cli",
+    "ftp_csv_validator.gui",
+    "Testfile10",
+]
+HEAVY = ("tkinter", "ftplib", "sqlite3", "requests", "numpy")
+
+
+def import_times(statement):
+    """Return {module: self microseconds} for one run of statement."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(own)
+    return times
+
+
+def measure(target, baseline, repeat):
+    runs = []
+    for _ in range(repeat):
+        times = import_times(f"import {target}")
+        loaded = {name: us for name, us in times.items() if name not in baseline}
+        runs.append(sum(loaded.values()) / 1e3)
+    return statistics.median(runs), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--budget", type=float,
+                        help="milliseconds the validation module may take to import")
+    parser.add_argument("targets", nargs="*", default=TARGETS)
+    args = parser.parse_args()
+
+    compileall.compile_dir(os.path.join(ROOT, "ftp_csv_validator"), quiet=1)
+    compileall.compile_file(os.path.join(ROOT, "Testfile10.py"), quiet=1)
+    baseline = set(import_times("pass"))
+
+    print(f"{'module':<32}{'ms':>8}{'modules':>9}  heavy dependencies")
+    results = {}
+    for target in args.targets:
+        ms, loaded = measure(target, baseline, args.repeat)
+        results[target] = ms
+        heavy = ", ".join(name for name in HEAVY if name in loaded) or "-"
+        print(f"{target:<32}{ms:>8.1f}{len(loaded):>9}  {heavy}")
+
+    validation = results.get("ftp_csv_validator.validation")
+    if args.budget is not None and validation is not None and validation > args.budget:
+        print(f"ftp_csv_validator.validation takes {validation:.1f} ms to import, "
+              f"over the {args.budget:g} ms budget", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
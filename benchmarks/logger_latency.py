@@ -0,0 +1,100 @@
+"""Per-call latency of Logger.log with each correlation-ID source.
+
+"blocking" reproduces the old behaviour, one HTTP round trip per log line;
+"local" and "remote" are the current Logger modes. The remote API is a
+local stub that answers after --latency milliseconds, so the numbers do
+not depend on internet access.
+
+    python benchmarks/logger_latency.py --calls 2000 --latency 50
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ftp_csv_validator.errorlog  # noqa: E402
+
+
+def start_stub_api(latency):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            count = int(self.path.rsplit("/", 1)[-1]) if "/count/" in self.path else 1
+            body = json.dumps([str(uuid4()) for _ in range(count)]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/api/generate/v1"
+
+
+def blocking_get_uuid(url):
+    import requests
+    response = requests.get(url)
+    response.raise_for_status()
+    return response.json()[0]
+
+
+def measure(log, calls):
+    timings = []
+    for i in range(calls):
+        started = time.perf_counter()
+        log(f"benchmark message {i}")
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        "mean_us": statistics.fmean(timings) * 1e6,
+        "p50_us": timings[len(timings) // 2] * 1e6,
+        "p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=50.0,
+                        help="simulated API round trip in milliseconds")
+    args = parser.parse_args()
+
+    server, url = start_stub_api(args.latency / 1000)
+    ftp_csv_validator.errorlog.UUID_API_URL = url
+    os.chdir(tempfile.mkdtemp())
+
+    local = ftp_csv_validator.errorlog.Logger(uuid_source="local")
+    remote = ftp_csv_validator.errorlog.Logger(uuid_source="remote")
+    remote.get_uuid()  # start the first refill
+    time.sleep(args.latency / 1000 * 4)
+
+    def blocking_log(message):
+        remote.logger.error(message, extra={"uuid": blocking_get_uuid(url)})
+
+    # The blocking mode is slow by design, so it only gets a sample.
+    results = {
+        "blocking": measure(blocking_log, min(args.calls, 50)),
+        "local": measure(local.log, args.calls),
+        "remote": measure(remote.log, args.calls),
+    }
+    server.shutdown()
+    remote.close()
+    print(f"{'mode':<10}{'mean us':>12}{'p50 us':>12}{'p99 us':>12}")
+    for mode, stats in results.items():
+        print(f"{mode:<10}{stats['mean_us']:>12.1f}{stats['p50_us']:>12.1f}{stats['p99_us']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""Throughput and latency of every pipeline stage on synthetic files.
+
+Files from synthetic.py are served by an in-process pyftpdlib server.
+Each file is timed through each stage --repeat times:
+
+    validate_python  FileValidator.validate on the decoded text
+    validate_numpy   the same with engine="numpy" (if NumPy is installed)
+    validate_stream  StreamingValidator fed 64 KiB chunks
+    list             FTPClient.list_files, one MLSD
+    size             SIZE round trip
+    retr             raw RETR into a sink
+    pipeline         FileProcessor.process: size, download, validate, save
+
+It reports MB/s and rows/s at the median, p50/p90/p99 latency and the
+process's peak RSS after each stage. --save writes the results as JSON.
+--baseline compares a run against such a file and exits 1 if any stage's
+p50 is more than --tolerance slower.
+
+    python benchmarks/pipeline.py --rows 10000 100000 --save baseline.json
+    python benchmarks/pipeline.py --rows 10000 100000 --baseline baseline.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ftp_csv_validator  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK = 64 * 1024
+
+
+class LocalFTPServer:
+    def __init__(self, root):
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("user", "pass", root, perm="elr")
+        handler = type("Handler", (FTPHandler,), {"authorizer": authorizer})
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+        self.host, self.port = self.server.address
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            self.server.serve_forever(timeout=0.05, blocking=False)
+
+    def client(self):
+        client = ftp_csv_validator.FTPClient()
+        client.connect(self.host, "user", "pass", port=self.port)
+        return client
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.server.close_all()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def measure(run, repeat, size, rows):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    p50 = timings[len(timings) // 2]
+    return {
+        "p50_ms": p50 * 1e3,
+        "p90_ms": timings[int(len(timings) * 0.9)] * 1e3,
+        "p99_ms": timings[int(len(timings) * 0.99)] * 1e3,
+        "mb_s": size / 1e6 / p50 if size else None,
+        "rows_s": rows / p50 if rows else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def stream(content):
+    validator = ftp_csv_validator.StreamingValidator()
+    for start in range(0, len(content), CHUNK):
+        if not validator.feed(content[start:start + CHUNK]):
+            break
+    return validator.close()
+
+
+def bench_file(name, content, rows, server, args):
+    text = content.decode()
+    stages = {
+        "validate_python": lambda: ftp_csv_validator.FileValidator.validate(text),
+        "validate_stream": lambda: stream(content),
+    }
+    if numpy is not None:
+        stages["validate_numpy"] = lambda: ftp_csv_validator.FileValidator.validate(text, engine="numpy")
+    if server is not None:
+        client = server.client()
+        logger = ftp_csv_validator.Logger()
+
+        def retr():
+            client.ftp.voidcmd("TYPE I")
+            client.ftp.retrbinary(f"RETR {name}", lambda data: None)
+
+        def size():
+            client.ftp.voidcmd("TYPE I")
+            client.ftp.size(name)
+
+        processor = ftp_csv_validator.FileProcessor(client, logger)
+
+        def pipeline():
+            # A fresh ledger, batch index and verdict cache, or every repeat
+            # after the first would be skipped or rejected as a duplicate
+            client.ledger = ftp_csv_validator.ProcessedLedger(":memory:")
+            client.batch_index = ftp_csv_validator.BatchIdIndex(":memory:", capacity=max(rows, 1000))
+            client.verdicts = ftp_csv_validator.VerdictCache(":memory:")
+            result = processor.process(name)
+            if result.outcome == "saved":
+                os.remove(os.path.join(ftp_csv_validator.VALID_DIR, result.message))
+
+        stages.update({"list": client.list_files, "size": size, "retr": retr, "pipeline": pipeline})
+    results = {}
+    for stage, run in stages.items():
+        moved = len(content) if stage not in ("list", "size") else 0
+        results[stage] = measure(run, args.repeat, moved, rows if moved else 0)
+    if server is not None:
+        client.ftp.quit()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print p50 changes against a baseline; return the regressed keys."""
+    regressions = []
+    print(f"\n{'stage':<40}{'base p50 ms':>14}{'p50 ms':>12}{'change':>10}")
+    for key, stats in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]["p50_ms"], stats["p50_ms"]
+        change = (after - before) / before if before else 0.0
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"{key:<40}{before:>14.2f}{after:>12.2f}{change:>+10.1%}{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--errors", nargs="*", default=["missing_columns"],
+                        help="error kinds from synthetic.ERRORS to add invalid files for")
+    parser.add_argument("--at", type=float, nargs="+", default=[0.1, 0.9],
+                        help="positions of the bad row in invalid files")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier --save to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="slowdown of a stage's p50 that counts as a regression")
+    args = parser.parse_args()
+    save = os.path.abspath(args.save) if args.save else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    root = tempfile.mkdtemp()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    os.makedirs(ftp_csv_validator.VALID_DIR, exist_ok=True)
+    files = []
+    seed = args.seed
+    for rows in args.rows:
+        cases = [("valid", None, None)] + [(f"{error}@{at:g}", error, at)
+                                           for error in args.errors for at in args.at]
+        for case, error, at in cases:
+            name = f"{rows}_{case.replace('@', '_at_')}.csv"
+            content = generate(rows, seed=seed, error=error, at=at or 0.5)
+            seed += 1
+            with open(os.path.join(root, name), "wb") as f:
+                f.write(content)
+            files.append((f"{rows}/{case}", name, content, rows))
+
+    logging.getLogger("pyftpdlib").setLevel(logging.WARNING)
+    server = LocalFTPServer(root) if ThreadedFTPServer is not None else None
+    if server is None:
+        print("pyftpdlib is not installed: only the validation stages run", file=sys.stderr)
+    results = {}
+    try:
+        print(f"{'stage':<40}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'MB/s':>10}{'rows/s':>12}{'RSS MB':>9}")
+        for label, name, content, rows in files:
+            for stage, stats in bench_file(name, content, rows, server, args).items():
+                key = f"{stage}/{label}"
+                results[key] = stats
+                mb_s = f"{stats['mb_s']:.1f}" if stats["mb_s"] else "-"
+                rows_s = f"{stats['rows_s']:.0f}" if stats["rows_s"] else "-"
+                print(f"{key:<40}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+                      f"{mb_s:>10}{rows_s:>12}{stats['peak_rss_mb']:>9.0f}")
+    finally:
+        if server is not None:
+            server.stop()
+        if ftp_csv_validator.Logger.active:
+            ftp_csv_validator.Logger.active.close()
+        shutil.rmtree(root)
+        shutil.rmtree(workdir)
+
+    if save:
+        meta = {"python": platform.python_version(), "platform": platform.platform(),
+                "numpy": numpy.__version__ if numpy is not None else None, "repeat": args.repeat}
+        with open(save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Compiled Schema validator against the hand-written FileValidator rules.
+
+Synthetic files from synthetic.py, valid ones and ones with a bad row
+near the end, are checked --repeat times by each engine:
+
+    handwritten         FileValidator.validate_rows on the decoded text
+    schema              Schema.default().validate, the same rules compiled
+    stream_handwritten  StreamingValidator fed 64 KiB chunks
+    stream_schema       the same with schema=Schema.default()
+
+Every engine must give the same verdict and message, or the run fails.
+It reports the median time, MB/s and rows/s of each, and the speed-up of
+the compiled validator over the hand-written one; --min-speedup exits 1
+when schema is less than that many times as fast as handwritten on any
+file. The time to compile the schema is printed first.
+
+    python benchmarks/schema_validator.py --rows 10000 100000 --min-speedup 1.0
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ftp_csv_validator.schema import Schema  # noqa: E402
+from ftp_csv_validator.validation import FileValidator, StreamingValidator  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+CHUNK = 64 * 1024
+
+
+def stream(content, schema=None):
+    validator = StreamingValidator(schema=schema)
+    for start in range(0, len(content), CHUNK):
+        if not validator.feed(content[start:start + CHUNK]):
+            break
+    return validator.close()
+
+
+def median_time(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--errors", nargs="*", default=["out_of_range"],
+                        help="error kinds from synthetic.ERRORS to add invalid files for")
+    parser.add_argument("--at", type=float, default=0.9, help="position of the bad row in invalid files")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-speedup", type=float,
+                        help="fail unless schema is at least this many times as fast as handwritten")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    schema = Schema.default()
+    print(f"compiled {len(schema.columns)} columns in {(time.perf_counter() - started) * 1e3:.2f} ms\n")
+
+    print(f"{'file':<28}{'engine':<20}{'ms':>10}{'MB/s':>10}{'rows/s':>12}{'speed-up':>10}")
+    seed = args.seed
+    slow = []
+    for rows in args.rows:
+        for error in [None] + args.errors:
+            content = generate(rows, seed=seed, error=error, at=args.at)
+            seed += 1
+            text = content.decode()
+            label = f"{rows}/{error or 'valid'}"
+            engines = {
+                "handwritten": lambda: FileValidator.validate_rows(text),
+                "schema": lambda: schema.validate(text),
+                "stream_handwritten": lambda: stream(content),
+                "stream_schema": lambda: stream(content, schema),
+            }
+            verdicts = {name: run() for name, run in engines.items()}
+            if len(set(verdicts.values())) != 1:
+                print(f"{label}: engines disagree: {verdicts}", file=sys.stderr)
+                sys.exit(1)
+            times = {name: median_time(run, args.repeat) for name, run in engines.items()}
+            for name, seconds in times.items():
+                baseline = times["stream_handwritten" if name.startswith("stream") else "handwritten"]
+                print(f"{label:<28}{name:<20}{seconds * 1e3:>10.2f}{len(content) / 1e6 / seconds:>10.1f}"
+                      f"{rows / seconds:>12.0f}{baseline / seconds:>9.2f}x")
+            if args.min_speedup and times["handwritten"] / times["schema"] < args.min_speedup:
+                slow.append(label)
+    if slow:
+        print(f"schema is less than {args.min_speedup:g}x as fast as handwritten on: {', '.join(slow)}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
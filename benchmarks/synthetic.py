@@ -0,0 +1,75 @@
+"""Seeded generator of CSV files in the EXPECTED_HEADERS layout.
+
+The same seed always gives the same bytes, and different seeds give
+disjoint batch_ids, so generated files can be fed through the pipeline
+together. An invalid file is a valid one with a single bad row (or bad
+header) at a chosen fraction of the way through.
+
+    python benchmarks/synthetic.py --rows 100000 --error out_of_range --at 0.9 out.csv
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ftp_csv_validator.config import EXPECTED_HEADERS  # noqa: E402
+
+ERRORS = ("header", "missing_columns", "duplicate", "out_of_range", "bad_decimal", "non_numeric")
+
+
+def batch_id(seed, i):
+    return f"B{seed:04d}{i:09d}"
+
+
+def good_row(rng, seed, i):
+    readings = ",".join(f"{rng.randrange(0, 9900) / 1000:.{rng.randint(1, 3)}f}" for _ in range(10))
+    return f"{batch_id(seed, i)},2023-01-{1 + i // 1440 % 28:02d} {i // 60 % 24:02d}:{i % 60:02d},{readings}"
+
+
+def bad_row(rng, seed, i, error):
+    row = good_row(rng, seed, i).split(",")
+    if error == "missing_columns":
+        row = row[:5]
+    elif error == "duplicate":
+        row[0] = batch_id(seed, rng.randrange(0, i)) if i else row[0]
+    elif error == "out_of_range":
+        row[2 + rng.randrange(10)] = "10.5"
+    elif error == "bad_decimal":
+        row[2 + rng.randrange(10)] = "1.2345"
+    elif error == "non_numeric":
+        row[2 + rng.randrange(10)] = "n/a"
+    return ",".join(row)
+
+
+def generate(rows, seed=0, error=None, at=0.5):
+    """Return the file as bytes; error is one of ERRORS or None for a valid file."""
+    if error is not None and error not in ERRORS:
+        raise ValueError(f"Unknown error kind: {error}")
+    rng = random.Random(seed)
+    header = list(EXPECTED_HEADERS)
+    if error == "header":
+        header[-1] = "reading11"
+    bad = min(int(rows * at), rows - 1) if error not in (None, "header") else -1
+    lines = [",".join(header)]
+    lines.extend(bad_row(rng, seed, i, error) if i == bad else good_row(rng, seed, i)
+                 for i in range(rows))
+    return ("\n".join(lines) + "\n").encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--error", choices=ERRORS)
+    parser.add_argument("--at", type=float, default=0.5,
+                        help="position of the bad row, as a fraction of the rows")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    with open(args.path, "wb") as f:
+        f.write(generate(args.rows, args.seed, args.error, args.at))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Download, validate and archive CSV sensor files from an FTP server.
+
+Each module imports only what it needs, so validation can be used
+without loading ftplib, SQLite, requests or tkinter:
+
+    config      settings
+    metrics     stage timings and counters
+    validation  FileValidator, StreamingValidator and the other engines
+    schema      declarative CSV layouts compiled into validators
+    sidecar     binary column sidecars of saved files
+    state       the processed-file ledger, the batch_id index, the
+                verdict cache and the store of saved files
+    errorlog    the error log
+    transport   FTP sessions, connection pools (to one server or several)
+                and resumable downloads
+    processing  the per-file pipeline and the directory watcher
+    gui         the Tkinter application
+    cli         the command line entry point
+
+The names below are also available from the package itself and are
+imported on first access, so ``from ftp_csv_validator import
+FileValidator`` loads the validation module and nothing else.
+"""
+import importlib
+
+_EXPORTS = {
+    "metrics": ("Metrics", "StageTimer", "METRICS"),
+    "validation": ("FileValidator", "ValidationReport", "ColumnarValidator", "StreamingValidator",
+                   "ContentDigest", "Decompressor", "ShardedValidator"),
+    "schema": ("Schema", "Column"),
+    "sidecar": ("SidecarWriter", "Sidecar"),
+    "state": ("ProcessedLedger", "BloomFilter", "BatchIdIndex", "Verdict", "VerdictCache", "Output",
+              "OutputStore"),
+    "errorlog": ("Logger", "LogTail"),
+    "transport": ("TransferAborted", "TransferCancelled", "TransferSizeMismatch", "PartialWriteError",
+                  "TRANSIENT_ERRORS", "PartialDownload", "RemoteEntry", "RemoteIndex", "FTPClient",
+                  "FTPConnectionPool", "Endpoint", "MultiServerPool"),
+    "processing": ("ProcessResult", "SCHEDULES", "FileProcessor", "ParallelFileProcessor", "MultiServerProcessor",
+                   "DirectoryWatcher"),
+    "gui": ("DownloadStatus", "App"),
+    "cli": ("parse_args", "run_headless", "run_local", "open_fleet", "run_watch", "main"),
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = list(_MODULES)
+
+
+def __getattr__(name):
+    module = _MODULES.get(name)
+    if module is None:
+        # Settings are cheap to import and read from config directly
+        config = importlib.import_module(".config", __name__)
+        if not name.isupper() or not hasattr(config, name):
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        return getattr(config, name)
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_MODULES))
@@ -0,0 +1,268 @@
+"""Command line entry point: the GUI, the headless and watch runners, or local validation."""
+import os
+import sys
+import time
+import signal
+import fnmatch
+import argparse
+import threading
+
+from .config import (BATCH_INDEX_FILE, DIAGNOSTICS_LIMIT, ERROR_LOG_DIR, EXIT_FAILURE, EXIT_OK, EXIT_REJECTED,
+                     LEDGER_FILE, METRICS_FILE, OUTPUT_MANIFEST_FILE, SCHEDULE, SHARD_MIN_BYTES, SIDECAR_EXTENSION,
+                     VALID_DIR, VERDICT_CACHE_FILE, WATCH_INTERVAL)
+from .errorlog import Logger
+from .metrics import METRICS
+from .processing import SCHEDULES, DirectoryWatcher, MultiServerProcessor
+from .schema import Schema
+from .state import BatchIdIndex, OutputStore, ProcessedLedger, VerdictCache
+from .transport import Endpoint, MultiServerPool
+from .validation import ShardedValidator
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="FTP CSV Validator")
+    parser.add_argument("--headless", action="store_true",
+                        help="run the download/validate pipeline without the GUI")
+    parser.add_argument("--host", default=os.environ.get("FTP_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("FTP_PORT", 21)))
+    parser.add_argument("--user", default=os.environ.get("FTP_USER", "anonymous"))
+    parser.add_argument("--password", default=os.environ.get("FTP_PASS", ""))
+    parser.add_argument("--directory", default=os.environ.get("FTP_DIR", ""),
+                        help="remote directory to process")
+    parser.add_argument("--endpoints", default=os.environ.get("FTP_ENDPOINTS"),
+                        help="JSON file of several servers to collect from at once, in place of --host")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of FTP sessions downloading in parallel (per server), or of "
+                             "processes validating a large file with --validate")
+    parser.add_argument("--schedule", choices=sorted(SCHEDULES), default=SCHEDULE,
+                        help="order in which the files of a batch are downloaded")
+    parser.add_argument("--ledger", default=LEDGER_FILE,
+                        help="SQLite file recording processed files across runs")
+    parser.add_argument("--batch-index", default=BATCH_INDEX_FILE,
+                        help="SQLite file of batch_ids accepted across runs")
+    parser.add_argument("--verdict-cache", default=VERDICT_CACHE_FILE,
+                        help="SQLite file of validation verdicts by content hash, to skip known files")
+    parser.add_argument("--manifest", default=OUTPUT_MANIFEST_FILE,
+                        help=f"SQLite index of the files saved in {VALID_DIR}, by source, content hash, "
+                             "row count and batch_id range")
+    parser.add_argument("--schema",
+                        help="JSON schema of the files in place of the built-in layout "
+                             "(endpoints may name their own)")
+    parser.add_argument("--sidecar", action="store_true",
+                        help=f"also write a binary {SIDECAR_EXTENSION} sidecar next to each saved file "
+                             "of the built-in layout")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep polling the directory and process files as they appear")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                        help="seconds between listings in watch mode")
+    parser.add_argument("--diagnostics", type=int, nargs="?", const=DIAGNOSTICS_LIMIT, metavar="LIMIT",
+                        help="read rejected files to the end and write a report of up to LIMIT "
+                             f"violations to {ERROR_LOG_DIR} (default {DIAGNOSTICS_LIMIT})")
+    parser.add_argument("--validate", nargs="+", metavar="FILE",
+                        help="validate local files instead of downloading; files of the built-in layout "
+                             f"from {SHARD_MIN_BYTES >> 20} MiB are split across --workers processes")
+    parser.add_argument("--metrics", default=METRICS_FILE,
+                        help="write live stage timings and counters to this file (.json or Prometheus text)")
+    parser.add_argument("patterns", nargs="*", default=["*"],
+                        help="glob patterns of remote files to process")
+    return parser.parse_args(argv)
+
+
+# A missing or malformed --schema, --endpoints or state file
+CONFIGURATION_ERRORS = (OSError, ValueError, TypeError)
+
+
+def run_headless(args):
+    """Process every matching remote file once and print a summary.
+
+    With --endpoints every server is listed and processed at once. Returns
+    EXIT_OK when every file was saved (or there was nothing to do),
+    EXIT_REJECTED when some file was rejected and EXIT_FAILURE when the
+    configuration could not be loaded, a server could not be reached or a
+    transfer failed.
+    """
+    logger = Logger()
+    fleet, processor = open_processor(args, logger)
+    if fleet is None:
+        return EXIT_FAILURE
+    started = time.perf_counter()
+    counts = {}
+    total_bytes = 0
+    for result in processor.collect(lambda name: matches(name, args.patterns)):
+        counts[result.outcome] = counts.get(result.outcome, 0) + 1
+        total_bytes += result.bytes
+        print(f"{result.outcome}: {label(fleet, result)}: {result.message}")
+    elapsed = time.perf_counter() - started
+    close_fleet(fleet)
+
+    for source, error in fleet.errors.items():
+        print(f"FTP connection failed{for_source(fleet, source)}: {error}", file=sys.stderr)
+    if len(fleet.errors) == len(fleet.pools):
+        return EXIT_FAILURE
+    files = sum(counts.values())
+    breakdown = ", ".join(f"{count} {outcome}" for outcome, count in sorted(counts.items()))
+    print(f"Processed {files} files ({breakdown or 'nothing to do'}) "
+          f"{total_bytes / 1e6:.2f} MB in {elapsed:.2f} s: "
+          f"{total_bytes / 1e6 / elapsed:.2f} MB/s, {files / elapsed:.1f} files/s")
+
+    if fleet.errors or counts.get("download_error") or counts.get("size_error"):
+        return EXIT_FAILURE
+    if set(counts) - {"saved", "skipped"}:
+        return EXIT_REJECTED
+    return EXIT_OK
+
+
+def run_local(args):
+    """Validate the local files of --validate and print a verdict for each.
+
+    Files are checked against --schema if given, and against the batch_ids
+    of --batch-index, which is not updated. Returns EXIT_OK when every file
+    is valid, EXIT_REJECTED when some file is not and EXIT_FAILURE when a
+    file or the configuration cannot be read.
+    """
+    try:
+        schema = Schema.load(args.schema) if args.schema else None
+        batch_index = BatchIdIndex(args.batch_index)
+    except CONFIGURATION_ERRORS as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_FAILURE
+    status = EXIT_OK
+    try:
+        for path in args.validate:
+            try:
+                if schema is None:
+                    valid, message = ShardedValidator.validate_file(path, workers=args.workers,
+                                                                    batch_index=batch_index)
+                else:
+                    valid, message = ShardedValidator.validate_serial(path, batch_index, schema)
+            except OSError as e:
+                print(f"error: {path}: {e}", file=sys.stderr)
+                status = EXIT_FAILURE
+                continue
+            print(f"{'valid' if valid else 'invalid'}: {path}: {message}")
+            if not valid and status == EXIT_OK:
+                status = EXIT_REJECTED
+    finally:
+        batch_index.close()
+    return status
+
+
+def open_fleet(args):
+    """The servers of --endpoints, or the single one of --host and friends."""
+    if args.endpoints:
+        endpoints = MultiServerPool.read_endpoints(args.endpoints)
+    else:
+        endpoints = [Endpoint(args.host, args.host, args.port, args.user, args.password, args.directory or None)]
+    return MultiServerPool(endpoints, default_workers=args.workers,
+                           ledger=ProcessedLedger(args.ledger),
+                           batch_index=BatchIdIndex(args.batch_index),
+                           verdicts=VerdictCache(args.verdict_cache),
+                           outputs=OutputStore(manifest=args.manifest))
+
+
+def open_processor(args, logger):
+    """The fleet and processor of a headless run, or (None, None) when the
+    configuration cannot be loaded; the error is logged and printed.
+    """
+    fleet = None
+    try:
+        fleet = open_fleet(args)
+        processor = MultiServerProcessor(fleet, logger, sidecar=args.sidecar, diagnostics=args.diagnostics,
+                                         schema=Schema.load(args.schema) if args.schema else None,
+                                         schedule=args.schedule)
+    except CONFIGURATION_ERRORS as e:
+        if fleet is not None:
+            close_fleet(fleet)
+        logger.log(f"Configuration error: {str(e)}")
+        print(f"error: {e}", file=sys.stderr)
+        return None, None
+    return fleet, processor
+
+
+def close_fleet(fleet):
+    fleet.close()
+    fleet.batch_index.close()
+    fleet.verdicts.close()
+    fleet.outputs.close()
+
+
+def matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def label(fleet, result):
+    # Names are only qualified when they can come from several servers
+    return f"{result.source}/{result.filename}" if len(fleet.pools) > 1 else result.filename
+
+
+def for_source(fleet, source):
+    return f" for {source}" if len(fleet.pools) > 1 else ""
+
+
+def run_watch(args, stop=None):
+    """Process matching files as they are uploaded, until stop is set.
+
+    Each server is watched on a thread of its own. SIGTERM and Ctrl-C set
+    stop too, after the batch in progress.
+    """
+    logger = Logger()
+    fleet, processor = open_processor(args, logger)
+    if fleet is None:
+        return EXIT_FAILURE
+    stop = stop or threading.Event()
+    watchers = {}
+    for source, pool in fleet.pools.items():
+        try:
+            watchers[source] = DirectoryWatcher(pool.new_client(), interval=args.interval)
+        except Exception as e:
+            logger.log(f"FTP connection failed{for_source(fleet, source)}: {str(e)}")
+            print(f"FTP connection failed{for_source(fleet, source)}: {e}", file=sys.stderr)
+    if not watchers:
+        close_fleet(fleet)
+        return EXIT_FAILURE
+
+    def handle(source, names):
+        names = [name for name in names if matches(name, args.patterns)]
+        results = []
+        for result in processor.run((source, name) for name in names):
+            print(f"{result.outcome}: {label(fleet, result)}: {result.message}", flush=True)
+            results.append(result)
+        return results
+
+    threads = [threading.Thread(target=watcher.run, args=(lambda names, source=source: handle(source, names), stop))
+               for source, watcher in watchers.items()]
+    for thread in threads:
+        thread.start()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        while not stop.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        for thread in threads:
+            thread.join()
+        for watcher in watchers.values():
+            watcher.ftp_client.ftp.close()
+        close_fleet(fleet)
+    return EXIT_OK
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.metrics:
+        METRICS.enable(args.metrics)
+    if args.validate:
+        return run_local(args)
+    if args.headless and args.watch:
+        return run_watch(args)
+    if args.headless:
+        return run_headless(args)
+    # Only the GUI needs tkinter and a display
+    from tkinter import Tk
+    from .gui import App
+    root = Tk()
+    app = App(root)
+    root.mainloop()
+    return EXIT_OK
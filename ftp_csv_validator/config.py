@@ -0,0 +1,96 @@
+"""Settings shared by every module; the environment overrides a few."""
+import os
+import re
+
+VALID_DIR = "valid_files"
+ERROR_LOG_DIR = "error_logs"
+ERROR_LOG_FILE = os.path.join(ERROR_LOG_DIR, "error_log.txt")
+# Log correlation IDs: "local" generates uuid4s in-process, "remote" serves
+# them from a pool refilled in the background from UUID_API_URL and falls
+# back to local IDs whenever the pool is empty.
+UUID_SOURCE = os.environ.get("UUID_SOURCE", "local")
+UUID_API_URL = "https://www.uuidtools.com/api/generate/v1"
+UUID_API_TIMEOUT = 2.0
+UUID_POOL_SIZE = 100
+UUID_RETRY_DELAY = 60.0
+LOGGER_NAME = "ftp_csv_validator"
+# Most recent error log lines kept in the GUI list
+ERROR_LOG_VIEW_LIMIT = 1000
+ERROR_LOG_POLL_MS = 500
+EXPECTED_HEADERS = ["batch_id", "timestamp"] + \
+    [f"reading{i}" for i in range(1, 11)]
+DECIMAL_PATTERN = re.compile(r"^\d+(\.\d{1,3})?$")
+COLUMNAR_BLOCK_ROWS = 16384
+# Violations listed in a full-diagnostics report; the rest are only counted
+DIAGNOSTICS_LIMIT = 1000
+# Files below this size are not worth splitting across processes
+SHARD_MIN_BYTES = 16 * 1024 * 1024
+SHARD_BLOCK_BYTES = 4 * 1024 * 1024
+# Quotes, which can hide a newline inside a field, and the line breaks
+# other than "\n" and "\r\n" that str.splitlines also honours: a file
+# containing any of them is not cut at newlines but validated serially
+IRREGULAR_LINES = re.compile(rb'"|\r(?!\n)|[\x0b\x0c\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+# Accepted file names and how their content is compressed; .csv.zst
+# needs the optional zstandard package
+CSV_EXTENSIONS = {".csv": None, ".csv.gz": "gzip", ".csv.zst": "zstd"}
+# Ask servers that offer MODE Z to deflate the transfer of plain .csv files
+MODE_Z = True
+# Binary copy of an accepted file's columns, written next to the CSV
+SIDECAR_EXTENSION = ".medb"
+
+STATE_DIR = "state"
+LEDGER_FILE = os.path.join(STATE_DIR, "ledger.sqlite3")
+BATCH_INDEX_FILE = os.path.join(STATE_DIR, "batch_ids.sqlite3")
+# Sizes the in-memory Bloom filter (about 1.2 bytes per id at 1%)
+BATCH_INDEX_CAPACITY = 10_000_000
+# and that of an in-memory index, which only lives as long as a session;
+# either is rebuilt twice as large once it holds more ids than this
+MEMORY_BATCH_INDEX_CAPACITY = 100_000
+BLOOM_ERROR_RATE = 0.01
+# A StreamingValidator checks batch_ids against the index this many rows
+# at a time, which is cheaper than per chunk received
+BATCH_INDEX_CHECK_ROWS = 1024
+# Verdicts of validated content by SHA-256/MD5; past this many entries
+# the least recently used are evicted (each takes a few hundred bytes)
+VERDICT_CACHE_FILE = os.path.join(STATE_DIR, "verdicts.sqlite3")
+VERDICT_CACHE_ENTRIES = 100_000
+# Accepted files are filed under VALID_DIR in a subdirectory per day of
+# acceptance, and indexed by source, content hash, rows and batch_id range
+OUTPUT_SHARD_FORMAT = "%Y/%m/%d"
+OUTPUT_MANIFEST_FILE = os.path.join(STATE_DIR, "outputs.sqlite3")
+# Part files and checkpoints of downloads; on the same filesystem as
+# VALID_DIR an accepted file is published by renaming its part file
+PARTIAL_DIR = os.path.join(STATE_DIR, "partial")
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+DOWNLOAD_RETRIES = 3
+RETRY_DELAY = 1.0
+# Seconds a cached remote directory listing is trusted
+LISTING_TTL = 60.0
+# Order in which a batch of downloads is started, one of
+# processing.SCHEDULES
+SCHEDULE = "size-balanced"
+# Watch mode: seconds between listings, backed off up to the maximum
+# (with +/- WATCH_JITTER) while the directory does not change
+WATCH_INTERVAL = 5.0
+WATCH_MAX_INTERVAL = 60.0
+WATCH_JITTER = 0.2
+LIST_UNIX_PATTERN = re.compile(
+    r"^([-dl])\S{9}\S*\s+\d+\s+(?:\S+\s+){1,2}?(\d+)\s+"
+    r"(\w{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4}))\s+(.+)$")
+LIST_DOS_PATTERN = re.compile(
+    r"^(\d{2}-\d{2}-\d{2,4})\s+(\d{1,2}:\d{2}[AP]M)\s+(<DIR>|\d+)\s+(.+)$")
+
+# Exit codes of the headless runner
+EXIT_OK = 0
+EXIT_REJECTED = 1
+EXIT_FAILURE = 2
+
+# GUI transfer progress
+PROGRESS_POLL_MS = 50
+PROGRESS_INTERVAL = 0.1
+
+# Instrumentation snapshot: off unless a file is given; .json for JSON,
+# anything else for the Prometheus text format
+METRICS_FILE = os.environ.get("METRICS_FILE")
+METRICS_INTERVAL = 1.0
+METRICS_PREFIX = "ftp_csv_validator"
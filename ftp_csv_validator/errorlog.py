@@ -0,0 +1,131 @@
+"""The error log and its correlation IDs."""
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from uuid import uuid4
+from collections import deque
+
+from .config import (ERROR_LOG_DIR, ERROR_LOG_FILE, LOGGER_NAME, UUID_API_TIMEOUT, UUID_API_URL, UUID_POOL_SIZE,
+                     UUID_RETRY_DELAY, UUID_SOURCE, VALID_DIR)
+from .metrics import METRICS
+
+
+class Logger:
+    """Error log writer; records are queued and written by a background thread.
+
+    Creating a Logger truncates ERROR_LOG_FILE and takes over from any
+    earlier instance, so the log always belongs to the current session.
+    """
+
+    active = None
+
+    def __init__(self, uuid_source=None):
+        self.ensure_directories()
+        # Clear the error log file at startup
+        if os.path.exists(ERROR_LOG_FILE):
+            # Truncate the file to clear old logs
+            open(ERROR_LOG_FILE, 'w').close()
+        if Logger.active:
+            Logger.active.close()
+        Logger.active = self
+        self.file_handler = logging.FileHandler(ERROR_LOG_FILE, mode='a')  # Append mode ensures new logs are added
+        self.file_handler.setFormatter(logging.Formatter(
+            "%(asctime)s - ERROR - [UUID: %(uuid)s] %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S"
+        ))
+        self.queue = queue.Queue()
+        self.listener = QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+        self.closed = False
+        atexit.register(self.close)
+        self.logger = logging.getLogger(LOGGER_NAME)
+        self.logger.handlers = [QueueHandler(self.queue)]
+        self.logger.setLevel(logging.ERROR)
+        self.logger.propagate = False
+        self.uuid_source = uuid_source or UUID_SOURCE
+        self.uuid_pool = deque()
+        self.refilling = threading.Lock()
+        self.next_refill = 0.0
+
+    def flush(self):
+        """Block until every queued record has been written."""
+        self.queue.join()
+        self.file_handler.flush()
+
+    def close(self):
+        """Write out queued records and stop the writer thread."""
+        if not self.closed:
+            self.closed = True
+            self.listener.stop()
+            self.file_handler.close()
+
+    def ensure_directories(self):
+        os.makedirs(VALID_DIR, exist_ok=True)
+        os.makedirs(ERROR_LOG_DIR, exist_ok=True)
+
+    def get_uuid(self):
+        """Return a correlation ID without ever waiting on the network."""
+        if self.uuid_source == "remote":
+            if len(self.uuid_pool) < UUID_POOL_SIZE // 2:
+                self.refill_uuid_pool()
+            try:
+                return self.uuid_pool.popleft()
+            except IndexError:
+                pass
+        return str(uuid4())
+
+    def refill_uuid_pool(self):
+        if time.monotonic() < self.next_refill or not self.refilling.acquire(blocking=False):
+            return
+        threading.Thread(target=self.fetch_uuids, daemon=True).start()
+
+    def fetch_uuids(self):
+        try:
+            import requests
+            with METRICS.stage("uuid_fetch"):
+                response = requests.get(
+                    f"{UUID_API_URL}/count/{UUID_POOL_SIZE}", timeout=UUID_API_TIMEOUT)
+            response.raise_for_status()
+            self.uuid_pool.extend(response.json())
+        except Exception as e:
+            self.next_refill = time.monotonic() + UUID_RETRY_DELAY
+            self.logger.error(f"UUID generation failed: {str(e)}", extra={
+                              "uuid": str(uuid4())})
+        finally:
+            self.refilling.release()
+
+    def log(self, message):
+        with METRICS.stage("log"):
+            uuid = self.get_uuid()
+            self.logger.error(message, extra={"uuid": uuid})
+
+
+class LogTail:
+    """Reads the lines appended to a log file since the previous call."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read_new_lines(self):
+        """Return (reset, lines); reset is True if the file was truncated."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return False, []
+        reset = size < self.offset
+        if reset:
+            self.offset = 0
+        if size == self.offset:
+            return reset, []
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            data = file.read(size - self.offset)
+        # Leave a partially written last line for the next call
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        return reset, data[:end].decode("utf-8", "replace").splitlines()
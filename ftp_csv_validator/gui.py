@@ -0,0 +1,447 @@
+"""The Tkinter application."""
+import time
+import queue
+import threading
+from tkinter import Button, Label, messagebox, Listbox, Scrollbar, END, Entry, StringVar, Frame, Toplevel
+from tkinter import filedialog, ttk
+
+from .config import (ERROR_LOG_FILE, ERROR_LOG_POLL_MS, ERROR_LOG_VIEW_LIMIT, PROGRESS_INTERVAL, PROGRESS_POLL_MS,
+                     VALID_DIR)
+from .errorlog import Logger, LogTail
+from .metrics import METRICS
+from .processing import ParallelFileProcessor, ProcessResult
+from .state import BatchIdIndex, OutputStore, ProcessedLedger, VerdictCache
+from .transport import FTPClient, FTPConnectionPool, MultiServerPool, TransferCancelled
+
+
+class DownloadStatus:
+    def __init__(self):
+        self.status = 'Idle'
+        self.status_label = None
+
+    def set_status_label(self, label):
+        self.status_label = label
+
+    def change_status(self, type):
+        if (type == "start"):
+            self.status = 'Downloading...'
+        elif (type == "success"):
+            self.status = 'Download Success'
+        elif (type == "cancelled"):
+            self.status = 'Download Cancelled'
+        else:
+            self.status = 'Download Failed!'
+
+        # Update the status label if it exists
+        if self.status_label:
+            self.status_label.config(text=self.status)
+
+        return self.status
+
+
+class App:
+    def __init__(self, root):
+        self.root = root
+        self.search_var = StringVar()
+        self.search_mode_var = StringVar(value="substring")
+        self.ftp_client = FTPClient(ledger=ProcessedLedger(), batch_index=BatchIdIndex(),
+                                    verdicts=VerdictCache(), outputs=OutputStore())
+        self.logger = Logger()
+        # Set by connect_endpoints: the servers listed together, and the
+        # (source, name) behind each row of the file list
+        self.fleet = None
+        self.listed = []
+        self.file_listbox = None
+        self.valid_files_listbox = None
+        self.error_logs_listbox = None
+        self.download_status = DownloadStatus()
+        # Transfers run on a worker thread with its own FTP session and
+        # report back through transfer_events, drained by root.after.
+        # With a fleet each server gets a transfer session of its own, so
+        # a listing never waits for a transfer to release one.
+        self.transfer_pool = None
+        self.fleet_transfer_pools = {}
+        self.transfer_queue = queue.Queue()
+        self.transfer_events = queue.Queue()
+        self.transfer_thread = None
+        self.cancel_event = threading.Event()
+        self.pending_transfers = 0
+        self.transfer_started = None
+        self.last_progress = 0.0
+        self.error_log_tail = LogTail(ERROR_LOG_FILE)
+        self.build_gui()
+        self.root.after(PROGRESS_POLL_MS, self.poll_transfer_events)
+        self.root.after(ERROR_LOG_POLL_MS, self.poll_error_logs)
+
+    def build_gui(self):
+        self.root.title("FTP CSV Validator")
+        self.root.geometry("800x600")
+
+        main_frame = Frame(self.root)
+        main_frame.pack(padx=10, pady=10, fill="both", expand=True)
+
+        # Connection Frame
+        connection_frame = Frame(main_frame)
+        connection_frame.pack(fill="x", pady=5)
+        Label(connection_frame, text="FTP Connection",
+              font=("Arial", 12, "bold")).pack(anchor="w")
+        Button(connection_frame, text="Connect to FTP",
+               command=self.connect_ftp_form, width=20).pack(side="left", padx=5)
+        Button(connection_frame, text="Load Endpoints",
+               command=self.connect_endpoints, width=20).pack(side="left", padx=5)
+
+        # Available Files Frame
+        header_frame = Frame(main_frame)
+        header_frame.pack(fill="both", expand=True)
+        Label(header_frame, text="Available Files", font=(
+            "Arial", 12, "bold")).pack(side="left")
+        Label(header_frame, text="Download status: ",
+              font=("Arial", 12, "bold")).pack(side="left")
+
+        # Create status label and set it in download_status
+        status_label = Label(header_frame, text=self.download_status.status,
+                             font=("Arial", 12, "bold"))
+        status_label.pack(side="left")
+        self.download_status.set_status_label(status_label)
+
+        # Search Frame
+        search_frame = Frame(header_frame)
+        search_frame.pack(side="right")
+        self.search_entry = Entry(search_frame, textvariable=self.search_var)
+        self.search_entry.pack(side="left")
+        ttk.Combobox(search_frame, textvariable=self.search_mode_var, width=9, state="readonly",
+                     values=("substring", "glob", "prefix")).pack(side="left", padx=3)
+        Button(search_frame, text="Search",
+               command=self.searchFileName).pack(side="left", padx=3)
+        Button(search_frame, text="Clear Search",
+               command=self.clearSearch).pack(side="right")
+
+        # Bind the <Return> key to the search function
+        self.search_entry.bind("<Return>", lambda event: self.searchFileName())
+
+        # Available Files Frame
+        file_frame = Frame(main_frame)
+        file_frame.pack(fill="both", expand=True, pady=5)
+        self.file_listbox = Listbox(file_frame, width=60, height=10)
+        self.file_listbox.pack(side="left", fill="both", expand=True)
+
+        scrollbar = Scrollbar(file_frame)
+        scrollbar.pack(side="right", fill="y")
+        self.file_listbox.config(yscrollcommand=scrollbar.set)
+        scrollbar.config(command=self.file_listbox.yview)
+
+        # Buttons Frame
+        button_frame = Frame(main_frame)
+        button_frame.pack(fill="x", pady=5)
+        Button(button_frame, text="List Files", command=self.list_files,
+               width=20).pack(side="left", padx=5)
+        Button(button_frame, text="Download Selected File",
+               command=self.download_selected_file, width=25).pack(side="left", padx=5)
+
+        # Progress Frame
+        progress_frame = Frame(main_frame)
+        progress_frame.pack(fill="x", pady=5)
+        self.progressbar = ttk.Progressbar(progress_frame, length=300, mode='determinate')
+        self.progressbar.pack(side="left", padx=5)
+        self.progress_label = Label(progress_frame, text="")
+        self.progress_label.pack(side="left", padx=5)
+        Button(progress_frame, text="Cancel",
+               command=self.cancel_download).pack(side="right", padx=5)
+        self.queue_label = Label(progress_frame, text="")
+        self.queue_label.pack(side="right", padx=5)
+
+        # Valid Files Frame
+        valid_files_frame = Frame(main_frame)
+        valid_files_frame.pack(fill="both", expand=True, pady=5)
+        Label(valid_files_frame, text="Valid Files", font=(
+            "Arial", 12, "bold")).pack(anchor="w", pady=5)
+        self.valid_files_listbox = Listbox(
+            valid_files_frame, width=60, height=5)
+        self.valid_files_listbox.pack(side="left", fill="both", expand=True)
+
+        valid_scrollbar = Scrollbar(valid_files_frame)
+        valid_scrollbar.pack(side="right", fill="y")
+        self.valid_files_listbox.config(yscrollcommand=valid_scrollbar.set)
+        valid_scrollbar.config(command=self.valid_files_listbox.yview)
+
+        # Error Logs Frame
+        error_logs_frame = Frame(main_frame)
+        error_logs_frame.pack(fill="both", expand=True, pady=5)
+        Label(error_logs_frame, text="Error Logs", font=(
+            "Arial", 12, "bold")).pack(anchor="w", pady=5)
+        self.error_logs_listbox = Listbox(error_logs_frame, width=60, height=5)
+        self.error_logs_listbox.pack(side="left", fill="both", expand=True)
+
+        error_scrollbar = Scrollbar(error_logs_frame)
+        error_scrollbar.pack(side="right", fill="y")
+        self.error_logs_listbox.config(yscrollcommand=error_scrollbar.set)
+        error_scrollbar.config(command=self.error_logs_listbox.yview)
+
+        # The error log is truncated at startup and tailed by
+        # poll_error_logs, so there is nothing to load here
+
+    def connect_ftp_form(self):
+        def connect():
+            try:
+                self.ftp_client.connect(
+                    host_var.get(), user_var.get(), pass_var.get())
+                if self.transfer_pool:
+                    self.transfer_pool.close()
+                self.transfer_pool = None
+                self.close_fleet()
+                messagebox.showinfo("Success", "Connected to FTP Server")
+                ftp_window.destroy()
+            except Exception as e:
+                messagebox.showerror("Error", f"FTP connection failed: {e}")
+
+        ftp_window = Toplevel(self.root)
+        ftp_window.title("FTP Connection")
+
+        Label(ftp_window, text="Hostname:").grid(
+            row=0, column=0, padx=5, pady=5)
+        host_var = StringVar()
+        Entry(ftp_window, textvariable=host_var).grid(
+            row=0, column=1, padx=5, pady=5)
+
+        Label(ftp_window, text="Username:").grid(
+            row=1, column=0, padx=5, pady=5)
+        user_var = StringVar()
+        Entry(ftp_window, textvariable=user_var).grid(
+            row=1, column=1, padx=5, pady=5)
+
+        Label(ftp_window, text="Password:").grid(
+            row=2, column=0, padx=5, pady=5)
+        pass_var = StringVar()
+        Entry(ftp_window, textvariable=pass_var,
+              show="*").grid(row=2, column=1, padx=5, pady=5)
+
+        Button(ftp_window, text="Connect", command=connect).grid(
+            row=3, column=0, columnspan=2, pady=10)
+
+    def connect_endpoints(self):
+        """Collect from every server of an endpoints file at once."""
+        path = filedialog.askopenfilename(title="Endpoints", filetypes=[("JSON", "*.json"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            endpoints = MultiServerPool.read_endpoints(path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load endpoints: {e}")
+            return
+        self.close_fleet()
+        self.fleet = MultiServerPool(endpoints, ledger=self.ftp_client.ledger,
+                                     batch_index=self.ftp_client.batch_index, verdicts=self.ftp_client.verdicts,
+                                     outputs=self.ftp_client.outputs)
+        self.list_files()
+
+    def close_fleet(self):
+        for pool in self.fleet_transfer_pools.values():
+            pool.close()
+        self.fleet_transfer_pools = {}
+        if self.fleet:
+            self.fleet.close()
+        self.fleet = None
+
+    def is_connected(self):
+        return self.fleet is not None or self.ftp_client.is_connected()
+
+    def show_files(self, files):
+        """Fill the file list with names, or (source, name) pairs from the fleet."""
+        self.file_listbox.delete(0, END)
+        self.listed = list(files)
+        for file in self.listed:
+            self.file_listbox.insert(END, f"{file[0]}: {file[1]}" if self.fleet else file)
+
+    def list_files(self):
+        if not self.is_connected():
+            messagebox.showerror("Error", "Not connected to FTP")
+            return
+        try:
+            if self.fleet:
+                self.show_files(self.fleet.list_files())
+                if self.fleet.errors:
+                    messagebox.showwarning("Warning", "Failed to list:\n" + "\n".join(
+                        f"{source}: {error}" for source, error in self.fleet.errors.items()))
+            else:
+                self.show_files(self.ftp_client.list_files())
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to list files: {e}")
+
+    def searchFileName(self):
+        if not self.is_connected():
+            messagebox.showerror("Error", "Not connected to FTP")
+            return
+        search_value = self.search_var.get().strip()
+        if not search_value:
+            messagebox.showerror("Error", "Please enter search keyword")
+            return
+        try:
+            if self.fleet:
+                found_files = self.fleet.search(search_value, self.search_mode_var.get())
+            else:
+                found_files = self.ftp_client.search_files(
+                    search_value, self.search_mode_var.get())
+            if not found_files:
+                messagebox.showerror('Error', "There is no file with this name!")
+            self.show_files(found_files)
+        except Exception as e:
+            messagebox.showerror("Error", f"Search failed: {e}")
+
+    def clearSearch(self):
+        self.search_var.set('')
+
+    def download_selected_file(self):
+        self.download_status.change_status("start")
+        if not self.is_connected():
+            self.download_status.change_status("error")
+            messagebox.showerror("Error", "Not connected to FTP")
+            return
+
+        selected = self.file_listbox.curselection()
+        if not selected:
+            self.download_status.change_status("error")
+            messagebox.showerror("Error", "No file selected")
+            return
+
+        if self.fleet:
+            source, filename = self.listed[selected[0]]
+            pool = self.get_fleet_transfer_pool(source)
+        else:
+            filename = self.listed[selected[0]]
+            pool = self.get_transfer_pool()
+        self.pending_transfers += 1
+        self.update_queue_label()
+        self.transfer_queue.put((pool, filename))
+        if self.transfer_thread is None:
+            self.transfer_thread = threading.Thread(target=self.transfer_worker, daemon=True)
+            self.transfer_thread.start()
+
+    def get_transfer_pool(self):
+        if self.transfer_pool is None:
+            self.transfer_pool = FTPConnectionPool(*self.ftp_client.credentials, size=1,
+                                                   ledger=self.ftp_client.ledger,
+                                                   batch_index=self.ftp_client.batch_index,
+                                                   verdicts=self.ftp_client.verdicts,
+                                                   outputs=self.ftp_client.outputs)
+            self.transfer_pool.index = self.ftp_client.index
+        return self.transfer_pool
+
+    def get_fleet_transfer_pool(self, source):
+        if source not in self.fleet_transfer_pools:
+            listing = self.fleet.pools[source]
+            pool = FTPConnectionPool(*listing.credentials, size=1, directory=listing.directory,
+                                     ledger=self.fleet.ledger, batch_index=self.fleet.batch_index,
+                                     verdicts=self.fleet.verdicts, outputs=self.fleet.outputs)
+            pool.index = listing.index
+            self.fleet_transfer_pools[source] = pool
+        return self.fleet_transfer_pools[source]
+
+    def cancel_download(self):
+        self.cancel_event.set()
+
+    def transfer_worker(self):
+        """Runs queued downloads; never touches widgets."""
+        while True:
+            pool, filename = self.transfer_queue.get()
+            self.cancel_event.clear()
+            self.transfer_events.put(("start", filename, None))
+            try:
+                processor = ParallelFileProcessor(pool, self.logger)
+                with METRICS.stage("gui_transfer"):
+                    result = processor.process(filename, progress=self.report_progress)
+            except Exception as e:
+                self.logger.log(f"Download error: {str(e)}")
+                result = ProcessResult(filename, "download_error", str(e), 0)
+            self.transfer_events.put(("done", filename, result))
+
+    def report_progress(self, received, total):
+        if self.cancel_event.is_set():
+            raise TransferCancelled("Download cancelled")
+        now = time.monotonic()
+        if now - self.last_progress >= PROGRESS_INTERVAL or received >= total:
+            self.last_progress = now
+            self.transfer_events.put(("progress", received, total))
+
+    def poll_transfer_events(self):
+        try:
+            while True:
+                kind, first, second = self.transfer_events.get_nowait()
+                if kind == "start":
+                    self.transfer_started = time.monotonic()
+                    self.progressbar.config(value=0, maximum=1)
+                    self.progress_label.config(text=f"{first}: starting")
+                    self.download_status.change_status("start")
+                elif kind == "progress":
+                    self.show_progress(first, second)
+                else:
+                    self.pending_transfers -= 1
+                    self.update_queue_label()
+                    self.show_result(second)
+        except queue.Empty:
+            pass
+        self.root.after(PROGRESS_POLL_MS, self.poll_transfer_events)
+
+    def show_progress(self, received, total):
+        elapsed = max(time.monotonic() - self.transfer_started, 1e-6)
+        rate = received / elapsed
+        eta = (total - received) / rate if rate else 0
+        self.progressbar.config(value=received, maximum=max(total, 1))
+        self.progress_label.config(
+            text=f"{received / 1e6:.1f}/{total / 1e6:.1f} MB, {rate / 1e6:.2f} MB/s, ETA {eta:.0f} s")
+
+    def update_queue_label(self):
+        waiting = max(self.pending_transfers - 1, 0)
+        self.queue_label.config(text=f"{waiting} queued" if waiting else "")
+
+    def show_result(self, result):
+        if result.outcome == "saved":
+            new_filename = result.message
+            self.valid_files_listbox.insert(END, new_filename)
+            self.valid_files_listbox.see(END)
+            self.valid_files_listbox.selection_clear(0, END)
+            self.valid_files_listbox.selection_set(END)
+            self.download_status.change_status("success")
+            messagebox.showinfo(
+                "Success", f"File saved as '{new_filename}' in '{VALID_DIR}'.")
+            return
+
+        if result.outcome == "cancelled":
+            self.download_status.change_status("cancelled")
+            self.progress_label.config(text=f"{result.filename}: cancelled")
+            return
+
+        self.download_status.change_status("error")
+        if result.outcome == "skipped":
+            messagebox.showwarning("Warning", result.message)
+            return
+        self.load_error_logs()
+        if result.outcome == "bad_extension":
+            messagebox.showerror("Invalid File", result.message)
+        elif result.outcome == "empty":
+            messagebox.showwarning("Warning", result.message)
+        elif result.outcome == "invalid":
+            messagebox.showerror("Validation Error",
+                                 f"Validation failed:\n{result.message}")
+        elif result.outcome == "download_error":
+            messagebox.showerror(
+                "Download Error", f"Failed to download/process file:\n{result.message}")
+
+    def load_error_logs(self):
+        """Append lines written since the last call to the error_logs_listbox."""
+        try:
+            reset, lines = self.error_log_tail.read_new_lines()
+            if reset:
+                self.error_logs_listbox.delete(0, END)
+            for log in lines:
+                self.error_logs_listbox.insert(END, log.strip())
+            overflow = self.error_logs_listbox.size() - ERROR_LOG_VIEW_LIMIT
+            if overflow > 0:
+                self.error_logs_listbox.delete(0, overflow - 1)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load error logs: {e}")
+
+    def poll_error_logs(self):
+        # Records are written by the logger's background thread, so lines
+        # can land after the load_error_logs call that follows an error.
+        self.load_error_logs()
+        self.root.after(ERROR_LOG_POLL_MS, self.poll_error_logs)
@@ -0,0 +1,126 @@
+"""Live stage timings and counters (the --metrics snapshot)."""
+import os
+import time
+import atexit
+import threading
+import contextlib
+
+from .config import METRICS_INTERVAL, METRICS_PREFIX
+
+
+class Metrics:
+    """Per-stage timings and counters, written to a snapshot file.
+
+    Disabled by default: stage() then hands back one shared no-op context
+    manager and add() returns at once, so the hooks cost a method call.
+    Once enabled, a daemon thread rewrites the snapshot every interval
+    seconds while anything changes.
+    """
+
+    NO_OP = contextlib.nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.changed = threading.Event()
+
+    def enable(self, path, interval=METRICS_INTERVAL):
+        self.path = path
+        self.enabled = True
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        threading.Thread(target=self.write_loop, args=(interval,), daemon=True).start()
+        atexit.register(self.close)
+
+    def close(self):
+        """Write a final snapshot and stop recording."""
+        if self.enabled:
+            atexit.unregister(self.close)
+            self.write()
+            self.enabled = False
+
+    def stage(self, name):
+        """Context manager timing one run of a stage."""
+        if not self.enabled:
+            return self.NO_OP
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+        self.changed.set()
+
+    def add(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.changed.set()
+
+    def snapshot(self):
+        # Imported here, like json below, to keep this module cheap to import
+        from datetime import datetime
+        with self.lock:
+            return {
+                "stages": {name: {"calls": calls, "seconds": seconds, "max_seconds": longest}
+                           for name, (calls, seconds, longest) in self.stages.items()},
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in self.counters.items()],
+                "updated_at": datetime.now().isoformat(),
+            }
+
+    def render(self, snapshot):
+        if self.path.endswith(".json"):
+            import json
+            return json.dumps(snapshot, indent=2)
+        lines = []
+        for kind in ("calls", "seconds", "max_seconds"):
+            metric = f"{METRICS_PREFIX}_stage_{kind}" + ("" if kind == "max_seconds" else "_total")
+            lines.append(f"# TYPE {metric} {'gauge' if kind == 'max_seconds' else 'counter'}")
+            lines.extend(f'{metric}{{stage="{name}"}} {stats[kind]}'
+                         for name, stats in sorted(snapshot["stages"].items()))
+        for counter in sorted(snapshot["counters"], key=lambda c: (c["name"], sorted(c["labels"].items()))):
+            labels = ",".join(f'{key}="{value}"' for key, value in sorted(counter["labels"].items()))
+            labels = f"{{{labels}}}" if labels else ""
+            lines.append(f"{METRICS_PREFIX}_{counter['name']}_total{labels} {counter['value']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        if not self.enabled:
+            return
+        self.changed.clear()
+        with open(self.path + ".tmp", "w") as f:
+            f.write(self.render(self.snapshot()))
+        os.replace(self.path + ".tmp", self.path)
+
+    def write_loop(self, interval):
+        while True:
+            self.changed.wait()
+            try:
+                self.write()
+            except OSError:
+                pass
+            time.sleep(interval)
+
+
+class StageTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.perf_counter() - self.started)
+
+
+METRICS = Metrics()
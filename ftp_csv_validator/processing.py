@@ -0,0 +1,466 @@
+"""The per-file pipeline shared by the GUI and the headless runner."""
+import queue
+import ftplib
+import random
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .config import CSV_EXTENSIONS, SCHEDULE, WATCH_INTERVAL, WATCH_JITTER, WATCH_MAX_INTERVAL
+from .metrics import METRICS
+from .schema import Schema
+from .sidecar import SidecarWriter
+from .state import ProcessedLedger
+from .transport import RemoteEntry, TransferCancelled
+from .validation import ContentDigest, Decompressor, FileValidator, StreamingValidator, ValidationReport
+
+
+# source names the server of a MultiServerProcessor result
+ProcessResult = namedtuple("ProcessResult", "filename outcome message bytes source", defaults=(None,))
+
+
+class FileProcessor:
+    """The size check, download, validate and save pipeline for one file.
+
+    Shared by the GUI and the headless runner; it only logs, so callers
+    decide how to present each outcome: "saved", "skipped", "bad_extension",
+    "empty", "size_error", "invalid", "download_error" or "cancelled". The
+    message of a saved file is its path in the client's OutputStore.
+    """
+
+    def __init__(self, ftp_client, logger, sidecar=False, diagnostics=None, schema=None):
+        self.ftp_client = ftp_client
+        self.logger = logger
+        # Also write a binary Sidecar next to every saved file
+        self.sidecar = sidecar
+        # Violation limit of the full-diagnostics mode; None stops at the
+        # first error
+        self.diagnostics = diagnostics
+        # Schema of the files in place of EXPECTED_HEADERS; sidecars are
+        # only written for the default layout
+        self.schema = schema
+
+    def cache_digests(self, digests):
+        if self.schema is None or not digests:
+            return digests
+        return self.schema.cache_digests(digests)
+
+    def process(self, filename, progress=None, entry=None):
+        """progress, if given, is called as progress(bytes_received, size).
+
+        entry is the file's RemoteEntry if the caller has listed it, and
+        defaults to the cached listing's.
+        """
+        with METRICS.stage("process"):
+            result = self.check_and_download(filename, progress, entry)
+        return self.count(result)
+
+    @staticmethod
+    def count(result):
+        if result.outcome == "invalid":
+            METRICS.add("files", outcome=result.outcome, reason=FileValidator.error_category(result.message))
+        else:
+            METRICS.add("files", outcome=result.outcome)
+        return result
+
+    def screen(self, filename, entry=None):
+        """Reject what the listing and the ledger alone tell apart.
+
+        A file processed already, one without a CSV extension and an empty
+        one get their ProcessResult without a round trip; None means the
+        file has to be fetched. entry defaults to the cached listing's.
+        """
+        ledger = self.ftp_client.ledger
+        path = self.ftp_client.remote_path(filename)
+        entry = entry or self.ftp_client.index.lookup(filename)
+        size = entry.size if entry else None
+        modify = entry.modify if entry else None
+
+        # If this version of the file was already processed, skip re-downloading
+        if entry and ledger.is_processed(path, size, modify):
+            return ProcessResult(filename, "skipped", f"File '{filename}' already downloaded or attempted.", 0)
+
+        # New Validation: Check file extension
+        if not filename.lower().endswith(tuple(CSV_EXTENSIONS)):
+            allowed = ", ".join(f"'{extension}'" for extension in CSV_EXTENSIONS)
+            error_msg = f"Invalid file extension for '{filename}'. Only {allowed} files are allowed."
+            self.logger.log(error_msg)
+            ledger.record(path, size, modify, "bad_extension", error_msg)
+            return ProcessResult(filename, "bad_extension", error_msg, 0)
+
+        if size == 0:
+            error_msg = f"File '{filename}' is empty (zero size)."
+            self.logger.log(error_msg)
+            ledger.record(path, size, modify, "empty", error_msg)
+            return ProcessResult(filename, "empty", error_msg, 0)
+        return None
+
+    def check_and_download(self, filename, progress=None, entry=None):
+        # Read once: the cached listing may go stale while this file waits
+        entry = entry or self.ftp_client.index.lookup(filename)
+        result = self.screen(filename, entry)
+        if result is not None:
+            return result
+        ledger = self.ftp_client.ledger
+        path = self.ftp_client.remote_path(filename)
+        size = entry.size if entry else None
+        modify = entry.modify if entry else None
+
+        if size is None:
+            # Not in a fresh listing, or listed without a size
+            try:
+                size = self.ftp_client.size(filename)
+            except Exception as e:
+                self.logger.log(f"Download size check error: {str(e)}")
+                ledger.record(path, size, modify, "size_error", str(e))
+                return ProcessResult(filename, "size_error", str(e), 0)
+            result = self.screen(filename, RemoteEntry(filename, size, modify))
+            if result is not None:
+                return result
+
+        # Content whose verdict is known needs no transfer at all
+        digests = self.ftp_client.remote_digests(filename)
+        verdict = None
+        if digests:
+            verdict = self.ftp_client.verdicts.lookup(self.cache_digests(digests), size)
+            METRICS.add("verdict_cache", result="hit" if verdict else "miss")
+        if verdict is not None and (not verdict.valid or verdict.source is not None):
+            if verdict.valid:
+                error_msg = f"Same content as {verdict.source} (accepted in an earlier file)"
+            else:
+                error_msg = verdict.message
+            self.logger.log(f"Validation failed for '{filename}': {error_msg} (known content, not downloaded)")
+            ledger.record(path, size, modify, "invalid", error_msg)
+            return ProcessResult(filename, "invalid", error_msg, 0)
+
+        result = self.download(filename, size, progress, digests, modify)
+        # A cancelled file can be queued again
+        if result.outcome != "cancelled":
+            ledger.record(path, size, modify, result.outcome, result.message)
+        return result
+
+    def download(self, filename, size, progress=None, digests=None, modify=None):
+        batch_index = self.ftp_client.batch_index
+        verdicts = self.ftp_client.verdicts
+        outputs = self.ftp_client.outputs
+        remote_path = self.ftp_client.remote_path(filename)
+        digest = ContentDigest()
+        violations = ValidationReport(self.diagnostics) if self.diagnostics is not None else None
+        try:
+            validator = StreamingValidator(batch_index=batch_index,
+                                           sidecar=SidecarWriter() if self.sidecar and self.schema is None else None,
+                                           report=violations, compression=Decompressor.codec_for(filename),
+                                           schema=self.schema)
+        except ImportError as e:
+            # .csv.zst without zstandard; retried once it is installed
+            self.logger.log(f"Download error: {str(e)}")
+            return ProcessResult(filename, "download_error", str(e), 0)
+        report = (lambda received: progress(received, size)) if progress else None
+        try:
+            valid, msg, spool = self.ftp_client.download_validated(filename, validator, report, size=size,
+                                                                   digest=digest, modify=modify)
+            # Local digests only cover the content if all of it arrived
+            local = digest.hexdigests() if digest.size == size else {}
+            digests = dict(digests or {}, **local)
+            if not valid:
+                # A duplicate of an earlier file says nothing about the content itself
+                if digests and FileValidator.error_category(msg) != "duplicate_earlier_file":
+                    verdicts.record(self.cache_digests(digests), size, False, msg)
+                if violations is not None:
+                    path = violations.write(filename, remote_path)
+                    msg = f"{msg} ({violations.summary()}, report: {path})"
+                self.logger.log(f"Validation failed for '{filename}': {msg}")
+                return ProcessResult(filename, "invalid", msg, validator.bytes_received)
+            if validator.decompressor is not None:
+                with METRICS.stage("inflate"):
+                    spool = Decompressor.inflate(spool, validator.decompressor.codec)
+            with METRICS.stage("publish"):
+                new_filename = outputs.publish(spool, digests.get("sha256"))
+            # Another worker may have accepted one of these ids meanwhile
+            duplicate = batch_index.commit(validator.batch_ids, remote_path)
+            if duplicate is not None:
+                outputs.discard(new_filename)
+                msg = f"Duplicate batch_id {duplicate} (accepted in an earlier file)"
+                self.logger.log(f"Validation failed for '{filename}': {msg}")
+                return ProcessResult(filename, "invalid", msg, validator.bytes_received)
+            outputs.record(new_filename, remote_path, size, digests, validator.row_num - 1, validator.batch_ids)
+            verdicts.record(self.cache_digests(digests), size, True, msg, source=remote_path)
+            if validator.sidecar is not None:
+                try:
+                    validator.sidecar.write(outputs.path(new_filename))
+                except OSError as e:
+                    # The CSV itself is saved; only the fast path is missing
+                    self.logger.log(f"Sidecar error for '{new_filename}': {str(e)}")
+            return ProcessResult(filename, "saved", new_filename, validator.bytes_received)
+        except TransferCancelled:
+            return ProcessResult(filename, "cancelled", "Download cancelled", validator.bytes_received)
+        except Exception as e:
+            self.logger.log(f"Download error: {str(e)}")
+            return ProcessResult(filename, "download_error", str(e), validator.bytes_received)
+
+
+def smallest_first(entries):
+    """Shortest job first: the soonest first result and mean completion time."""
+    return sorted(entries, key=lambda entry: (entry.size is None, entry.size or 0))
+
+
+def oldest_first(entries):
+    """In upload order, by modify time."""
+    return sorted(entries, key=lambda entry: (entry.modify is None, entry.modify or ""))
+
+
+def size_balanced(entries):
+    """Largest first, so the workers end up with about equal bytes.
+
+    Handing the largest remaining file to whichever worker frees up first
+    (LPT) keeps any one worker from finishing long after the others. The
+    smallest file goes ahead of them all, so a result still comes at once.
+    """
+    ordered = sorted(entries, key=lambda entry: (entry.size is None, -(entry.size or 0)))
+    if len(ordered) > 1:
+        smallest = smallest_first(ordered)[0]
+        ordered.remove(smallest)
+        ordered.insert(0, smallest)
+    return ordered
+
+
+# Orders in which ParallelFileProcessor starts its downloads; each takes
+# and returns a list of RemoteEntry, whose size or modify may be None
+SCHEDULES = {"listing": list, "smallest-first": smallest_first, "oldest-first": oldest_first,
+             "size-balanced": size_balanced}
+
+
+class ParallelFileProcessor:
+    """Runs FileProcessor over many files with one worker per pooled session.
+
+    schedule is the name of a policy in SCHEDULES, or a function like
+    them, deciding in which order the downloads start.
+    """
+
+    def __init__(self, pool, logger, workers=None, sidecar=False, diagnostics=None, schema=None,
+                 schedule=SCHEDULE):
+        self.pool = pool
+        self.logger = logger
+        self.workers = workers or pool.size
+        self.sidecar = sidecar
+        self.diagnostics = diagnostics
+        self.schema = schema
+        if isinstance(schedule, str):
+            if schedule not in SCHEDULES:
+                raise ValueError(f"Unknown schedule: {schedule}")
+            schedule = SCHEDULES[schedule]
+        self.schedule = schedule
+
+    def processor(self, client):
+        return FileProcessor(client, self.logger, self.sidecar, self.diagnostics, self.schema)
+
+    def process(self, filename, progress=None, entry=None):
+        client = self.pool.acquire()
+        result = None
+        try:
+            result = self.processor(client).process(filename, progress, entry)
+        finally:
+            healthy = result is not None and result.outcome not in ("size_error", "download_error")
+            self.pool.release(client, healthy)
+        return result
+
+    def prefetch(self, filenames):
+        """Screen filenames against one listing of the directory.
+
+        The directory is listed once, unless the cached listing is fresh
+        and has every file, so no file costs a SIZE round trip of its own.
+        Returns the ProcessResults of the files rejected from the listing
+        and the RemoteEntry of each file left to download. If no session
+        can be had, every file is left to download. The entries are those
+        of this listing even if it goes stale before the last download.
+        """
+        try:
+            client = self.pool.acquire()
+        except Exception:
+            # Each download reports the error
+            return [], [RemoteEntry(name, None, None) for name in filenames]
+        healthy = True
+        try:
+            index = client.index
+            if index.is_stale() or any(name not in index.entries for name in filenames):
+                try:
+                    client.list_files()
+                except Exception as e:
+                    # Files are then sized one by one
+                    self.logger.log(f"Listing error: {str(e)}")
+                    healthy = False
+            # A failed listing leaves entries that may be out of date
+            listing = index.entries if healthy else {}
+            processor = self.processor(client)
+            results, entries = [], []
+            for name in filenames:
+                entry = listing.get(name)
+                result = processor.screen(name, entry)
+                if result is not None:
+                    results.append(FileProcessor.count(result))
+                else:
+                    entries.append(entry or RemoteEntry(name, None, None))
+        finally:
+            self.pool.release(client, healthy)
+        return results, entries
+
+    def run(self, filenames):
+        """Yield a ProcessResult per file, in completion order.
+
+        Files rejected from the listing come first; the rest are started
+        in the order of the schedule.
+        """
+        filenames = list(filenames)
+        if not filenames:
+            return
+        results, entries = self.prefetch(filenames)
+        yield from results
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.process, entry.name, None, entry): entry.name
+                       for entry in self.schedule(entries)}
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    # The session could not be opened or reconnected
+                    self.logger.log(f"Download error: {str(e)}")
+                    yield ProcessResult(futures[future], "download_error", str(e), 0)
+
+
+class MultiServerProcessor:
+    """Fans the pipeline out over every server of a MultiServerPool.
+
+    Each server is listed and processed on threads of its own, at most
+    its pool's size files at a time, so a slow or unreachable server only
+    holds up its own files. Results carry their server's name as source.
+    Files are checked against their endpoint's schema file, if it has one,
+    and schema otherwise.
+    """
+
+    def __init__(self, fleet, logger, sidecar=False, diagnostics=None, schema=None, schedule=SCHEDULE):
+        self.fleet = fleet
+        self.logger = logger
+        schemas = {path: Schema.load(path) for path in {endpoint.schema for endpoint in fleet.endpoints.values()}
+                   if path}
+        self.processors = {
+            source: ParallelFileProcessor(pool, logger, sidecar=sidecar, diagnostics=diagnostics,
+                                          schema=schemas.get(fleet.endpoints[source].schema, schema),
+                                          schedule=schedule)
+            for source, pool in fleet.pools.items()}
+
+    def run(self, files):
+        """Yield a ProcessResult per (source, filename) pair, in completion order."""
+        names = {}
+        for source, filename in files:
+            names.setdefault(source, []).append(filename)
+        return self.fan_out({source: (lambda names=names[source]: names) for source in names})
+
+    def collect(self, select=None):
+        """List every server and process the files select(name) accepts.
+
+        A server's files start as soon as its own listing arrives. One that
+        cannot be listed is logged and its error kept in fleet.errors.
+        """
+        def listing(source):
+            names = self.fleet.list_source(source)
+            return [name for name in names if select is None or select(name)]
+
+        return self.fan_out({source: (lambda source=source: listing(source)) for source in self.fleet.pools})
+
+    def fan_out(self, jobs):
+        results = queue.Queue()
+
+        def drain(source, names):
+            try:
+                try:
+                    names = names()
+                except Exception as e:
+                    self.logger.log(f"FTP connection failed for {source}: {str(e)}")
+                    return
+                for result in self.processors[source].run(names):
+                    METRICS.add("files_by_source", source=source, outcome=result.outcome)
+                    results.put(result._replace(source=source))
+            finally:
+                results.put(None)
+
+        threads = [threading.Thread(target=drain, args=job, daemon=True) for job in jobs.items()]
+        for thread in threads:
+            thread.start()
+        running = len(threads)
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+            else:
+                yield result
+
+
+class DirectoryWatcher:
+    """Polls a remote directory and reports CSV files once they settle.
+
+    Each poll is a single listing on one long-lived session. A file is
+    ready when its size and modify time are the same on two consecutive
+    polls, so uploads in progress are left alone, and it is reported once
+    per version, unless handling it ends in an outcome the ledger retries
+    (a failed transfer): then it is reported again on every poll. While
+    nothing changes the interval doubles up to max_interval; any change
+    brings it back to interval, a retried file does not.
+    """
+
+    def __init__(self, ftp_client, interval=WATCH_INTERVAL, max_interval=WATCH_MAX_INTERVAL,
+                 jitter=WATCH_JITTER):
+        self.ftp_client = ftp_client
+        self.interval = interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.delay = interval
+        self.snapshot = {}
+        self.reported = {}
+        self.retrying = set()
+
+    def poll(self):
+        """List the directory once; return the names of files ready to process."""
+        self.ftp_client.list_files()
+        snapshot = {name: (entry.size, entry.modify)
+                    for name, entry in self.ftp_client.index.entries.items()
+                    if name.lower().endswith(tuple(CSV_EXTENSIONS))}
+        ready = [name for name, version in snapshot.items()
+                 if self.snapshot.get(name) == version and self.reported.get(name) != version]
+        changed = snapshot != self.snapshot or bool(set(ready) - self.retrying)
+        self.snapshot = snapshot
+        for name in ready:
+            self.reported[name] = snapshot[name]
+        # Forget deleted files, so one uploaded again is picked up
+        self.reported = {name: version for name, version in self.reported.items() if name in snapshot}
+        self.delay = self.interval if changed else min(self.delay * 2, self.max_interval)
+        return ready
+
+    def settle(self, results):
+        """Unmark the files whose ProcessResults the ledger would retry."""
+        final = ProcessedLedger.FINAL_OUTCOMES + ("skipped",)
+        self.retrying = {result.filename for result in results if result.outcome not in final}
+        for name in self.retrying:
+            self.reported.pop(name, None)
+
+    def next_delay(self):
+        return self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self, handle, stop):
+        """Call handle(names) for every batch of ready files until stop is set.
+
+        handle returns the ProcessResults of the names, or None if every
+        name is done with.
+        """
+        while not stop.is_set():
+            try:
+                ready = self.poll()
+            except ftplib.all_errors:
+                self.delay = min(self.delay * 2, self.max_interval)
+                try:
+                    self.ftp_client.reconnect()
+                except ftplib.all_errors:
+                    pass
+            else:
+                if ready:
+                    self.settle(handle(ready) or [])
+            stop.wait(self.next_delay())
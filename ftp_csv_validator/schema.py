@@ -0,0 +1,317 @@
+"""Declarative CSV layouts, compiled into specialized validators.
+
+A Schema lists the columns of a file in order, each with a type and its
+rules. It is compiled once into Python source specialized to the layout:
+a check_row with every rule unrolled and every bound inlined, and a scan
+loop that matches each line against a single regex for the whole row and
+only falls back to check_row, for the exact message, on a row the regex
+or the bounds reject. Messages are those of FileValidator, so a schema of
+the EXPECTED_HEADERS layout gives the same verdicts as the hand-written
+rules. A schema in a JSON file looks like
+
+    {"name": "med_sensor",
+     "columns": [{"name": "batch_id", "unique": true},
+                 {"name": "timestamp"},
+                 {"name": "reading1", "type": "decimal", "max": 9.9, "decimals": 3}]}
+
+Column types are "text" (not checked), "decimal" and "integer", with
+optional min, max and, for decimals, the most digits allowed after the
+point. Negative values are only accepted when min is below zero. At most
+one column is unique; it is the file's key, checked against the
+BatchIdIndex like batch_id. FileValidator.validate and StreamingValidator
+take a schema; the NumPy and sharded engines only know the built-in
+layout.
+"""
+import re
+import csv
+import math
+from collections import namedtuple
+
+from .config import EXPECTED_HEADERS
+
+Column = namedtuple("Column", "name type min max decimals unique", defaults=("text", None, None, None, False))
+
+TYPES = ("text", "decimal", "integer")
+
+
+class Schema:
+    """The columns of a CSV layout and the validator compiled from them."""
+
+    def __init__(self, columns, name="schema"):
+        self.columns = [self.checked(column if isinstance(column, Column) else Column(**column))
+                        for column in columns]
+        self.name = name
+        self.headers = [column.name for column in self.columns]
+        for column in self.columns:
+            if column.type not in TYPES:
+                raise ValueError(f"Unknown type of column {column.name}: {column.type}")
+            if column.type == "text" and (column.min, column.max, column.decimals) != (None, None, None):
+                raise ValueError(f"Text column {column.name} cannot have bounds or decimals")
+            if column.type == "integer" and column.decimals is not None:
+                raise ValueError(f"Integer column {column.name} cannot have decimals")
+            if column.min is not None and column.max is not None and column.min > column.max:
+                raise ValueError(f"Column {column.name} has min above max")
+        if len(set(self.headers)) != len(self.headers):
+            raise ValueError(f"Column names of schema {name} are not unique")
+        unique = [index for index, column in enumerate(self.columns) if column.unique]
+        if len(unique) > 1:
+            raise ValueError(f"Schema {name} has more than one unique column")
+        # Index of the key column, None without one
+        self.key = unique[0] if unique else None
+        self.compile()
+
+    @staticmethod
+    def checked(column):
+        """The column with its bounds as finite numbers, as JSON may give strings or Infinity."""
+        bounds = {}
+        for field in ("min", "max"):
+            value = getattr(column, field)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"The {field} of column {column.name} is not a number: {value!r}") from None
+            if not math.isfinite(value):
+                raise ValueError(f"The {field} of column {column.name} is not finite: {value!r}")
+            # Whole bounds read as integers in messages, like the 500 of "Value exceeds 500"
+            bounds[field] = int(value) if value.is_integer() and abs(value) < 2 ** 53 else value
+        decimals = column.decimals
+        if decimals is not None:
+            if isinstance(decimals, bool) or not isinstance(decimals, int) or decimals < 0:
+                raise ValueError(f"The decimals of column {column.name} is not a count of digits: {decimals!r}")
+        return column._replace(**bounds)
+
+    @classmethod
+    def load(cls, path):
+        """Read a schema from a JSON file."""
+        import json
+        with open(path) as f:
+            data = json.load(f)
+        return cls([Column(**column) for column in data["columns"]], data.get("name", path))
+
+    @classmethod
+    def default(cls):
+        """The EXPECTED_HEADERS layout, with the rules of FileValidator."""
+        batch_id, timestamp, *readings = EXPECTED_HEADERS
+        return cls([Column(batch_id, unique=True), Column(timestamp)]
+                   + [Column(name, "decimal", max=9.9, decimals=3) for name in readings], "default")
+
+    def __reduce__(self):
+        # Compiled functions do not pickle; process-pool workers recompile
+        return Schema, (self.columns, self.name)
+
+    @property
+    def fingerprint(self):
+        """Short hash of the columns, telling verdicts under other schemas apart."""
+        import json
+        import hashlib
+        return hashlib.sha256(json.dumps(self.columns).encode()).hexdigest()[:16]
+
+    def cache_digests(self, digests):
+        """Key VerdictCache entries by schema as well as content."""
+        return {name: f"{self.fingerprint}:{digest}" for name, digest in digests.items()}
+
+    def cell_pattern(self, column):
+        if column.type == "text":
+            # Quotes and NULs are left to the csv module
+            return '[^,"\\0]*'
+        sign = "-?" if column.min is not None and column.min < 0 else ""
+        if column.type == "integer" or column.decimals == 0:
+            fraction = ""
+        elif column.decimals is None:
+            fraction = r"(?:\.\d+)?"
+        else:
+            fraction = rf"(?:\.\d{{1,{column.decimals}}})?"
+        return rf"{sign}\d+{fraction}"
+
+    def compile(self):
+        """Generate check_row and scan for this layout."""
+        def escape(text):
+            return str(text).replace("{", "{{").replace("}", "}}")
+
+        namespace = {"reader": csv.reader, "limit": csv.field_size_limit(),
+                     "MISSING": "Row {} has missing columns"}
+        checked = [index for index, column in enumerate(self.columns) if column.type != "text"]
+        bounded = [index for index in checked
+                   if self.columns[index].min is not None or self.columns[index].max is not None]
+
+        row = ["def check_row(row, row_num, batch_ids, batch_index=None):",
+               f"    if len(row) != {len(self.columns)}:",
+               "        return MISSING.format(row_num)"]
+        key = []
+        if self.key is not None:
+            name = escape(self.columns[self.key].name)
+            namespace["DUPLICATE"] = f"Duplicate {name} {{}} on row {{}}"
+            namespace["EARLIER"] = f"Duplicate {name} {{}} on row {{}} (accepted in an earlier file)"
+            key = ["if key in batch_ids:",
+                   "    return DUPLICATE.format(key, row_num)",
+                   "if batch_index is not None and key in batch_index:",
+                   "    return EARLIER.format(key, row_num)",
+                   "batch_ids[key] = row_num"]
+            row.append(f"    key = row[{self.key}]")
+            row.extend(f"    {line}" for line in key)
+            # scan leaves batch_index to check_lines
+            del key[2:4]
+        for index in checked:
+            column = self.columns[index]
+            name = escape(column.name)
+            namespace[f"NON_NUMERIC_{index}"] = f"Non-numeric {name} on row {{}}: {{}}"
+            namespace[f"FORMAT_{index}"] = f"Invalid {column.type} format in {name} on row {{}}: {{}}"
+            # "$" rather than "\Z", like DECIMAL_PATTERN
+            namespace[f"PATTERN_{index}"] = re.compile(f"^{self.cell_pattern(column)}$").match
+            row += [f"    cell = row[{index}]",
+                    "    try:",
+                    "        value = float(cell)",
+                    "    except ValueError:",
+                    f"        return NON_NUMERIC_{index}.format(row_num, cell)"]
+            if column.max is not None:
+                namespace[f"EXCEEDS_{index}"] = f"Value exceeds {escape(column.max)} in {name} on row {{}}: {{}}"
+                row += [f"    if value > {float(column.max)!r}:",
+                        f"        return EXCEEDS_{index}.format(row_num, value)"]
+            if column.min is not None:
+                namespace[f"BELOW_{index}"] = f"Value below {escape(column.min)} in {name} on row {{}}: {{}}"
+                row += [f"    if value < {float(column.min)!r}:",
+                        f"        return BELOW_{index}.format(row_num, value)"]
+            row += [f"    if not PATTERN_{index}(cell):",
+                    f"        return FORMAT_{index}.format(row_num, cell)"]
+        row.append("    return None")
+
+        # Only the key and the bounded columns are captured
+        captured = [index for index in range(len(self.columns)) if index == self.key or index in bounded]
+        cells = [f"({self.cell_pattern(column)})" if index in captured else f"(?:{self.cell_pattern(column)})"
+                 for index, column in enumerate(self.columns)]
+        namespace["ROW"] = re.compile(",".join(cells) + r"\Z").match
+        bounds = []
+        for index in bounded:
+            column = self.columns[index]
+            if column.max is not None:
+                bounds.append(f"float(c{index}) > {float(column.max)!r}")
+            if column.min is not None:
+                bounds.append(f"float(c{index}) < {float(column.min)!r}")
+        scan = ["def scan(lines, row_num, batch_ids):",
+                "    for line in lines:",
+                "        row_num += 1",
+                "        match = ROW(line)",
+                "        if match is not None and len(line) <= limit:"]
+        fast = []
+        if captured:
+            fast.append(f"{''.join(f'c{index}, ' for index in captured)}= match.groups()")
+        if bounds:
+            fast.append(f"if not ({' or '.join(bounds)}):")
+            indent = "    "
+        else:
+            indent = ""
+        if self.key is not None:
+            fast += [indent + line.replace("key", f"c{self.key}").replace("return ", "return row_num, ")
+                     for line in key]
+        fast.append(indent + "continue")
+        scan.extend(f"            {line}" for line in fast)
+        scan += ["        error = check_row(next(reader([line]), []), row_num, batch_ids)",
+                 "        if error:",
+                 "            return row_num, error",
+                 "    return row_num, None"]
+
+        source = "\n".join(row + [""] + scan) + "\n"
+        exec(compile(source, f"<schema {self.name}>", "exec"), namespace)
+        self.source = source
+        self.check_row = namespace["check_row"]
+        self.scan = namespace["scan"]
+
+    def check_headers(self, headers):
+        if headers != self.headers:
+            return f"Incorrect or missing headers: {headers}"
+        return None
+
+    def check_lines(self, lines, row_num, batch_ids, batch_index=None):
+        """Check the lines that follow row row_num, 0 for the header line.
+
+        Returns (row_num, error): the number of the last row checked, and
+        the message of the first bad row or None. The keys of the rows are
+        checked against batch_index together, once the lines are done.
+        """
+        known = len(batch_ids)
+        row_num, error = self.check_rows(lines, row_num, batch_ids)
+        if len(batch_ids) > known:
+            from .validation import FileValidator
+            error = FileValidator.accepted_earlier(batch_ids, len(batch_ids) - known, batch_index,
+                                                   self.headers[self.key]) or error
+        return row_num, error
+
+    def check_rows(self, lines, row_num, batch_ids):
+        if any('"' in line for line in lines):
+            # A quoted field may hold commas or span lines
+            for row in csv.reader(lines):
+                row_num += 1
+                if row_num == 1:
+                    error = self.check_headers(row)
+                else:
+                    error = self.check_row(row, row_num, batch_ids)
+                if error:
+                    return row_num, error
+            return row_num, None
+        if row_num == 0 and lines:
+            error = self.check_headers(next(csv.reader(lines[:1])))
+            if error:
+                return 1, error
+            return self.scan(lines[1:], 1, batch_ids)
+        return self.scan(lines, row_num, batch_ids)
+
+    def check_cell(self, column, cell, row_num):
+        """Interpreted check of one cell, for diagnostics."""
+        if column.type == "text":
+            return None
+        try:
+            value = float(cell)
+        except ValueError:
+            return f"Non-numeric {column.name} on row {row_num}: {cell}"
+        if column.max is not None and value > column.max:
+            return f"Value exceeds {column.max} in {column.name} on row {row_num}: {value}"
+        if column.min is not None and value < column.min:
+            return f"Value below {column.min} in {column.name} on row {row_num}: {value}"
+        if not re.match(f"^{self.cell_pattern(column)}$", cell):
+            return f"Invalid {column.type} format in {column.name} on row {row_num}: {cell}"
+        return None
+
+    def row_violations(self, row, row_num, error):
+        """Every violation in a row that check_row rejected, like FileValidator.row_violations."""
+        from .validation import FileValidator
+        category = FileValidator.error_category(error)
+        if category == "missing_columns":
+            return [(None, error)]
+        violations = [(self.columns[self.key].name, error)] if category.startswith("duplicate") else []
+        for column, cell in zip(self.columns, row):
+            message = self.check_cell(column, cell, row_num)
+            if message:
+                violations.append((column.name, message))
+        return violations
+
+    def validate(self, file_content, batch_index=None, report=None):
+        """Return (valid, message) for the first error, like FileValidator.validate_rows."""
+        first_error = None
+        try:
+            lines = file_content.splitlines()
+            if report is None:
+                row_num, error = self.check_lines(lines, 0, {}, batch_index)
+                if row_num == 0:
+                    error = self.check_headers(None)
+                return (False, error) if error else (True, "Valid")
+            reader = csv.reader(lines)
+            error = self.check_headers(next(reader, None))
+            if error:
+                report.add(1, None, error)
+                return False, error
+            batch_ids = {}
+            for row_num, row in enumerate(reader, start=2):
+                error = self.check_row(row, row_num, batch_ids, batch_index)
+                if error:
+                    report.add_row(row, row_num, error, self)
+                    first_error = first_error or error
+        except Exception as e:
+            error = f"Malformed file error: {str(e)}"
+            if report is not None:
+                report.add(None, None, error)
+            return False, first_error or error
+        if first_error:
+            return False, first_error
+        return True, "Valid"
@@ -0,0 +1,127 @@
+"""Binary column sidecars written next to saved CSV files."""
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+from .config import EXPECTED_HEADERS, SIDECAR_EXTENSION
+
+
+class SidecarWriter:
+    """Collects the columns of a file as it is validated and writes them
+    as a binary sidecar, see Sidecar for the layout."""
+
+    def __init__(self):
+        self.readings = array("f")
+        self.batch_ids = bytearray()
+        self.batch_id_offsets = array("Q", [0])
+        self.timestamps = bytearray()
+        self.timestamp_offsets = array("Q", [0])
+
+    def add_row(self, batch_id, timestamp):
+        self.batch_ids += batch_id.encode()
+        self.batch_id_offsets.append(len(self.batch_ids))
+        self.timestamps += timestamp.encode()
+        self.timestamp_offsets.append(len(self.timestamps))
+
+    def write(self, csv_path):
+        """Write the sidecar for csv_path atomically; return its path."""
+        path = os.path.splitext(csv_path)[0] + SIDECAR_EXTENSION
+        sections = [self.readings, self.batch_id_offsets, self.batch_ids,
+                    self.timestamp_offsets, self.timestamps]
+        if sys.byteorder == "big":
+            sections = [Sidecar.little_endian(section) for section in sections]
+        offsets = []
+        position = Sidecar.HEADER.size
+        for section in sections:
+            position += -position % 8
+            offsets.append(position)
+            position += len(memoryview(section).cast("B"))
+        rows = len(self.batch_id_offsets) - 1
+        with open(path + ".tmp", "wb") as f:
+            f.write(Sidecar.HEADER.pack(Sidecar.MAGIC, Sidecar.VERSION, len(EXPECTED_HEADERS) - 2, rows, *offsets))
+            for offset, section in zip(offsets, sections):
+                f.write(b"\0" * (offset - f.tell()))
+                f.write(section)
+        os.replace(path + ".tmp", path)
+        return path
+
+
+class Sidecar:
+    """Memory-mapped reader of a binary sidecar.
+
+    Layout, little-endian: a header with magic, version, columns, rows and
+    the offset of each section; the readings as a rows x columns float32
+    array; then the batch_ids and the timestamps, each as rows + 1 uint64
+    end offsets followed by the UTF-8 bytes they index. Sections start on
+    8-byte boundaries so they can be viewed in place.
+    """
+
+    MAGIC = b"MEDB"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHQ5Q")
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.columns, self.rows, *offsets = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.map.close()
+            raise ValueError(f"Not a version {self.VERSION} sidecar: {path}")
+        readings, id_offsets, ids, timestamp_offsets, timestamps = offsets
+        view = memoryview(self.map)
+        count = self.rows * self.columns
+        self.readings = self.column(view, readings, "f", count)
+        self.batch_id_offsets = self.column(view, id_offsets, "Q", self.rows + 1)
+        self.batch_id_data = view[ids:ids + self.batch_id_offsets[-1]]
+        self.timestamp_offsets = self.column(view, timestamp_offsets, "Q", self.rows + 1)
+        self.timestamp_data = view[timestamps:timestamps + self.timestamp_offsets[-1]]
+
+    @staticmethod
+    def column(view, offset, typecode, count):
+        column = view[offset:offset + count * array(typecode).itemsize].cast(typecode)
+        if sys.byteorder == "big":
+            column = Sidecar.little_endian(column)
+        return column
+
+    @staticmethod
+    def little_endian(section):
+        # Swapping works on a copy, so only big-endian hosts pay for it
+        swapped = array(section.typecode if isinstance(section, array) else section.format, section)
+        swapped.byteswap()
+        return swapped
+
+    def __len__(self):
+        return self.rows
+
+    def reading(self, row, column):
+        return self.readings[row * self.columns + column]
+
+    def batch_id(self, row):
+        return bytes(self.batch_id_data[self.batch_id_offsets[row]:self.batch_id_offsets[row + 1]]).decode()
+
+    def timestamp(self, row):
+        return bytes(self.timestamp_data[self.timestamp_offsets[row]:self.timestamp_offsets[row + 1]]).decode()
+
+    def to_numpy(self):
+        """Return the readings as a rows x columns NumPy array, without copying.
+
+        The array views the mapped file, so drop it before calling close().
+        """
+        import numpy as np
+        return np.frombuffer(self.readings, dtype=np.float32).reshape(self.rows, self.columns)
+
+    def close(self):
+        for name in ("readings", "batch_id_offsets", "batch_id_data",
+                     "timestamp_offsets", "timestamp_data"):
+            value = getattr(self, name)
+            if isinstance(value, memoryview):
+                value.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
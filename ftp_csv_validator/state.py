@@ -0,0 +1,540 @@
+"""Persistent state across runs: processed files, accepted batch_ids and saved outputs."""
+import os
+import math
+import time
+import errno
+import atexit
+import shutil
+import zlib
+import struct
+import secrets
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from .config import (BATCH_INDEX_CAPACITY, BATCH_INDEX_FILE, BLOOM_ERROR_RATE, LEDGER_FILE,
+                     MEMORY_BATCH_INDEX_CAPACITY, OUTPUT_MANIFEST_FILE, OUTPUT_SHARD_FORMAT, VALID_DIR,
+                     VERDICT_CACHE_ENTRIES, VERDICT_CACHE_FILE)
+
+
+class ProcessedLedger:
+    """SQLite record of processed remote files and their outcome.
+
+    Keyed by remote path, size and modify time, so a file republished under
+    the same name with new content is fetched again. Only final outcomes
+    make a file count as processed; transient errors are retried. A modify
+    time is not always known (a file sized with SIZE rather than listed),
+    so a version recorded or looked up without one matches any record of
+    the same path and size.
+    """
+
+    FINAL_OUTCOMES = ("saved", "invalid", "bad_extension", "empty")
+
+    def __init__(self, path=LEDGER_FILE):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS processed ("
+                " path TEXT NOT NULL, size INTEGER NOT NULL, modify TEXT NOT NULL,"
+                " outcome TEXT NOT NULL, message TEXT, processed_at TEXT NOT NULL,"
+                " PRIMARY KEY (path, size, modify)) WITHOUT ROWID")
+
+    @staticmethod
+    def key(path, size, modify):
+        # Unknown size or time still has to be a comparable key value
+        return path, -1 if size is None else size, modify or ""
+
+    def lookup(self, path, size, modify):
+        """Return the latest (outcome, message) recorded for this file version, or None."""
+        path, size, modify = self.key(path, size, modify)
+        with self.lock:
+            return self.db.execute(
+                "SELECT outcome, message FROM processed WHERE path = ? AND size = ?"
+                " AND (modify = ? OR modify = '' OR ? = '') ORDER BY processed_at DESC LIMIT 1",
+                (path, size, modify, modify)).fetchone()
+
+    def is_processed(self, path, size, modify):
+        record = self.lookup(path, size, modify)
+        return record is not None and record[0] in self.FINAL_OUTCOMES
+
+    def record(self, path, size, modify, outcome, message):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?)",
+                self.key(path, size, modify) + (outcome, message, datetime.now().isoformat()))
+
+    def close(self):
+        self.db.close()
+
+
+class BloomFilter:
+    """Fixed-size set of strings with no false negatives and, once capacity
+    keys have been added, about error_rate false positives."""
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(1, capacity)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def hash_pair(key):
+        # Double hashing: k positions from the CRCs of the key and of its
+        # reverse, the cheapest hashes that are the same in every process
+        data = key.encode()
+        return zlib.crc32(data), zlib.crc32(data[::-1]) | 1
+
+    def add(self, key):
+        h1, h2 = self.hash_pair(key)
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.size
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        h1, h2 = self.hash_pair(key)
+        size, bits = self.size, self.bits
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def probes(self, np, keys):
+        """The k bit positions of every key, as k arrays."""
+        data = [key.encode() for key in keys]
+        h1 = np.fromiter(map(zlib.crc32, data), np.int64, len(data))
+        h2 = np.fromiter((zlib.crc32(item[::-1]) for item in data), np.int64, len(data)) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def filter(self, keys):
+        """Return the keys that may have been added, in order.
+
+        The bulk form of in: with NumPy the probes of many keys are done
+        as array operations, which leaves a CRC pair of Python per key.
+        """
+        np = self.numpy(keys)
+        if np is None:
+            return [key for key in keys if key in self]
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        found = np.ones(len(keys), dtype=bool)
+        for positions in self.probes(np, keys):
+            found &= (bits[positions >> 3] >> (positions & 7)) & 1 == 1
+        return [keys[index] for index in np.flatnonzero(found)]
+
+    def update(self, keys):
+        """Add every key of a sequence, the bulk form of add."""
+        np = self.numpy(keys)
+        if np is None:
+            for key in keys:
+                self.add(key)
+            return
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        for positions in self.probes(np, keys):
+            np.bitwise_or.at(bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+
+    @staticmethod
+    def numpy(keys):
+        # Below a few hundred keys the array setup costs more than it saves
+        if len(keys) < 256:
+            return None
+        try:
+            import numpy
+        except ImportError:
+            return None
+        return numpy
+
+
+class BatchIdIndex:
+    """Persistent set of the batch_ids of every accepted file.
+
+    The SQLite table is the source of truth and a Bloom filter in front of
+    it answers most lookups from memory, so only ids seen before (and about
+    1% of new ones) cost a query. Validators check the ids of a chunk of
+    rows at once with first_accepted rather than one by one. The filter is
+    saved next to the database on close and rebuilt from the table when
+    that copy is missing, stale or hashed another way, or twice as large
+    once it holds more ids than it was sized for.
+    """
+
+    SNAPSHOT_HEADER = struct.Struct("<qqqq")
+    # Bumped whenever BloomFilter.hash_pair changes
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self, path=BATCH_INDEX_FILE, capacity=None):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.snapshot = None if path == ":memory:" else os.path.abspath(path) + ".bloom"
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " file_id INTEGER PRIMARY KEY, source TEXT NOT NULL,"
+                " rows INTEGER NOT NULL, accepted_at TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS batch_ids ("
+                " batch_id TEXT PRIMARY KEY, file_id INTEGER NOT NULL) WITHOUT ROWID")
+        last_file, total = self.db.execute(
+            "SELECT COALESCE(MAX(file_id), 0), COALESCE(SUM(rows), 0) FROM files").fetchone()
+        if capacity is None:
+            capacity = MEMORY_BATCH_INDEX_CAPACITY if path == ":memory:" else BATCH_INDEX_CAPACITY
+        # Past capacity the error rate climbs, so leave room to grow
+        self.capacity = max(capacity, 2 * total)
+        self.bloom = BloomFilter(self.capacity)
+        self.count = total
+        # Ids this filter holds: those of every file up to last_file
+        self.last_file = last_file
+        if not self.load_snapshot():
+            self.rebuild()
+        self.closed = False
+        if self.snapshot:
+            atexit.register(self.close)
+
+    def load_snapshot(self):
+        if not self.snapshot:
+            return False
+        try:
+            with open(self.snapshot, "rb") as f:
+                header = f.read(self.SNAPSHOT_HEADER.size)
+                if len(header) != self.SNAPSHOT_HEADER.size or \
+                        self.SNAPSHOT_HEADER.unpack(header) != (self.SNAPSHOT_VERSION, self.last_file,
+                                                                self.bloom.size, self.bloom.hashes):
+                    return False
+                bits = f.read()
+        except OSError:
+            return False
+        if len(bits) != len(self.bloom.bits):
+            return False
+        self.bloom.bits = bytearray(bits)
+        return True
+
+    def rebuild(self):
+        cursor = self.db.execute("SELECT batch_id FROM batch_ids")
+        for rows in iter(lambda: cursor.fetchmany(100_000), []):
+            self.bloom.update([batch_id for (batch_id,) in rows])
+
+    def grow(self):
+        """Rebuild the filter with room for twice the ids it holds."""
+        self.capacity = 2 * self.count
+        self.bloom = BloomFilter(self.capacity)
+        self.last_file = self.db.execute("SELECT COALESCE(MAX(file_id), 0) FROM files").fetchone()[0]
+        self.rebuild()
+
+    def __contains__(self, batch_id):
+        if batch_id not in self.bloom:
+            return False
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM batch_ids WHERE batch_id = ?", (batch_id,)).fetchone() is not None
+
+    def commit(self, batch_ids, source):
+        """Add the batch_ids of an accepted file in one transaction.
+
+        Returns None, or one id that is already in the index, in which case
+        nothing is added. This is the atomic check: two files validated at
+        the same time cannot both get in with the same batch_id.
+        """
+        with self.lock:
+            try:
+                with self.db:
+                    file_id = self.db.execute(
+                        "INSERT INTO files (source, rows, accepted_at) VALUES (?, ?, ?)",
+                        (source, len(batch_ids), datetime.now().isoformat())).lastrowid
+                    self.db.executemany("INSERT INTO batch_ids VALUES (?, ?)",
+                                        ((batch_id, file_id) for batch_id in batch_ids))
+            except sqlite3.IntegrityError:
+                return self.find_accepted(list(batch_ids))
+            self.count += len(batch_ids)
+            if self.count > self.capacity:
+                self.grow()
+                return None
+            self.bloom.update(list(batch_ids))
+            if file_id == self.last_file + 1:
+                self.last_file = file_id
+        return None
+
+    def first_accepted(self, batch_ids, chunk=500):
+        """Return the first of batch_ids (a sequence) already in the index, or None.
+
+        The Bloom filter screens them all at once and those it cannot rule
+        out are looked up chunk ids per query.
+        """
+        candidates = self.bloom.filter(batch_ids)
+        if not candidates:
+            return None
+        accepted = set()
+        with self.lock:
+            for start in range(0, len(candidates), chunk):
+                ids = candidates[start:start + chunk]
+                accepted.update(batch_id for (batch_id,) in self.db.execute(
+                    f"SELECT batch_id FROM batch_ids WHERE batch_id IN ({','.join('?' * len(ids))})", ids))
+        return next((batch_id for batch_id in candidates if batch_id in accepted), None)
+
+    def find_accepted(self, batch_ids, chunk=500):
+        for start in range(0, len(batch_ids), chunk):
+            ids = batch_ids[start:start + chunk]
+            row = self.db.execute(
+                f"SELECT batch_id FROM batch_ids WHERE batch_id IN ({','.join('?' * len(ids))}) LIMIT 1",
+                ids).fetchone()
+            if row:
+                return row[0]
+        return None
+
+    def source(self, batch_id):
+        """Return the remote path of the file that batch_id was accepted from."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT source FROM batch_ids JOIN files USING (file_id) WHERE batch_id = ?",
+                (batch_id,)).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        with self.lock:
+            if self.snapshot:
+                try:
+                    with open(self.snapshot + ".tmp", "wb") as f:
+                        f.write(self.SNAPSHOT_HEADER.pack(self.SNAPSHOT_VERSION, self.last_file,
+                                                          self.bloom.size, self.bloom.hashes))
+                        f.write(self.bloom.bits)
+                    os.replace(self.snapshot + ".tmp", self.snapshot)
+                except OSError:
+                    pass  # Only costs a rebuild from the table on the next open
+            self.db.close()
+
+
+Verdict = namedtuple("Verdict", "valid message source")
+
+
+class VerdictCache:
+    """Persistent verdicts of validated content, keyed by its hash.
+
+    An entry is found by the SHA-256 or the MD5 of the file's bytes
+    together with its size, so a server's HASH or XMD5 reply can be looked
+    up before the transfer. source is the remote path of the file the
+    content was accepted from, if it was. Past capacity entries, the least
+    recently used are evicted.
+    """
+
+    DIGESTS = ("sha256", "md5")
+
+    def __init__(self, path=VERDICT_CACHE_FILE, capacity=VERDICT_CACHE_ENTRIES):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.capacity = capacity
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                " sha256 TEXT, md5 TEXT, size INTEGER NOT NULL, valid INTEGER NOT NULL,"
+                " message TEXT NOT NULL, source TEXT, used_at REAL NOT NULL)")
+            # Either digest may be unknown: a transfer stopped at the first
+            # bad row only has the one the server reported
+            for name in self.DIGESTS:
+                self.db.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS verdicts_{name}"
+                                f" ON verdicts ({name}) WHERE {name} IS NOT NULL")
+            self.db.execute("CREATE INDEX IF NOT EXISTS verdicts_used_at ON verdicts (used_at)")
+        self.count = self.db.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def find(self, digests, size):
+        for name in self.DIGESTS:
+            if digests.get(name):
+                row = self.db.execute(f"SELECT rowid, valid, message, source FROM verdicts"
+                                      f" WHERE {name} = ? AND size = ?", (digests[name], size)).fetchone()
+                if row:
+                    return row
+        return None
+
+    def lookup(self, digests, size):
+        """Return the Verdict for content with any of digests, or None."""
+        with self.lock, self.db:
+            row = self.find(digests, size)
+            if row is None:
+                return None
+            self.db.execute("UPDATE verdicts SET used_at = ? WHERE rowid = ?", (time.time(), row[0]))
+        return Verdict(bool(row[1]), row[2], row[3])
+
+    def record(self, digests, size, valid, message, source=None):
+        """Store a verdict under every digest in digests ({name: hex})."""
+        values = (digests.get("sha256"), digests.get("md5"), size, int(valid), message, source, time.time())
+        with self.lock, self.db:
+            row = self.find(digests, size)
+            if row is not None:
+                self.db.execute(
+                    "UPDATE OR REPLACE verdicts SET sha256 = COALESCE(?, sha256), md5 = COALESCE(?, md5),"
+                    " size = ?, valid = ?, message = ?, source = COALESCE(?, source), used_at = ?"
+                    " WHERE rowid = ?", values + (row[0],))
+                return
+            self.db.execute("INSERT INTO verdicts VALUES (?, ?, ?, ?, ?, ?, ?)", values)
+            self.count += 1
+            if self.count > self.capacity:
+                self.db.execute("DELETE FROM verdicts WHERE rowid IN"
+                                " (SELECT rowid FROM verdicts ORDER BY used_at LIMIT ?)",
+                                (self.count - self.capacity,))
+                self.count = self.capacity
+
+    def close(self):
+        self.db.close()
+
+
+Output = namedtuple("Output", "path source sha256 md5 size rows first_batch_id last_batch_id accepted_at")
+
+
+class OutputStore:
+    """The accepted files under root and an append-only manifest of them.
+
+    A file is published into a subdirectory per day of acceptance
+    (shard_format), so no directory grows without bound, under a name
+    made unique by its content hash, or a random token when the hash is
+    unknown. The name is claimed before the content is moved in, so
+    parallel workers never overwrite each other. The manifest maps each
+    file's path, relative to root, to the remote path it came from, the
+    size and digests of the remote content, its row count and its lowest
+    and highest batch_id, with an index on each. When every batch_id of a
+    file is an integer its range is ordered, and looked up, by number, so
+    "9" comes before "10". Entries are only ever inserted.
+    """
+
+    COLUMNS = "path, source, sha256, md5, size, rows, first_batch_id, last_batch_id, accepted_at"
+
+    def __init__(self, root=VALID_DIR, manifest=OUTPUT_MANIFEST_FILE, shard_format=OUTPUT_SHARD_FORMAT):
+        if manifest != ":memory:" and os.path.dirname(manifest):
+            os.makedirs(os.path.dirname(manifest), exist_ok=True)
+        # Both are resolved now, so the files and their manifest stay
+        # together whatever the working directory is later
+        self.root = os.path.abspath(root)
+        self.shard_format = shard_format
+        self.db = sqlite3.connect(manifest, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                " path TEXT PRIMARY KEY, source TEXT NOT NULL, sha256 TEXT, md5 TEXT, size INTEGER,"
+                " rows INTEGER NOT NULL, first_batch_id TEXT, last_batch_id TEXT, accepted_at TEXT NOT NULL,"
+                " first_number INTEGER, last_number INTEGER)")
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(outputs)")}
+            for column in ("first_number", "last_number"):
+                # Manifests from before numeric ranges; their rows keep text ones
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE outputs ADD COLUMN {column} INTEGER")
+            for column in ("source", "sha256", "md5", "rows", "first_batch_id", "last_batch_id",
+                           "first_number", "last_number"):
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS outputs_{column} ON outputs ({column})")
+            for action in ("UPDATE", "DELETE"):
+                self.db.execute(f"CREATE TRIGGER IF NOT EXISTS outputs_no_{action.lower()} BEFORE {action}"
+                                " ON outputs BEGIN SELECT RAISE(ABORT, 'the output manifest is append-only'); END")
+
+    def path(self, name):
+        """Where the file of a manifest path is on disk."""
+        return os.path.join(self.root, name)
+
+    def publish(self, spool, digest=None):
+        """Move a downloaded file into the store without rewriting its bytes.
+
+        digest is the hex SHA-256 of the content, if known. Returns the
+        file's path relative to root.
+        """
+        now = datetime.now()
+        shard = os.path.join(*now.strftime(self.shard_format).split("/"))
+        os.makedirs(self.path(shard), exist_ok=True)
+        stem = f"MED_DATA_{now.strftime('%Y%m%d%H%M%S')}_{digest[:16] if digest else secrets.token_hex(8)}"
+        name = os.path.join(shard, f"{stem}.csv")
+        suffix = 0
+        while True:
+            # The same content may be accepted twice within a second, so
+            # claim the name first; os.replace then swaps in the content
+            try:
+                open(self.path(name), 'xb').close()
+                break
+            except FileExistsError:
+                suffix += 1
+                name = os.path.join(shard, f"{stem}_{suffix}.csv")
+        target = self.path(name)
+        try:
+            os.replace(spool, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                os.remove(target)
+                raise
+            # PARTIAL_DIR is on another filesystem
+            shutil.copyfile(spool, target)
+            os.remove(spool)
+        return name
+
+    def discard(self, name):
+        """Remove a published file that did not make it into the manifest."""
+        os.remove(self.path(name))
+
+    def record(self, name, source, size, digests, rows, batch_ids):
+        """Add a published file to the manifest; digests is {name: hex} of the remote content."""
+        numbers = {self.number(batch_id): batch_id for batch_id in batch_ids}
+        if None in numbers or not numbers:
+            first, last = (min(batch_ids), max(batch_ids)) if batch_ids else (None, None)
+            first_number = last_number = None
+        else:
+            first_number, last_number = min(numbers), max(numbers)
+            first, last = numbers[first_number], numbers[last_number]
+        with self.lock, self.db:
+            self.db.execute(f"INSERT INTO outputs ({self.COLUMNS}, first_number, last_number)"
+                            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (name, source, digests.get("sha256"), digests.get("md5"), size, rows, first, last,
+                             datetime.now().isoformat(), first_number, last_number))
+
+    @staticmethod
+    def number(batch_id):
+        """The value of an integer batch_id that SQLite can hold, else None."""
+        try:
+            value = int(batch_id)
+        except ValueError:
+            return None
+        return value if str(value) == batch_id and -2 ** 63 <= value < 2 ** 63 else None
+
+    def find(self, source=None, digest=None, rows=None, batch_id=None):
+        """Return the Outputs matching every key given, newest first.
+
+        digest is a SHA-256 or MD5 hex digest. batch_id matches the files
+        whose batch_id range holds it, by number for the files of integer
+        ids; BatchIdIndex.source tells which one accepted it.
+        """
+        clauses, values = [], []
+        if source is not None:
+            clauses.append("source = ?")
+            values.append(source)
+        if digest is not None:
+            clauses.append("(sha256 = ? OR md5 = ?)")
+            values += [digest, digest]
+        if rows is not None:
+            clauses.append("rows = ?")
+            values.append(rows)
+        if batch_id is not None:
+            # Text ranges may hold integers too, but numeric ones nothing else
+            clause = "first_number IS NULL AND first_batch_id <= ? AND last_batch_id >= ?"
+            values += [batch_id, batch_id]
+            number = self.number(batch_id)
+            if number is not None:
+                clause = f"{clause} OR first_number <= ? AND last_number >= ?"
+                values += [number, number]
+            clauses.append(f"({clause})")
+        where = " AND ".join(clauses) or "1"
+        with self.lock:
+            return [Output(*row) for row in self.db.execute(
+                f"SELECT {self.COLUMNS} FROM outputs WHERE {where} ORDER BY rowid DESC", values)]
+
+    def close(self):
+        self.db.close()
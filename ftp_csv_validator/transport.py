@@ -0,0 +1,691 @@
+"""FTP sessions, directory listings and resumable, validated downloads."""
+import os
+import json
+import mmap
+import time
+import queue
+import bisect
+import ftplib
+import fnmatch
+import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from .config import (CHECKPOINT_BYTES, DOWNLOAD_RETRIES, LIST_DOS_PATTERN, LIST_UNIX_PATTERN, LISTING_TTL, MODE_Z,
+                     PARTIAL_DIR, RETRY_DELAY)
+from .metrics import METRICS
+from .state import BatchIdIndex, OutputStore, ProcessedLedger, VerdictCache
+from .validation import Decompressor, StreamingValidator
+
+# Errors after which a transfer is resumed instead of failed
+TRANSIENT_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_reply)
+
+
+class TransferAborted(Exception):
+    """Raised from a retrbinary callback to stop a transfer early."""
+
+
+class TransferCancelled(TransferAborted):
+    """Raised from a progress callback when the user cancels a transfer."""
+
+
+class TransferSizeMismatch(Exception):
+    """Raised when a finished transfer does not match the remote file size."""
+
+
+class PartialWriteError(Exception):
+    """Raised when received bytes cannot be saved to their part file.
+
+    Not one of TRANSIENT_ERRORS: a full or failing disk is not cured by
+    reconnecting, and the part file may hold bytes past its offset.
+    """
+
+
+class PartialDownload:
+    """Part file and checkpoint of a transfer, kept until it completes.
+
+    Received bytes are appended to <key>.part; <key>.json records which
+    remote file version they belong to and the offset up to which they
+    were fsynced. A later attempt at the same path and size resumes from
+    that offset if the modify times agree, or either is unknown; anything
+    else starts from scratch.
+    """
+
+    def __init__(self, path, size, modify, directory=PARTIAL_DIR):
+        # Not keyed by modify, which one attempt may know and the next not
+        key = hashlib.sha1(f"{path}\0{size}".encode()).hexdigest()
+        self.part_file = os.path.join(directory, key + ".part")
+        self.checkpoint_file = os.path.join(directory, key + ".json")
+        self.source = {"path": path, "size": size, "modify": modify}
+        self.file = None
+        self.offset = 0
+        self.synced = 0
+
+    def open(self):
+        """Open the part file, truncated to the last checkpoint; return its offset."""
+        os.makedirs(os.path.dirname(self.part_file), exist_ok=True)
+        offset = 0
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            if self.same_version(checkpoint.get("source") or {}):
+                offset = min(checkpoint["offset"], os.path.getsize(self.part_file))
+        except (OSError, ValueError, KeyError):
+            pass
+        self.file = open(self.part_file, "r+b" if offset else "w+b")
+        self.file.truncate(offset)
+        self.file.seek(offset)
+        self.offset = self.synced = offset
+        return offset
+
+    def same_version(self, source):
+        """Whether a checkpoint's source is this file, allowing an unknown modify time."""
+        if (source.get("path"), source.get("size")) != (self.source["path"], self.source["size"]):
+            return False
+        modify = source.get("modify")
+        return modify == self.source["modify"] or None in (modify, self.source["modify"])
+
+    def chunks(self, blocksize=1 << 20):
+        """Yield the bytes received so far, for replaying into a validator."""
+        if not self.offset:
+            return
+        self.file.flush()
+        with mmap.mmap(self.file.fileno(), self.offset, access=mmap.ACCESS_READ) as view:
+            for start in range(0, self.offset, blocksize):
+                yield view[start:start + blocksize]
+
+    def write(self, data):
+        with METRICS.stage("disk_write"):
+            self.file.write(data)
+        self.offset += len(data)
+        if self.offset - self.synced >= CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def checkpoint(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        with open(self.checkpoint_file + ".tmp", "w") as f:
+            json.dump({"source": self.source, "offset": self.offset}, f)
+        os.replace(self.checkpoint_file + ".tmp", self.checkpoint_file)
+        self.synced = self.offset
+
+    def finish(self):
+        """Close a complete download and return the path of its part file."""
+        self.file.close()
+        self.file = None
+        try:
+            os.remove(self.checkpoint_file)
+        except FileNotFoundError:
+            pass
+        return self.part_file
+
+    def close(self):
+        """Checkpoint and close, keeping the part file for a later resume."""
+        if self.file is not None:
+            self.checkpoint()
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for name in (self.part_file, self.checkpoint_file):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+RemoteEntry = namedtuple("RemoteEntry", "name size modify")
+
+
+class RemoteIndex:
+    """Cached listing of a remote directory: name, size and modify time.
+
+    Built from MLSD, or from LIST on servers without it, and trusted for
+    ttl seconds. Lookups and searches never touch the network; refresh
+    does, through whichever FTPClient is passed in, so one index can be
+    shared by several sessions. modify is a "YYYYMMDDHHMMSS" string, or
+    None when the server does not report it.
+    """
+
+    def __init__(self, ttl=LISTING_TTL):
+        self.ttl = ttl
+        self.entries = {}
+        self.names = []
+        self.sorted_names = []
+        self.loaded_at = None
+
+    def refresh(self, ftp_client):
+        entries = ftp_client.list_entries()
+        self.entries = {entry.name: entry for entry in entries}
+        self.names = [entry.name for entry in entries]
+        self.sorted_names = sorted(self.names)
+        self.loaded_at = time.monotonic()
+        return self.names
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def lookup(self, name):
+        """Return the RemoteEntry for name if the listing is fresh, else None."""
+        if self.is_stale():
+            return None
+        return self.entries.get(name)
+
+    def search(self, keyword, mode="substring"):
+        if mode == "glob":
+            return fnmatch.filter(self.names, keyword)
+        if mode == "prefix":
+            names = self.sorted_names
+            start = bisect.bisect_left(names, keyword)
+            end = bisect.bisect_left(names, keyword + "\U0010ffff", start)
+            return names[start:end]
+        return [name for name in self.names if keyword in name]
+
+    @staticmethod
+    def parse_list_line(line, now=None):
+        """Parse a Unix- or DOS-style LIST line; None for directories and noise."""
+        match = LIST_UNIX_PATTERN.match(line)
+        if match:
+            kind, size, stamp, name = match.groups()
+            if kind == "d":
+                return None
+            if kind == "l":
+                name, size = name.split(" -> ")[0], None
+            now = now or datetime.now()
+            try:
+                if ":" in stamp:
+                    # Recent entries omit the year; a date ahead of today is last year's
+                    modify = datetime.strptime(f"{stamp} {now.year}", "%b %d %H:%M %Y")
+                    if modify > now + timedelta(days=1):
+                        modify = datetime.strptime(f"{stamp} {now.year - 1}", "%b %d %H:%M %Y")
+                else:
+                    modify = datetime.strptime(stamp, "%b %d %Y")
+                modify = modify.strftime("%Y%m%d%H%M%S")
+            except ValueError:
+                modify = None
+            return RemoteEntry(name, None if size is None else int(size), modify)
+        match = LIST_DOS_PATTERN.match(line)
+        if match:
+            day, clock, size, name = match.groups()
+            if size == "<DIR>":
+                return None
+            date_format = "%m-%d-%Y" if len(day) == 10 else "%m-%d-%y"
+            modify = datetime.strptime(f"{day} {clock}", f"{date_format} %I:%M%p")
+            return RemoteEntry(name, int(size), modify.strftime("%Y%m%d%H%M%S"))
+        return None
+
+
+class FTPClient:
+    def __init__(self, ledger=None, batch_index=None, verdicts=None, outputs=None):
+        self.ftp = None
+        self.credentials = None
+        self.directory = None
+        self.ledger = ledger or ProcessedLedger(":memory:")
+        self.batch_index = BatchIdIndex(":memory:") if batch_index is None else batch_index
+        self.verdicts = VerdictCache(":memory:") if verdicts is None else verdicts
+        # Files are published under VALID_DIR, so they are recorded in its
+        # persistent manifest too, never in one that dies with the session
+        self.outputs = OutputStore() if outputs is None else outputs
+        self.index = RemoteIndex()
+        self.mode_z = MODE_Z
+        # Session state: the FEAT reply, fetched once, the transfer mode and
+        # whether HASH has been switched to SHA-256
+        self.features = None
+        self.mode = "S"
+        self.hash_sha256 = False
+
+    def connect(self, host, user, password, port=21):
+        self.ftp = ftplib.FTP()
+        self.features = None
+        self.mode = "S"
+        self.hash_sha256 = False
+        with METRICS.stage("connect"):
+            self.ftp.connect(host, port)
+            self.ftp.login(user, password)
+        self.credentials = (host, user, password, port)
+
+    def reconnect(self):
+        try:
+            self.ftp.close()
+        except Exception:
+            pass
+        self.connect(*self.credentials)
+        if self.directory:
+            self.ftp.cwd(self.directory)
+
+    def cwd(self, directory):
+        self.ftp.cwd(directory)
+        self.directory = self.ftp.pwd()
+
+    def remote_path(self, filename):
+        """Identify filename across sessions, for the processed-file ledger."""
+        host, user, password, port = self.credentials
+        directory = (self.directory or "").rstrip("/")
+        return f"ftp://{user}@{host}:{port}{directory}/{filename}"
+
+    def list_entries(self):
+        """List the working directory's files as RemoteEntry tuples."""
+        with METRICS.stage("list"):
+            try:
+                return [RemoteEntry(name, int(facts["size"]) if "size" in facts else None,
+                                    facts.get("modify", "")[:14] or None)
+                        for name, facts in self.ftp.mlsd(facts=["type", "size", "modify"])
+                        if facts.get("type", "file") == "file"]
+            except ftplib.error_perm:
+                # No MLSD on this server
+                lines = []
+                self.ftp.retrlines('LIST', lines.append)
+                entries = (RemoteIndex.parse_list_line(line) for line in lines)
+                return [entry for entry in entries if entry]
+
+    def list_files(self):
+        """Refresh the directory index and return the file names."""
+        return self.index.refresh(self)
+
+    def size(self, filename):
+        entry = self.index.lookup(filename)
+        if entry and entry.size is not None:
+            return entry.size
+        # Listings switch the session to ASCII, where many servers refuse SIZE
+        with METRICS.stage("size"):
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size(filename)
+
+    def search_files(self, keyword, mode="substring"):
+        """Search the cached listing by substring, glob or prefix."""
+        if self.index.is_stale():
+            self.index.refresh(self)
+        return self.index.search(keyword, mode)
+
+    def download_validated(self, filename, validator=None, progress=None, size=None, retries=DOWNLOAD_RETRIES,
+                           digest=None, modify=None):
+        """Download and validate in one pass, aborting on the first bad row.
+
+        Returns (valid, message, spool) where spool is the path of the part
+        file holding an accepted file, to be moved into place by the caller,
+        and None for a rejected one. progress, if given, is
+        called with the number of bytes received after every chunk and may
+        raise TransferCancelled to stop the transfer.
+
+        Received bytes are checkpointed to a PartialDownload. A dropped
+        connection is retried up to retries times, reconnecting and resuming
+        with REST; a transfer that still fails or is cancelled resumes from
+        its part file the next time this file version is downloaded.
+        Plain files are sent deflated in MODE Z when the server offers it;
+        the part file always holds the bytes of the remote file, and so
+        does digest, a ContentDigest, if given. size and modify default
+        to the cached listing's.
+        """
+        validator = validator or StreamingValidator(compression=Decompressor.codec_for(filename))
+        if size is None:
+            size = self.size(filename)
+        if modify is None:
+            entry = self.index.lookup(filename)
+            modify = entry.modify if entry else None
+        partial = PartialDownload(self.remote_path(filename), size, modify)
+        resumed = partial.open() > 0 and self.supports_rest()
+        if not resumed:
+            partial.discard()
+            partial.open()
+
+        def handle_binary(data):
+            # Saved before it is fed, so the validator never sees bytes
+            # that a resume would send again
+            try:
+                partial.write(data)
+            except OSError as e:
+                raise PartialWriteError(f"Cannot save '{filename}' to {partial.part_file}: {e}") from e
+            if not validator.feed(data):
+                raise TransferAborted(validator.message)
+            if digest is not None:
+                with METRICS.stage("hash"):
+                    digest.update(data)
+            if progress:
+                progress(validator.bytes_received)
+
+        # A file that is compressed already gains nothing from MODE Z
+        deflate = self.mode_z and validator.decompressor is None and self.supports("MODE Z")
+
+        def receive(data):
+            METRICS.add("bytes_received", len(data))
+            if inflater is not None:
+                data = inflater.decompress(data)
+            if data:
+                handle_binary(data)
+
+        try:
+            # What an earlier attempt received has to be validated too
+            for chunk in partial.chunks():
+                if not validator.feed(chunk):
+                    partial.discard()
+                    return False, validator.message, None
+                if digest is not None:
+                    digest.update(chunk)
+            attempt = 0
+            while True:
+                try:
+                    # Resumes are sent uncompressed: servers disagree on
+                    # what a REST offset means under MODE Z
+                    inflater = Decompressor("zlib") if deflate and not partial.offset else None
+                    self.set_mode("S" if inflater is None else "Z")
+                    # Includes the decode, validate and disk_write stages
+                    # run from the callback
+                    with METRICS.stage("retr"):
+                        self.ftp.retrbinary(f'RETR {filename}', callback=receive,
+                                            rest=partial.offset or None)
+                        if inflater is not None:
+                            inflater.finish()
+                    break
+                except TRANSIENT_ERRORS:
+                    if attempt >= retries:
+                        raise
+                    time.sleep(RETRY_DELAY * 2 ** attempt)
+                    attempt += 1
+                    self.reconnect()
+                    if partial.offset and not self.supports_rest():
+                        raise
+                    resumed = resumed or partial.offset > 0
+            if resumed:
+                # The part file may span two uploads of the remote file
+                self.ftp.voidcmd('TYPE I')
+                size = self.ftp.size(filename)
+            if partial.offset != size:
+                raise TransferSizeMismatch(
+                    f"Received {partial.offset} bytes of '{filename}', expected {size}")
+        except TransferAborted as e:
+            self.abort_transfer()
+            if isinstance(e, TransferCancelled):
+                partial.close()
+                raise
+            partial.discard()
+            return False, validator.message, None
+        except TRANSIENT_ERRORS:
+            partial.close()
+            raise
+        except Exception:
+            partial.discard()
+            raise
+        finally:
+            if self.mode != "S":
+                try:
+                    self.set_mode("S")
+                except ftplib.all_errors:
+                    pass
+        valid, msg = validator.close()
+        if not valid:
+            partial.discard()
+            return valid, msg, None
+        return valid, msg, partial.finish()
+
+    def supports_rest(self):
+        return self.supports("REST STREAM")
+
+    def supports(self, feature):
+        """Whether the server lists feature in its FEAT reply."""
+        if self.features is None:
+            try:
+                self.features = {line.strip().upper() for line in self.ftp.sendcmd('FEAT').splitlines()[1:-1]}
+            except ftplib.all_errors:
+                self.features = set()
+        return feature in self.features
+
+    def feature(self, name):
+        """Return the parameters of command name in the FEAT reply, or None."""
+        self.supports(name)
+        for line in self.features:
+            command, _, parameters = line.partition(" ")
+            if command == name:
+                return parameters
+        return None
+
+    def remote_digests(self, filename):
+        """Ask the server for the SHA-256 (HASH) or MD5 (XMD5) of a file.
+
+        Returns {"sha256": hex} or {"md5": hex}, or {} when the server
+        offers neither or fails. XCRC is not used: a CRC-32 is too weak to
+        stand in for the content.
+        """
+        try:
+            algorithms = self.feature("HASH")
+            if algorithms is not None and "SHA-256" in algorithms:
+                if not self.hash_sha256 and "SHA-256*" not in algorithms:
+                    self.ftp.voidcmd('OPTS HASH SHA-256')
+                self.hash_sha256 = True
+                # 213 SHA-256 0-49 <hex> <name>
+                name, length, reply = "sha256", 64, self.ftp.sendcmd(f'HASH {filename}')
+            elif self.supports("XMD5"):
+                # 250 <hex>, with or without the algorithm or name around it
+                name, length, reply = "md5", 32, self.ftp.sendcmd(f'XMD5 {filename}')
+            else:
+                return {}
+        except ftplib.all_errors:
+            return {}
+        for token in reply.split()[1:]:
+            if len(token) == length and all(c in "0123456789abcdefABCDEF" for c in token):
+                return {name: token.lower()}
+        return {}
+
+    def set_mode(self, mode):
+        if self.mode != mode:
+            self.ftp.voidcmd(f'MODE {mode}')
+            self.mode = mode
+
+    def abort_transfer(self):
+        """Send ABOR and resynchronise the control channel after an early stop."""
+        try:
+            # Depending on timing the server answers the dropped data
+            # connection and the ABOR separately, so drain every reply up
+            # to our own NOOP before issuing the next command.
+            try:
+                self.ftp.abort()
+            except ftplib.error_proto:
+                pass
+            self.ftp.putcmd('NOOP')
+            while not self.ftp.getmultiline().startswith('200'):
+                pass
+        except ftplib.all_errors:
+            self.reconnect()
+
+    def is_connected(self):
+        return self.ftp is not None
+
+
+class FTPConnectionPool:
+    """A bounded set of logged-in FTPClient sessions shared by worker threads.
+
+    Sessions are opened on demand up to size. One that has been idle for
+    longer than idle_check seconds, or whose last transfer failed, is
+    probed with NOOP before being handed out and reconnected if the probe
+    fails. All sessions share one ProcessedLedger, BatchIdIndex, VerdictCache,
+    OutputStore and RemoteIndex.
+    """
+
+    def __init__(self, host, user, password, port=21, size=4, directory=None, idle_check=30.0,
+                 ledger=None, batch_index=None, verdicts=None, outputs=None):
+        self.credentials = (host, user, password, port)
+        self.size = size
+        self.directory = directory
+        self.idle_check = idle_check
+        self.ledger = ledger or ProcessedLedger(":memory:")
+        self.batch_index = BatchIdIndex(":memory:") if batch_index is None else batch_index
+        self.verdicts = VerdictCache(":memory:") if verdicts is None else verdicts
+        self.outputs = OutputStore() if outputs is None else outputs
+        self.index = RemoteIndex()
+        # LIFO so a lightly loaded pool keeps reusing its warmest session
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def acquire(self):
+        try:
+            client, released, healthy = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_open = self.opened < self.size
+                if can_open:
+                    self.opened += 1
+            if can_open:
+                return self.open()
+            client, released, healthy = self.idle.get()
+        if not healthy or time.monotonic() - released > self.idle_check:
+            self.check(client)
+        return client
+
+    def release(self, client, healthy=True):
+        self.idle.put((client, time.monotonic(), healthy))
+
+    def open(self):
+        try:
+            return self.new_client()
+        except Exception:
+            self.discard()
+            raise
+
+    def new_client(self):
+        """Connect a session sharing the pool's state but not counted in it."""
+        client = FTPClient(ledger=self.ledger, batch_index=self.batch_index, verdicts=self.verdicts,
+                           outputs=self.outputs)
+        client.index = self.index
+        client.connect(*self.credentials)
+        if self.directory:
+            client.cwd(self.directory)
+        return client
+
+    def check(self, client):
+        try:
+            client.ftp.voidcmd('NOOP')
+        except ftplib.all_errors:
+            try:
+                client.reconnect()
+            except Exception:
+                self.discard()
+                raise
+
+    def discard(self):
+        with self.lock:
+            self.opened -= 1
+
+    def close(self):
+        while True:
+            try:
+                client = self.idle.get_nowait()[0]
+            except queue.Empty:
+                return
+            try:
+                client.ftp.quit()
+            except Exception:
+                client.ftp.close()
+            self.discard()
+
+
+# schema is the path of a Schema JSON file for the server's files
+Endpoint = namedtuple("Endpoint", "name host port user password directory workers schema",
+                      defaults=(21, "anonymous", "", None, None, None))
+
+
+class MultiServerPool:
+    """One FTPConnectionPool per server, all sharing one state.
+
+    Each Endpoint gets its own credentials, directory and session limit
+    (workers, default_workers if unset), while the ProcessedLedger,
+    BatchIdIndex, VerdictCache and OutputStore are shared, so a batch_id
+    accepted from one server is a duplicate on every other. Files are
+    named by (source, name) pairs, source being the endpoint's name.
+    """
+
+    def __init__(self, endpoints, default_workers=1, idle_check=30.0, ledger=None, batch_index=None,
+                 verdicts=None, outputs=None):
+        self.ledger = ledger or ProcessedLedger(":memory:")
+        self.batch_index = BatchIdIndex(":memory:") if batch_index is None else batch_index
+        self.verdicts = VerdictCache(":memory:") if verdicts is None else verdicts
+        self.outputs = OutputStore() if outputs is None else outputs
+        self.endpoints = {endpoint.name: endpoint for endpoint in endpoints}
+        self.pools = {
+            endpoint.name: FTPConnectionPool(endpoint.host, endpoint.user, endpoint.password, port=endpoint.port,
+                                             size=endpoint.workers or default_workers,
+                                             directory=endpoint.directory, idle_check=idle_check,
+                                             ledger=self.ledger, batch_index=self.batch_index,
+                                             verdicts=self.verdicts, outputs=self.outputs)
+            for endpoint in endpoints}
+        # Why the last listing of a server failed, by source
+        self.errors = {}
+
+    @staticmethod
+    def read_endpoints(path):
+        """Read a JSON list of endpoints, e.g.
+
+            [{"name": "north", "host": "ftp.north.example", "user": "collector",
+              "password_env": "NORTH_PASS", "directory": "/outgoing", "workers": 2,
+              "schema": "schemas/north.json"}]
+
+        name defaults to the host and must be unique; password_env names
+        an environment variable holding the password.
+        """
+        with open(path) as f:
+            items = json.load(f)
+        endpoints = []
+        for item in items:
+            if "host" not in item:
+                raise ValueError(f"Endpoint without a host in {path}: {item}")
+            item = dict(item)
+            if "password_env" in item:
+                item["password"] = os.environ.get(item.pop("password_env"), "")
+            item.setdefault("name", item["host"])
+            unknown = set(item) - set(Endpoint._fields)
+            if unknown:
+                raise ValueError(f"Unknown endpoint settings in {path}: {', '.join(sorted(unknown))}")
+            endpoints.append(Endpoint(**item))
+        names = [endpoint.name for endpoint in endpoints]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Endpoint names in {path} are not unique")
+        return endpoints
+
+    @property
+    def sources(self):
+        return list(self.pools)
+
+    def list_source(self, source):
+        """List one server's directory, recording why it failed in errors."""
+        pool = self.pools[source]
+        try:
+            client = pool.acquire()
+            try:
+                names = client.list_files()
+            except Exception:
+                pool.release(client, healthy=False)
+                raise
+            pool.release(client)
+        except Exception as e:
+            self.errors[source] = e
+            raise
+        self.errors.pop(source, None)
+        return names
+
+    def list_files(self):
+        """List every server at once; return the merged (source, name) pairs.
+
+        A server that cannot be listed is left out and its error kept in
+        errors.
+        """
+        def listing(source):
+            try:
+                return self.list_source(source)
+            except Exception:
+                return []
+
+        with ThreadPoolExecutor(max_workers=max(len(self.pools), 1)) as executor:
+            listings = executor.map(listing, self.pools)
+            return [(source, name) for source, names in zip(self.pools, listings) for name in names]
+
+    def search(self, keyword, mode="substring"):
+        """Search the cached listings of every server, as (source, name) pairs."""
+        return [(source, name) for source, pool in self.pools.items() for name in pool.index.search(keyword, mode)]
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
@@ -0,0 +1,810 @@
+"""Validation of CSV files against EXPECTED_HEADERS and the reading rules.
+
+Only the standard library is needed here, and what is not needed to
+validate (json, datetime, hashlib, concurrent.futures, NumPy, zstandard) is
+imported on first use, so process-pool workers and short scripts load
+this module in a few milliseconds.
+"""
+import os
+import csv
+import mmap
+import zlib
+import codecs
+from itertools import islice
+
+from .config import (BATCH_INDEX_CHECK_ROWS, COLUMNAR_BLOCK_ROWS, CSV_EXTENSIONS, DECIMAL_PATTERN, DIAGNOSTICS_LIMIT, ERROR_LOG_DIR,
+                     EXPECTED_HEADERS, IRREGULAR_LINES, SHARD_BLOCK_BYTES, SHARD_MIN_BYTES)
+from .metrics import METRICS
+
+
+class FileValidator:
+    # Message prefix of each kind of violation, most specific first
+    CATEGORIES = (
+        ("Incorrect or missing headers", "header"),
+        ("Duplicate batch_id", "duplicate_batch_id"),
+        ("Duplicate ", "duplicate_key"),
+        ("Value exceeds", "out_of_range"),
+        ("Value below", "out_of_range"),
+        ("Invalid decimal format", "bad_decimal"),
+        ("Invalid integer format", "bad_integer"),
+        ("Non-numeric", "non_numeric"),
+        ("Malformed file error", "malformed"),
+    )
+
+    @staticmethod
+    def error_category(message):
+        """Classify a validation message, e.g. for counting rejections."""
+        if message.endswith("(accepted in an earlier file)"):
+            return "duplicate_earlier_file"
+        if message.startswith("Row ") and message.endswith("has missing columns"):
+            return "missing_columns"
+        for prefix, category in FileValidator.CATEGORIES:
+            if message.startswith(prefix):
+                return category
+        return "other"
+
+    @staticmethod
+    def check_headers(headers):
+        if headers != EXPECTED_HEADERS:
+            return f"Incorrect or missing headers: {headers}"
+        return None
+
+    @staticmethod
+    def check_row(row, row_num, batch_ids, batch_index=None, readings=None):
+        """Return the error message for a data row, or None if it is valid.
+
+        batch_ids maps the batch_ids of the rows so far to their row, in
+        order; batch_index, if given, holds the batch_ids of earlier
+        accepted files. Validators that stop at the first error leave it
+        out and check a run of rows at once with accepted_earlier.
+        readings, if given, is extended with the parsed reading values.
+        """
+        if len(row) != 12:
+            return f"Row {row_num} has missing columns"
+        batch_id = row[0]
+        if batch_id in batch_ids:
+            return f"Duplicate batch_id {batch_id} on row {row_num}"
+        if batch_index is not None and batch_id in batch_index:
+            return f"Duplicate batch_id {batch_id} on row {row_num} (accepted in an earlier file)"
+        batch_ids[batch_id] = row_num
+        # check_reading inlined, as this runs for every cell
+        for i, reading in enumerate(row[2:], start=1):
+            try:
+                value = float(reading)
+                if value > 9.9:
+                    return f"Value exceeds 9.9 in reading{i} on row {row_num}: {value}"
+                if not DECIMAL_PATTERN.match(reading):
+                    return f"Invalid decimal format in reading{i} on row {row_num}: {reading}"
+                if readings is not None:
+                    readings.append(value)
+            except ValueError:
+                return f"Non-numeric reading{i} on row {row_num}: {reading}"
+        return None
+
+    @staticmethod
+    def accepted_earlier(batch_ids, added, batch_index, name="batch_id"):
+        """Return the error message for the first of the last added ids of
+        batch_ids that batch_index holds, or None.
+
+        Those rows passed check_row without batch_index, so the error is on
+        an earlier row than any check_row found after them.
+        """
+        if batch_index is None or not added:
+            return None
+        ids = list(islice(reversed(batch_ids), added))
+        ids.reverse()
+        batch_id = batch_index.first_accepted(ids)
+        if batch_id is None:
+            return None
+        return f"Duplicate {name} {batch_id} on row {batch_ids[batch_id]} (accepted in an earlier file)"
+
+    @staticmethod
+    def check_reading(reading, i, row_num):
+        try:
+            value = float(reading)
+        except ValueError:
+            return f"Non-numeric reading{i} on row {row_num}: {reading}"
+        if value > 9.9:
+            return f"Value exceeds 9.9 in reading{i} on row {row_num}: {value}"
+        if not DECIMAL_PATTERN.match(reading):
+            return f"Invalid decimal format in reading{i} on row {row_num}: {reading}"
+        return None
+
+    @staticmethod
+    def row_violations(row, row_num, error):
+        """Every violation in a row that check_row rejected with error.
+
+        Returns (column, message) pairs; column is None when the row does
+        not have the expected columns at all.
+        """
+        category = FileValidator.error_category(error)
+        if category == "missing_columns":
+            return [(None, error)]
+        violations = [("batch_id", error)] if category.startswith("duplicate") else []
+        for i, reading in enumerate(row[2:], start=1):
+            message = FileValidator.check_reading(reading, i, row_num)
+            if message:
+                violations.append((f"reading{i}", message))
+        return violations
+
+    @staticmethod
+    def validate(file_content, engine="python", batch_index=None, report=None, cache=None, schema=None):
+        """Return (valid, message) for the first error.
+
+        With a ValidationReport the whole file is checked and every
+        violation is added to the report; this always uses the Python engine.
+        With a VerdictCache, content seen before is answered from the cache,
+        except that content it accepted is checked again against batch_index.
+        A Schema replaces the EXPECTED_HEADERS layout and its rules, and
+        the engine with its compiled validator.
+        """
+        with METRICS.stage("validate"):
+            if cache is None or report is not None:
+                return FileValidator.validate_content(file_content, engine, batch_index, report, schema)
+            data = file_content.encode()
+            digest = ContentDigest()
+            digest.update(data)
+            digests = digest.hexdigests()
+            if schema is not None:
+                digests = schema.cache_digests(digests)
+            verdict = cache.lookup(digests, len(data))
+            if verdict is not None and not (verdict.valid and batch_index is not None):
+                return verdict.valid, verdict.message
+            valid, message = FileValidator.validate_content(file_content, engine, batch_index, schema=schema)
+            # A duplicate of an earlier file says nothing about the content itself
+            if FileValidator.error_category(message) != "duplicate_earlier_file":
+                cache.record(digests, len(data), valid, message)
+            return valid, message
+
+    @staticmethod
+    def validate_content(file_content, engine="python", batch_index=None, report=None, schema=None):
+        if schema is not None:
+            return schema.validate(file_content, batch_index, report)
+        if engine == "numpy" and report is None:
+            return ColumnarValidator.validate(file_content, batch_index=batch_index)
+        return FileValidator.validate_rows(file_content, batch_index, report)
+
+    @staticmethod
+    def validate_rows(file_content, batch_index=None, report=None):
+        first_error = None
+        batch_ids = {}
+        # A report needs every row checked against batch_index; otherwise
+        # the rows up to the first error are checked at once
+        row_index = batch_index if report is not None else None
+        bulk_index = None if report is not None else batch_index
+        try:
+            reader = csv.reader(file_content.splitlines())
+            error = FileValidator.check_headers(next(reader, None))
+            if error:
+                if report is not None:
+                    report.add(1, None, error)
+                return False, error
+            for row_num, row in enumerate(reader, start=2):
+                error = FileValidator.check_row(row, row_num, batch_ids, row_index)
+                if error:
+                    if report is None:
+                        return False, FileValidator.accepted_earlier(batch_ids, len(batch_ids), bulk_index) or error
+                    report.add_row(row, row_num, error)
+                    first_error = first_error or error
+            error = FileValidator.accepted_earlier(batch_ids, len(batch_ids), bulk_index)
+            if error:
+                return False, error
+        except Exception as e:
+            error = f"Malformed file error: {str(e)}"
+            if report is not None:
+                report.add(None, None, error)
+            return False, first_error or FileValidator.accepted_earlier(batch_ids, len(batch_ids), bulk_index) or error
+        if first_error:
+            return False, first_error
+        return True, "Valid"
+
+
+class ValidationReport:
+    """Every violation of a file, for the full-diagnostics mode.
+
+    The first limit violations are kept with their row, column and message;
+    all of them are counted by category.
+    """
+
+    def __init__(self, limit=DIAGNOSTICS_LIMIT):
+        self.limit = limit
+        self.violations = []
+        self.categories = {}
+        self.total = 0
+        self.rows = 0
+
+    def add(self, row_num, column, message):
+        self.total += 1
+        category = FileValidator.error_category(message)
+        self.categories[category] = self.categories.get(category, 0) + 1
+        if len(self.violations) < self.limit:
+            self.violations.append({"row": row_num, "column": column,
+                                    "category": category, "message": message})
+
+    def add_row(self, row, row_num, error, schema=None):
+        self.rows += 1
+        for column, message in (schema or FileValidator).row_violations(row, row_num, error):
+            self.add(row_num, column, message)
+
+    def summary(self):
+        return f"{self.total} violations in {self.rows} rows"
+
+    def write(self, filename, source=None):
+        """Write the report as JSON into ERROR_LOG_DIR and return its path."""
+        import json
+        from datetime import datetime
+        os.makedirs(ERROR_LOG_DIR, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        path = os.path.join(ERROR_LOG_DIR, f"{os.path.splitext(filename)[0]}_{timestamp}_report.json")
+        report = {
+            "file": filename,
+            "source": source,
+            "created_at": datetime.now().isoformat(),
+            "total": self.total,
+            "rows": self.rows,
+            "categories": self.categories,
+            "truncated": self.total > len(self.violations),
+            "violations": self.violations,
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return path
+
+
+class ColumnarValidator:
+    """NumPy engine for FileValidator: checks blocks of rows as byte arrays.
+
+    The column count, decimal format and 9.9 bound are evaluated for a whole
+    block of lines at once; only the first row flagged by the array checks
+    is handed to FileValidator.check_row, so the message and row number are
+    exactly those of the pure-Python path. The batch_ids of a block are
+    checked against batch_index together. Falls back to that path when
+    NumPy is not installed, for quoted CSV, and per block for non-ASCII text.
+    """
+
+    @staticmethod
+    def validate(file_content, block_rows=COLUMNAR_BLOCK_ROWS, batch_index=None):
+        try:
+            import numpy as np
+        except ImportError:
+            return FileValidator.validate_rows(file_content, batch_index)
+        if '"' in file_content or "\0" in file_content:
+            # Without quoting every line is exactly line.split(","), which
+            # is what lets the rows be cut up as raw bytes.
+            return FileValidator.validate_rows(file_content, batch_index)
+        try:
+            lines = file_content.splitlines()
+            error = FileValidator.check_headers(next(csv.reader(lines[:1]), None))
+            if error:
+                return False, error
+            batch_ids = {}
+            for start in range(1, len(lines), block_rows):
+                block = lines[start:start + block_rows]
+                known = len(batch_ids)
+                error = ColumnarValidator.check_block(np, block, start + 1, batch_ids)
+                error = FileValidator.accepted_earlier(batch_ids, len(batch_ids) - known, batch_index) or error
+                if error:
+                    return False, error
+        except Exception as e:
+            return False, f"Malformed file error: {str(e)}"
+        return True, "Valid"
+
+    @staticmethod
+    def check_block(np, lines, first_row, batch_ids):
+        start = 0
+        while start < len(lines):
+            bad = ColumnarValidator.find_candidate(np, lines, start)
+            if bad is None:
+                rows = csv.reader(lines[start:])
+                for row_num, row in enumerate(rows, start=first_row + start):
+                    error = FileValidator.check_row(row, row_num, batch_ids)
+                    if error:
+                        return error
+                return None
+            # Rows before the candidate passed every other check, so the
+            # only thing that can fail earlier is a duplicate batch_id.
+            ids = [line.partition(",")[0] for line in lines[start:bad]]
+            if len(set(ids)) == len(ids) and batch_ids.keys().isdisjoint(ids):
+                batch_ids.update(zip(ids, range(first_row + start, first_row + bad)))
+            else:
+                for index, batch_id in enumerate(ids, start=start):
+                    if batch_id in batch_ids:
+                        bad = index
+                        break
+                    batch_ids[batch_id] = first_row + index
+            if bad == len(lines):
+                return None
+            row = next(csv.reader([lines[bad]]), [])
+            error = FileValidator.check_row(row, first_row + bad, batch_ids)
+            if error:
+                return error
+            start = bad + 1
+        return None
+
+    @staticmethod
+    def find_candidate(np, lines, start):
+        """Index of the first line from start that may fail, len(lines) if
+        none can, or None if the rest has to be checked row by row."""
+        lines = lines[start:]
+        if max(map(len, lines)) > csv.field_size_limit():
+            return None
+        try:
+            data = np.frombuffer(("\n".join(lines) + "\n").encode("ascii"), dtype=np.uint8)
+        except UnicodeEncodeError:
+            return None
+
+        newlines = np.flatnonzero(data == 10)
+        commas = np.flatnonzero(data == ord(","))
+        line_commas = np.bincount(np.searchsorted(newlines, commas), minlength=len(newlines))
+        short = np.flatnonzero(line_commas != 11)
+        rows = int(short[0]) if len(short) else len(lines)
+        if rows == 0:
+            return start
+        newlines = newlines[:rows]
+        commas = commas[:rows * 11].reshape(rows, 11)
+        # Four bytes of padding keep the look-ahead below in bounds.
+        data = np.concatenate((data[:newlines[-1] + 1], np.zeros(4, dtype=np.uint8)))
+
+        # The readings of each row run from its second comma to its newline.
+        marks = np.zeros(len(data), dtype=np.int8)
+        marks[commas[:, 1] + 1] = 1
+        marks[newlines] = -1
+        region = np.cumsum(marks, dtype=np.int8).astype(bool)
+
+        digit = (data >= ord("0")) & (data <= ord("9"))
+        nonzero = digit & (data != ord("0"))
+        dot = data == ord(".")
+        sep = (data == ord(",")) | (data == 10)
+        failed = region & ~(digit | dot | sep)
+        starts = commas[:, 1:].ravel() + 1
+        failed[starts[~digit[starts]]] = True
+
+        # A dot needs 1 to 3 digits and then the end of the cell.
+        dots = np.flatnonzero(dot & region)
+        d1, d2, d3 = digit[dots + 1], digit[dots + 2], digit[dots + 3]
+        well_placed = d1 & (sep[dots + 2] | d2 & (sep[dots + 3] | d3 & sep[dots + 4]))
+        failed[dots[~well_placed]] = True
+
+        # A non-zero integer digit followed by another integer digit makes
+        # the value at least 10; otherwise only 9.9 plus a non-zero decimal
+        # can exceed the bound.
+        fraction = np.zeros(len(data), dtype=bool)
+        fraction[dots + 1] = True
+        fraction[(dots + 2)[d2]] = True
+        fraction[(dots + 3)[d2 & d3]] = True
+        integer = digit & ~fraction
+        failed[:-1] |= region[:-1] & nonzero[:-1] & ~fraction[:-1] & integer[1:]
+        nine_point_nine = ((data[dots - 1] == ord("9")) & (data[dots + 1] == ord("9"))
+                           & (nonzero[dots + 2] | d2 & nonzero[dots + 3]))
+        failed[dots[nine_point_nine]] = True
+
+        if not failed.any():
+            return start + rows
+        return start + int(np.searchsorted(newlines, failed.argmax()))
+
+
+class StreamingValidator:
+    """Incremental FileValidator fed with raw bytes chunks as they arrive.
+
+    Line boundaries, and records whose quoted fields span several lines,
+    are tracked across chunks, so the verdict and message are the same as
+    FileValidator.validate on the whole decoded file, but the first bad row
+    is reported as soon as its chunk has been received.
+    With a compression from CSV_EXTENSIONS the chunks are decompressed
+    first, so a .csv.gz file is never inflated in memory as a whole. A
+    Schema is checked with its compiled validator in place of
+    FileValidator; it does not fill a sidecar. Without a report the
+    batch_ids are checked against batch_index BATCH_INDEX_CHECK_ROWS rows
+    at a time, and those before a bad row with it.
+    """
+
+    def __init__(self, encoding="utf-8", batch_index=None, sidecar=None, report=None, compression=None,
+                 schema=None):
+        self.decompressor = Decompressor(compression) if compression else None
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.batch_index = batch_index
+        # SidecarWriter collecting the columns of the rows checked so far
+        self.sidecar = sidecar
+        # With a ValidationReport, row errors are collected and the whole
+        # file is read; only a bad header or undecodable data stop it early
+        self.report = report
+        self.schema = schema
+        self.stopped = False
+        self.pending = ""
+        self.row_num = 0
+        # batch_id: row, of the rows so far; the first self.checked of
+        # them are known not to be in batch_index
+        self.batch_ids = {}
+        self.checked = 0
+        self.bytes_received = 0
+        self.valid = True
+        self.message = "Valid"
+
+    def feed(self, chunk):
+        """Consume a bytes chunk; return False once the rest need not be read."""
+        if self.stopped:
+            return False
+        self.bytes_received += len(chunk)
+        try:
+            if self.decompressor is not None:
+                with METRICS.stage("decompress"):
+                    chunk = self.decompressor.decompress(chunk)
+            with METRICS.stage("decode"):
+                text = self.decoder.decode(chunk)
+            lines = (self.pending + text).splitlines(True)
+            # Hold back an unterminated last line, and a bare "\r" which may
+            # be the first half of a "\r\n" split across two chunks.
+            if lines and (lines[-1].splitlines()[0] == lines[-1] or lines[-1].endswith("\r")):
+                self.pending = lines.pop()
+            else:
+                self.pending = ""
+            # Nor cut a record whose quoted field goes on in the next chunk:
+            # each consume call parses with a csv reader of its own
+            start = self.open_record(lines)
+            if start is not None:
+                self.pending = "".join(lines[start:]) + self.pending
+                del lines[start:]
+            rows = self.row_num
+            with METRICS.stage("validate"):
+                self.consume("".join(lines).splitlines())
+            METRICS.add("rows", self.row_num - rows)
+        except Exception as e:
+            self.fail(self.check_accepted() or f"Malformed file error: {str(e)}")
+        return not self.stopped
+
+    def close(self):
+        """Flush the last partial line and return (valid, message)."""
+        if not self.stopped:
+            try:
+                if self.decompressor is not None:
+                    self.decompressor.finish()
+                self.pending += self.decoder.decode(b"", final=True)
+                self.consume(self.pending.splitlines())
+                self.pending = ""
+                error = None if self.stopped else self.check_accepted()
+                if error:
+                    self.fail(error)
+                if self.row_num == 0:
+                    self.fail(FileValidator.check_headers(None))
+            except Exception as e:
+                self.fail(self.check_accepted() or f"Malformed file error: {str(e)}")
+        return self.valid, self.message
+
+    @staticmethod
+    def open_record(lines):
+        """Index of the line starting a record that a quoted field leaves
+        unterminated at the end of lines, or None if every record ends.
+
+        Follows the csv module: a quote opens a quoted field only at the
+        start of a field, and inside one a doubled quote is literal.
+        """
+        if not any('"' in line for line in lines):
+            return None
+        quoted = False
+        start = None
+        for index, line in enumerate(lines):
+            if not quoted:
+                start = index
+                if '"' not in line:
+                    continue
+            elif '"' not in line:
+                continue
+            field_start = not quoted
+            i, n = 0, len(line)
+            while i < n:
+                c = line[i]
+                if quoted:
+                    if c == '"':
+                        if i + 1 < n and line[i + 1] == '"':
+                            i += 1
+                        else:
+                            quoted = False
+                elif c == '"' and field_start:
+                    quoted = True
+                field_start = not quoted and c == ","
+                i += 1
+        return start if quoted else None
+
+    def check_accepted(self):
+        """Check the batch_ids added since the last call against batch_index
+        together; return the error message or None.
+
+        With a report every row is checked on its own instead.
+        """
+        added = len(self.batch_ids) - self.checked
+        self.checked = len(self.batch_ids)
+        if self.report is not None or not added:
+            return None
+        name = "batch_id" if self.schema is None else self.schema.headers[self.schema.key]
+        return FileValidator.accepted_earlier(self.batch_ids, added, self.batch_index, name)
+
+    def consume(self, lines):
+        if self.schema is not None:
+            self.consume_schema(lines)
+        else:
+            self.consume_rows(lines)
+        if not self.stopped and len(self.batch_ids) - self.checked >= BATCH_INDEX_CHECK_ROWS:
+            error = self.check_accepted()
+            if error:
+                self.fail(error)
+
+    def consume_rows(self, lines):
+        sidecar = self.sidecar
+        readings = sidecar.readings if sidecar is not None else None
+        batch_index = self.batch_index if self.report is not None else None
+        for row in csv.reader(lines):
+            self.row_num += 1
+            if self.row_num == 1:
+                error = FileValidator.check_headers(row)
+            else:
+                error = FileValidator.check_row(row, self.row_num, self.batch_ids, batch_index, readings)
+                if sidecar is not None and not error:
+                    sidecar.add_row(row[0], row[1])
+            if error:
+                if self.report is None or self.row_num == 1:
+                    self.fail(self.check_accepted() or error)
+                    return
+                self.report.add_row(row, self.row_num, error)
+                self.reject(error)
+
+    def consume_schema(self, lines):
+        schema = self.schema
+        if self.report is None:
+            self.row_num, error = schema.check_lines(lines, self.row_num, self.batch_ids)
+            if error:
+                self.fail(self.check_accepted() or error)
+            return
+        for row in csv.reader(lines):
+            self.row_num += 1
+            if self.row_num == 1:
+                error = schema.check_headers(row)
+                if error:
+                    self.fail(error)
+                    return
+                continue
+            error = schema.check_row(row, self.row_num, self.batch_ids, self.batch_index)
+            if error:
+                self.report.add_row(row, self.row_num, error, schema)
+                self.reject(error)
+
+    def reject(self, message):
+        """Mark the file invalid, keeping the first message."""
+        if self.valid:
+            self.valid = False
+            self.message = message
+
+    def fail(self, message):
+        """Reject the file and stop reading it."""
+        if self.report is not None:
+            self.report.add(self.row_num or None, None, message)
+        self.reject(message)
+        self.stopped = True
+
+
+class ContentDigest:
+    """Running SHA-256 and MD5 of a file's bytes, the keys of a VerdictCache."""
+
+    def __init__(self):
+        import hashlib
+        self.hashes = {"sha256": hashlib.sha256(), "md5": hashlib.md5()}
+        self.size = 0
+
+    def update(self, data):
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.size += len(data)
+
+    def hexdigests(self):
+        return {name: digest.hexdigest() for name, digest in self.hashes.items()}
+
+
+class Decompressor:
+    """Incremental decompression of a compressed file or MODE Z stream.
+
+    codec is "gzip" or "zstd" for the content of .csv.gz and .csv.zst
+    files, which may hold several members or frames, or "zlib" for the
+    deflate stream of a MODE Z transfer.
+    """
+
+    def __init__(self, codec):
+        if codec not in ("gzip", "zstd", "zlib"):
+            raise ValueError(f"Unknown compression: {codec}")
+        if codec == "zstd":
+            import zstandard
+            self.zstd = zstandard.ZstdDecompressor()
+        self.codec = codec
+        # Decompressor of the member being read, None between members
+        self.member = None
+
+    @staticmethod
+    def codec_for(filename):
+        """Return the compression of a file by its name, None for plain CSV."""
+        name = filename.lower()
+        for extension, codec in CSV_EXTENSIONS.items():
+            if name.endswith(extension):
+                return codec
+        return None
+
+    def new_member(self):
+        if self.codec == "zstd":
+            return self.zstd.decompressobj()
+        return zlib.decompressobj(zlib.MAX_WBITS | 16 if self.codec == "gzip" else zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        out = []
+        while data:
+            if self.member is None:
+                self.member = self.new_member()
+            out.append(self.member.decompress(data))
+            if not self.member.eof:
+                break
+            data = self.member.unused_data
+            self.member = None
+        return b"".join(out)
+
+    def finish(self):
+        """Raise EOFError if the data stopped in the middle of a member."""
+        if self.member is not None:
+            raise EOFError(f"{self.codec} data ends in the middle of a stream")
+
+    @staticmethod
+    def inflate(path, codec, blocksize=1 << 20):
+        """Decompress the file at path into path + ".csv" and remove it."""
+        target = path + ".csv"
+        decompressor = Decompressor(codec)
+        try:
+            with open(path, "rb") as source, open(target, "wb") as f:
+                for block in iter(lambda: source.read(blocksize), b""):
+                    f.write(decompressor.decompress(block))
+            decompressor.finish()
+        except BaseException:
+            os.remove(target)
+            raise
+        os.remove(path)
+        return target
+
+
+class ShardedValidator:
+    """FileValidator for a file on disk, split across worker processes.
+
+    The file is cut into one newline-aligned byte range per worker. A first
+    parallel pass counts the lines of every range, which gives each one its
+    starting row number; the second validates the ranges. Each worker stops
+    at its range's first error and returns the batch_ids it saw before it,
+    in order, and that of the error row, so the merge can find duplicates
+    across ranges exactly and report the error on the lowest row, with the
+    same message as the serial path. Small files, compressed files and
+    files that cannot be cut safely at newlines are validated serially.
+    """
+
+    @staticmethod
+    def validate_file(path, workers=None, min_bytes=SHARD_MIN_BYTES, batch_index=None):
+        workers = workers or os.cpu_count() or 1
+        size = os.path.getsize(path)
+        if workers < 2 or size == 0 or size < min_bytes or Decompressor.codec_for(path) is not None:
+            return ShardedValidator.validate_serial(path, batch_index)
+        from concurrent.futures import ProcessPoolExecutor
+        try:
+            ranges = ShardedValidator.split(path, size, workers)
+            starts, ends = zip(*ranges)
+            paths = [path] * len(ranges)
+            with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+                scans = list(executor.map(ShardedValidator.scan, paths, starts, ends))
+                if any(irregular for lines, irregular in scans):
+                    return ShardedValidator.validate_serial(path, batch_index)
+                first_rows = [1]
+                for lines, irregular in scans[:-1]:
+                    first_rows.append(first_rows[-1] + lines)
+                results = list(executor.map(ShardedValidator.validate_range, paths, starts, ends, first_rows))
+        except Exception as e:
+            return False, f"Malformed file error: {str(e)}"
+        return ShardedValidator.merge(results, first_rows, batch_index)
+
+    @staticmethod
+    def validate_serial(path, batch_index=None, schema=None):
+        validator = StreamingValidator(batch_index=batch_index, compression=Decompressor.codec_for(path),
+                                       schema=schema)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(SHARD_BLOCK_BYTES), b""):
+                if not validator.feed(chunk):
+                    break
+        return validator.close()
+
+    @staticmethod
+    def split(path, size, count):
+        """Cut [0, size) into up to count ranges, each ending after a newline."""
+        bounds = [0]
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for i in range(1, count):
+                cut = view.find(b"\n", max(bounds[-1], size * i // count)) + 1
+                if cut == 0 or cut >= size:
+                    break
+                bounds.append(cut)
+        bounds.append(size)
+        return list(zip(bounds, bounds[1:]))
+
+    @staticmethod
+    def blocks(view, start, end):
+        """Yield newline-aligned (start, end) blocks of a range, to bound memory."""
+        while start < end:
+            cut = min(start + SHARD_BLOCK_BYTES, end)
+            if cut < end:
+                cut = view.find(b"\n", cut - 1, end) + 1 or end
+            yield start, cut
+            start = cut
+
+    @staticmethod
+    def scan(path, start, end):
+        """Return (lines, irregular) for a range."""
+        lines = 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for block_start, block_end in ShardedValidator.blocks(view, start, end):
+                # Blocks end after a "\n", so no "\r\n" is split between two
+                block = view[block_start:block_end]
+                if IRREGULAR_LINES.search(block):
+                    return lines, True
+                lines += block.count(b"\n")
+            if end > start and view[end - 1:end] != b"\n":
+                lines += 1
+        return lines, False
+
+    @staticmethod
+    def validate_range(path, start, end, first_row):
+        """Return (error_row, message, batch_ids, error_id) for a range.
+
+        batch_ids holds the ids of the rows before the first error, joined
+        with newlines, which cannot occur inside an unquoted field.
+        error_id is the batch_id of the error row if it has every column:
+        FileValidator.check_row looks for duplicates before the readings,
+        so the merge has to check it against the other ranges too.
+        """
+        row_num = first_row
+        batch_ids = {}
+        ids = []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            for block_start, block_end in ShardedValidator.blocks(view, start, end):
+                try:
+                    lines = view[block_start:block_end].decode("utf-8").splitlines()
+                except UnicodeDecodeError as e:
+                    return row_num, f"Malformed file error: {str(e)}", "\n".join(ids), None
+                for row in csv.reader(lines):
+                    if row_num == 1:
+                        error = FileValidator.check_headers(row)
+                    else:
+                        error = FileValidator.check_row(row, row_num, batch_ids)
+                        if not error:
+                            ids.append(row[0])
+                    if error:
+                        error_id = row[0] if row_num > 1 and len(row) == len(EXPECTED_HEADERS) else None
+                        return row_num, error, "\n".join(ids), error_id
+                    row_num += 1
+        return None, None, "\n".join(ids), None
+
+    @staticmethod
+    def merge(results, first_rows, batch_index=None):
+        """Return (valid, message) for the whole file from the ranges' results."""
+        seen = set()
+        for (error_row, message, joined, error_id), first_row in zip(results, first_rows):
+            ids = joined.split("\n") if joined else []
+            # Every row before the error has an id, the first range's after the header
+            first_id_row = max(first_row, 2)
+            duplicates = seen.intersection(ids)
+            accepted = batch_index.first_accepted(ids) if batch_index is not None else None
+            if duplicates or accepted is not None:
+                # An id seen in an earlier range is an error on an earlier
+                # row than any the worker found in this one
+                for row_num, batch_id in enumerate(ids, start=first_id_row):
+                    if batch_id in duplicates:
+                        return False, f"Duplicate batch_id {batch_id} on row {row_num}"
+                    if batch_id == accepted:
+                        return False, f"Duplicate batch_id {batch_id} on row {row_num} (accepted in an earlier file)"
+            # An id repeated within the range is the worker's own message
+            if error_id is not None and error_id not in ids:
+                if error_id in seen:
+                    return False, f"Duplicate batch_id {error_id} on row {error_row}"
+                if batch_index is not None and error_id in batch_index:
+                    return False, f"Duplicate batch_id {error_id} on row {error_row} (accepted in an earlier file)"
+            if message:
+                return False, message
+            seen.update(ids)
+        return True, "Valid"
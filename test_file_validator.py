@@ -1,6 +1,187 @@
+import io
+import os
+import sys
+import json
+import errno
+import ftplib
+import shutil
+import subprocess
+import tempfile
+import threading
 import unittest
+import uuid
+import zlib
+import gzip
+import pickle
+import sqlite3
+import hashlib
 from datetime import datetime
-from Testfile10 import FileValidator, Logger, FTPClient, DownloadStatus, App, VALID_DIR, ERROR_LOG_DIR, ERROR_LOG_FILE, EXPECTED_HEADERS
+from unittest.mock import MagicMock, patch
+from ftp_csv_validator.config import VALID_DIR, ERROR_LOG_DIR, ERROR_LOG_FILE, EXPECTED_HEADERS, SIDECAR_EXTENSION
+from ftp_csv_validator.config import EXIT_OK, EXIT_REJECTED, EXIT_FAILURE, BATCH_INDEX_CAPACITY
+from ftp_csv_validator.metrics import Metrics, METRICS
+from ftp_csv_validator.validation import FileValidator, ColumnarValidator, StreamingValidator, ShardedValidator
+from ftp_csv_validator.validation import ValidationReport
+from ftp_csv_validator.schema import Schema, Column
+from ftp_csv_validator.sidecar import Sidecar
+from ftp_csv_validator.state import ProcessedLedger, BatchIdIndex, BloomFilter, VerdictCache, OutputStore
+from ftp_csv_validator.errorlog import Logger, LogTail
+from ftp_csv_validator.transport import FTPClient, FTPConnectionPool, TransferCancelled, RemoteIndex, RemoteEntry
+from ftp_csv_validator.transport import Endpoint, MultiServerPool, PartialDownload, PartialWriteError
+from ftp_csv_validator.processing import FileProcessor, ParallelFileProcessor, MultiServerProcessor, DirectoryWatcher
+from ftp_csv_validator.processing import SCHEDULES
+from ftp_csv_validator.gui import DownloadStatus
+from ftp_csv_validator.cli import parse_args, run_headless, run_watch, run_local
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.ioloop import IOLoop
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER_LINE = ",".join(EXPECTED_HEADERS)
+GOOD_ROW = "{},2023-01-01,1.234,2.345,3.456,4.567,5.678,6.789,7.890,8.901,9.012,0.123"
+
+
+def make_csv(rows, bad_row=None, bad_line="x,2023-01-01,1.0", first=1):
+    lines = [HEADER_LINE]
+    for i in range(1, rows + 1):
+        lines.append(bad_line if i == bad_row else GOOD_ROW.format(first + i - 1))
+    return "\n".join(lines) + "\n"
+
+
+def saved_files():
+    """Paths of the CSV files in VALID_DIR and its date shards."""
+    return [os.path.join(directory, name) for directory, _, names in os.walk(VALID_DIR)
+            for name in names if name.endswith(".csv")]
+
+
+class DeflateProducer:
+    """Sends what a pyftpdlib producer yields as one zlib stream."""
+
+    def __init__(self, producer):
+        self.producer = producer
+        self.compressor = zlib.compressobj()
+
+    def more(self):
+        while self.compressor is not None:
+            data = self.producer.more()
+            if not data:
+                data, self.compressor = self.compressor.flush(), None
+                return data
+            data = self.compressor.compress(data)
+            if data:
+                return data
+        return b""
+
+
+if ThreadedFTPServer is not None:
+    class ModeZHandler(FTPHandler):
+        """FTPHandler that also offers MODE Z for RETR."""
+
+        use_sendfile = False
+        deflate = False
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._extra_feats.append("MODE Z")
+
+        def ftp_MODE(self, line):
+            self.deflate = line.upper() == "Z"
+            if self.deflate:
+                self.respond("200 Transfer mode set to: Z")
+            else:
+                super().ftp_MODE(line)
+
+        def push_dtp_data(self, data, isproducer=False, file=None, cmd=None):
+            if cmd == "RETR" and self.deflate:
+                self.deflated.append(os.path.basename(file.name))
+                data = DeflateProducer(data)
+            super().push_dtp_data(data, isproducer, file, cmd)
+
+    class DigestHandler(FTPHandler):
+        """FTPHandler that also answers the digest commands in hash_commands."""
+
+        proto_cmds = dict(FTPHandler.proto_cmds,
+                          HASH=dict(perm="r", auth=True, arg=True, help="Syntax: HASH <SP> file-name"),
+                          XMD5=dict(perm="r", auth=True, arg=True, help="Syntax: XMD5 <SP> file-name"))
+        hash_commands = ()
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            for command in self.hash_commands:
+                self._extra_feats.append("HASH SHA-256*;MD5" if command == "HASH" else command)
+
+        def hexdigest(self, path, algorithm):
+            with open(path, "rb") as f:
+                return hashlib.new(algorithm, f.read()).hexdigest()
+
+        def ftp_HASH(self, path):
+            if "HASH" not in self.hash_commands:
+                return self.respond('500 Command "HASH" not understood.')
+            size = os.path.getsize(path)
+            self.respond(f"213 SHA-256 0-{size} {self.hexdigest(path, 'sha256')} {os.path.basename(path)}")
+
+        def ftp_XMD5(self, path):
+            if "XMD5" not in self.hash_commands:
+                return self.respond('500 Command "XMD5" not understood.')
+            self.respond(f"250 {self.hexdigest(path, 'md5').upper()}")
+
+        def ftp_RETR(self, file):
+            self.retrieved.append(os.path.basename(file))
+            return super().ftp_RETR(file)
+
+
+class LocalFTPServer:
+    """In-process pyftpdlib server serving a temporary directory.
+
+    hash_commands ("HASH", "XMD5") are offered in place of MODE Z.
+    """
+
+    def __init__(self, mode_z=False, hash_commands=()):
+        self.root = tempfile.mkdtemp()
+        authorizer = DummyAuthorizer()
+        authorizer.add_user("user", "pass", self.root, perm="elradfmw")
+        # Names of the files sent in MODE Z, and of every file sent
+        self.deflated = []
+        self.retrieved = []
+        base = ModeZHandler if mode_z else DigestHandler if hash_commands else FTPHandler
+        handler = type("Handler", (base,), {"authorizer": authorizer, "deflated": self.deflated,
+                                            "retrieved": self.retrieved, "hash_commands": hash_commands})
+        # A loop of its own: the default is shared by every server in the
+        # process, and tests run more than one at a time
+        self.server = ThreadedFTPServer(("127.0.0.1", 0), handler, ioloop=IOLoop())
+        self.host, self.port = self.server.address
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            self.server.serve_forever(timeout=0.05, blocking=False)
+
+    def write(self, name, content):
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(os.path.join(self.root, name), mode) as f:
+            f.write(content)
+
+    def client(self, **state):
+        client = FTPClient(**state)
+        client.connect(self.host, "user", "pass", port=self.port)
+        return client
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.server.close_all()
+        shutil.rmtree(self.root)
 
 class TestFileValidator(unittest.TestCase):
     def setUp(self):
@@ -12,7 +193,7 @@ class TestFileValidator(unittest.TestCase):
     def test_valid_file(self):
         is_valid, message = FileValidator.validate(self.valid_csv_content)
         self.assertTrue(is_valid)
-        self.assertEqual(message, "Vali")
+        self.assertEqual(message, "Valid")
 
     def test_invalid_headers(self):
         invalid_headers = """wrong_id,timestamp,reading1,reading2,reading3,reading4,reading5,reading6,reading7,reading8,reading9,reading10
@@ -44,6 +225,1307 @@ class TestFileValidator(unittest.TestCase):
         self.assertIn("Value exceeds 9.9", message)
 
 
+class TestImports(unittest.TestCase):
+    def loaded(self, statement):
+        """Modules loaded by statement in a fresh interpreter."""
+        code = f"import sys; {statement}; print(' '.join(sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return set(result.stdout.split())
+
+    def test_validation_needs_no_transport_or_gui(self):
+        for statement in ("import ftp_csv_validator.validation", "from ftp_csv_validator import FileValidator"):
+            heavy = self.loaded(statement) & {"tkinter", "ftplib", "sqlite3", "requests", "numpy"}
+            self.assertEqual(heavy, set(), statement)
+
+    def test_headless_runner_needs_no_tkinter(self):
+        self.assertNotIn("tkinter", self.loaded("import ftp_csv_validator.cli"))
+
+
+class TestColumnarValidator(unittest.TestCase):
+    def test_matches_python_engine(self):
+        cells = ["9.9", "9.900", "9.901", "09.95", "10", "0010", "00", "1.", "1..2", ".5",
+                 "1.2345", "", "abc", "1e1", "+1", " 1", "9.09", "1.2.3", "nan", "\u0663"]
+        samples = [make_csv(40), "", "wrong," + make_csv(2), make_csv(3, bad_row=2, bad_line="")]
+        samples += [make_csv(40, bad_row=37, bad_line=GOOD_ROW.format(37).replace("0.123", cell))
+                    for cell in cells]
+        samples += [make_csv(40, bad_row=row, bad_line=GOOD_ROW.format(5)) for row in (6, 33)]
+        samples.append(make_csv(40, bad_row=20, bad_line=GOOD_ROW.format(20) + ",1"))
+        samples.append(make_csv(3).replace("1.234", '"1.234"'))
+        for content in samples:
+            expected = FileValidator.validate(content)
+            self.assertEqual(FileValidator.validate(content, engine="numpy"), expected)
+            for block_rows in (1, 3, 16):
+                self.assertEqual(ColumnarValidator.validate(content, block_rows), expected)
+
+
+class TestValidationReport(unittest.TestCase):
+    def bad_file(self):
+        lines = make_csv(50).splitlines()
+        lines[3] = GOOD_ROW.format(3).replace("1.234", "12.5").replace("0.123", "x")
+        lines[10] = "10,2023-01-01,1.0"
+        lines[20] = GOOD_ROW.format(5)
+        lines[30] = GOOD_ROW.format(30).replace("2.345", "2.3456")
+        return "\n".join(lines) + "\n"
+
+    def test_collects_every_violation(self):
+        content = self.bad_file()
+        report = ValidationReport()
+        validator = StreamingValidator(report=report)
+        for start in range(0, len(content), 100):
+            self.assertTrue(validator.feed(content[start:start + 100].encode()))
+        self.assertEqual(validator.close(), FileValidator.validate(content))
+        self.assertEqual(report.total, 5)
+        self.assertEqual(report.rows, 4)
+        self.assertEqual(report.categories, {"out_of_range": 1, "non_numeric": 1, "missing_columns": 1,
+                                             "duplicate_batch_id": 1, "bad_decimal": 1})
+        self.assertEqual([(v["row"], v["column"]) for v in report.violations],
+                         [(4, "reading1"), (4, "reading10"), (11, None), (21, "batch_id"), (31, "reading2")])
+        other = ValidationReport()
+        FileValidator.validate(content, engine="numpy", report=other)
+        self.assertEqual(other.violations, report.violations)
+
+    def test_limit_caps_listed_violations(self):
+        report = ValidationReport(limit=2)
+        FileValidator.validate(self.bad_file(), report=report)
+        self.assertEqual((report.total, len(report.violations)), (5, 2))
+
+    def test_bad_header_stops_early(self):
+        report = ValidationReport()
+        validator = StreamingValidator(report=report)
+        self.assertFalse(validator.feed(("wrong," + make_csv(5)).encode()))
+        self.assertEqual(report.categories, {"header": 1})
+
+
+class TestSchema(unittest.TestCase):
+    SENSOR = Schema([Column("serial", unique=True), Column("site"),
+                     Column("depth", "integer", min=0, max=500),
+                     Column("temperature", "decimal", min=-40, max=60, decimals=1)], "sensor")
+
+    def stream(self, content, schema, chunk_size):
+        validator = StreamingValidator(schema=schema)
+        data = content.encode("utf-8")
+        for start in range(0, len(data), chunk_size):
+            if not validator.feed(data[start:start + chunk_size]):
+                break
+        return validator.close()
+
+    def test_default_schema_matches_hand_written_rules(self):
+        schema = Schema.default()
+        index = BatchIdIndex(":memory:", capacity=1000)
+        index.commit({"9"}, "ftp://h/a.csv")
+        samples = [make_csv(5), make_csv(5).replace("\n", "\r\n"), make_csv(5, bad_row=3), make_csv(12),
+                   make_csv(5, bad_row=4, bad_line=GOOD_ROW.format(2))]
+        for cell in ("9.91", "10", "-1", "1.2345", "nan", " 1", "n/a", '"1.5"', "1.0000"):
+            samples.append(make_csv(3, bad_row=2, bad_line=GOOD_ROW.format(2).replace("5.678", cell)))
+        samples += ["wrong," + make_csv(1), "", HEADER_LINE]
+        for content in samples:
+            for batch_index in (None, index):
+                expected = FileValidator.validate(content, batch_index=batch_index)
+                self.assertEqual(schema.validate(content, batch_index), expected)
+                for chunk_size in (1, 7, 1 << 16):
+                    validator = StreamingValidator(batch_index=batch_index, schema=schema)
+                    data = content.encode()
+                    for start in range(0, len(data), chunk_size):
+                        validator.feed(data[start:start + chunk_size])
+                    self.assertEqual(validator.close(), expected)
+
+    def test_rules_of_a_custom_schema(self):
+        header = "serial,site,depth,temperature"
+        cases = {
+            "A1,north,10,-3.5\nA2,south,0,60": (True, "Valid"),
+            "A1,north,10,-3.5\nA1,south,0,20": (False, "Duplicate serial A1 on row 3"),
+            "A1,north,501,1": (False, "Value exceeds 500 in depth on row 2: 501.0"),
+            "A1,north,1.5,1": (False, "Invalid integer format in depth on row 2: 1.5"),
+            "A1,north,-1,1": (False, "Value below 0 in depth on row 2: -1.0"),
+            "A1,north,1,-40.25": (False, "Value below -40 in temperature on row 2: -40.25"),
+            "A1,north,1,-4.25": (False, "Invalid decimal format in temperature on row 2: -4.25"),
+            'A1,"north, upper",1,warm': (False, "Non-numeric temperature on row 2: warm"),
+            "A1,north,1": (False, "Row 2 has missing columns"),
+        }
+        for rows, expected in cases.items():
+            content = f"{header}\n{rows}\n"
+            self.assertEqual(self.SENSOR.validate(content), expected)
+            self.assertEqual(self.stream(content, self.SENSOR, 3), expected)
+        self.assertEqual(self.SENSOR.validate(make_csv(1)), (False, f"Incorrect or missing headers: {EXPECTED_HEADERS}"))
+
+    def test_load_from_json(self):
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        path = os.path.join(workdir, "sensor.json")
+        with open(path, "w") as f:
+            json.dump({"name": "sensor", "columns": [column._asdict() for column in self.SENSOR.columns]}, f)
+        schema = Schema.load(path)
+        self.assertEqual(schema.columns, self.SENSOR.columns)
+        self.assertEqual(schema.fingerprint, self.SENSOR.fingerprint)
+        with open(path, "w") as f:
+            json.dump({"columns": [{"name": "a", "unique": True}, {"name": "b", "unique": True}]}, f)
+        with self.assertRaises(ValueError):
+            Schema.load(path)
+        with self.assertRaises(ValueError):
+            Schema([Column("a", "decimal", min=2, max=1)])
+        with self.assertRaises(ValueError):
+            Schema([Column("a", "float")])
+        for bounds in ({"max": float("inf")}, {"min": float("nan")}, {"max": "high"}, {"max": [1]}):
+            with self.assertRaisesRegex(ValueError, "column a"):
+                Schema([Column("a", "decimal", **bounds)])
+        with open(path, "w") as f:
+            f.write('{"columns": [{"name": "a", "type": "decimal", "max": Infinity}]}')
+        with self.assertRaisesRegex(ValueError, "column a"):
+            Schema.load(path)
+        # Bounds written as strings are read as numbers
+        schema = Schema([Column("depth", "integer", min="0", max="500")])
+        self.assertEqual(schema.validate("depth\n501\n"), (False, "Value exceeds 500 in depth on row 2: 501.0"))
+
+    def test_pickles_for_worker_processes(self):
+        schema = pickle.loads(pickle.dumps(self.SENSOR))
+        self.assertEqual(schema.validate("serial,site,depth,temperature\nA1,north,501,1\n"),
+                         (False, "Value exceeds 500 in depth on row 2: 501.0"))
+
+    def test_diagnostics_use_the_schema_columns(self):
+        report = ValidationReport()
+        content = "serial,site,depth,temperature\nA1,north,501,x\nA1,south,1,1\n"
+        self.assertEqual(FileValidator.validate(content, report=report, schema=self.SENSOR),
+                         (False, "Value exceeds 500 in depth on row 2: 501.0"))
+        self.assertEqual([(v["row"], v["column"], v["category"]) for v in report.violations],
+                         [(2, "depth", "out_of_range"), (2, "temperature", "non_numeric"),
+                          (3, "serial", "duplicate_key")])
+
+
+class TestShardedValidator(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "data.csv")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def validate(self, content, workers=3):
+        with open(self.path, "w", newline="") as f:
+            f.write(content)
+        return ShardedValidator.validate_file(self.path, workers=workers, min_bytes=0)
+
+    def test_matches_serial_path(self):
+        samples = [make_csv(300), "wrong," + make_csv(2), make_csv(300, bad_row=250),
+                   make_csv(300, bad_row=20, bad_line=GOOD_ROW.format(20) + ",1"),
+                   make_csv(300).replace("\n", "\r\n"), make_csv(300).rstrip("\n"),
+                   make_csv(300).replace("1.234", '"1.234"', 1), make_csv(300).replace("\n", "\r", 5)]
+        for content in samples:
+            self.assertEqual(self.validate(content), FileValidator.validate(content))
+
+    def test_duplicates_across_ranges(self):
+        # The second 5 is in the last range, far from the first
+        content = make_csv(300, bad_row=290, bad_line=GOOD_ROW.format(5))
+        self.assertEqual(self.validate(content), (False, "Duplicate batch_id 5 on row 291"))
+        # An earlier row error in a later range still wins over the duplicate
+        content = make_csv(300, bad_row=290, bad_line=GOOD_ROW.format(5)).replace(
+            GOOD_ROW.format(200), "x,2023-01-01,1.0")
+        self.assertEqual(self.validate(content), (False, "Row 201 has missing columns"))
+
+    def test_error_row_id_is_checked_like_the_serial_path(self):
+        # The bad reading is on a row whose id repeats one from another range
+        # or the same one, or was accepted in an earlier file: the duplicate
+        # is reported, as check_row looks at the id first
+        index = BatchIdIndex(":memory:", capacity=1000)
+        index.commit({"1000"}, "ftp://h/a.csv")
+        cases = {GOOD_ROW.format(5).replace("1.234", "11.0"): "Duplicate batch_id 5 on row 291",
+                 GOOD_ROW.format(280).replace("1.234", "11.0"): "Duplicate batch_id 280 on row 291",
+                 "1000,2023-01-01,n/a,1,1,1,1,1,1,1,1,1":
+                     "Duplicate batch_id 1000 on row 291 (accepted in an earlier file)"}
+        for bad_line, message in cases.items():
+            content = make_csv(300, bad_row=290, bad_line=bad_line)
+            with open(self.path, "w", newline="") as f:
+                f.write(content)
+            for batch_index in (None, index):
+                expected = FileValidator.validate(content, batch_index=batch_index)
+                self.assertEqual(ShardedValidator.validate_file(self.path, workers=3, min_bytes=0,
+                                                                batch_index=batch_index), expected)
+            self.assertEqual(expected, (False, message))
+
+    def test_validate_local_files_from_the_command_line(self):
+        good, bad = os.path.join(self.workdir, "good.csv"), os.path.join(self.workdir, "bad.csv.gz")
+        with open(good, "w") as f:
+            f.write(make_csv(10))
+        with open(bad, "wb") as f:
+            f.write(gzip.compress(make_csv(10, bad_row=4).encode()))
+        args = parse_args(["--validate", good, bad, "--workers", "2",
+                           "--batch-index", os.path.join(self.workdir, "batch_ids.sqlite3")])
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            self.assertEqual(run_local(args), EXIT_REJECTED)
+        self.assertEqual(stdout.getvalue(), f"valid: {good}: Valid\ninvalid: {bad}: Row 5 has missing columns\n")
+        args.validate = [good, os.path.join(self.workdir, "missing.csv")]
+        with patch("sys.stdout", new_callable=io.StringIO), patch("sys.stderr", new_callable=io.StringIO):
+            self.assertEqual(run_local(args), EXIT_FAILURE)
+
+
+class TestStreamingValidator(unittest.TestCase):
+    def stream(self, content, chunk_size):
+        validator = StreamingValidator()
+        data = content.encode("utf-8")
+        for start in range(0, len(data), chunk_size):
+            if not validator.feed(data[start:start + chunk_size]):
+                break
+        return validator.close()
+
+    def test_matches_validate_for_any_chunking(self):
+        samples = [
+            make_csv(5),
+            make_csv(5).replace("\n", "\r\n"),
+            make_csv(5).rstrip("\n"),
+            make_csv(5, bad_row=3),
+            make_csv(5, bad_row=4, bad_line=GOOD_ROW.format(2)),
+            make_csv(3, bad_row=2, bad_line=GOOD_ROW.format(2).replace("0.123", "0.12\u00e9")),
+            "wrong," + make_csv(1),
+            "",
+        ]
+        for content in samples:
+            expected = FileValidator.validate(content)
+            for chunk_size in (1, 2, 7, 64, 1 << 16):
+                self.assertEqual(self.stream(content, chunk_size), expected)
+
+    def test_quoted_newlines_across_chunks(self):
+        multiline = GOOD_ROW.format(1).replace("2023-01-01", '"2023-01-01\n10:00"')
+        escaped = GOOD_ROW.format(2).replace("2023-01-01", '"a,""b""\n\nc"')
+        samples = [
+            f"{HEADER_LINE}\n{multiline}\n{escaped}\n",
+            f"{HEADER_LINE}\n{multiline}\n{escaped}\nx,1\n",
+            # A quote inside an unquoted field opens nothing
+            HEADER_LINE + "\n" + GOOD_ROW.format(1).replace("2023", 'a"b') + "\nx,1\n",
+            f"{HEADER_LINE}\n{multiline.rsplit(',', 1)[0]}\n",
+        ]
+        for content in samples:
+            expected = FileValidator.validate(content)
+            for chunk_size in (1, 7, 50, 1 << 16):
+                self.assertEqual(self.stream(content, chunk_size), expected)
+                validator = StreamingValidator(schema=Schema.default())
+                data = content.encode()
+                for start in range(0, len(data), chunk_size):
+                    validator.feed(data[start:start + chunk_size])
+                self.assertEqual(validator.close(), expected)
+
+    def test_decompresses_gzip_and_zstd_in_chunks(self):
+        content = make_csv(300, bad_row=250).encode()
+        compressed = {"gzip": gzip.compress(content[:5000]) + gzip.compress(content[5000:])}
+        if zstandard is not None:
+            compressor = zstandard.ZstdCompressor()
+            compressed["zstd"] = compressor.compress(content[:5000]) + compressor.compress(content[5000:])
+        for codec, data in compressed.items():
+            for chunk_size in (1, 100, 1 << 16):
+                validator = StreamingValidator(compression=codec)
+                for start in range(0, len(data), chunk_size):
+                    if not validator.feed(data[start:start + chunk_size]):
+                        break
+                self.assertEqual(validator.close(), FileValidator.validate(content.decode()))
+
+    def test_truncated_compressed_file_is_malformed(self):
+        validator = StreamingValidator(compression="gzip")
+        self.assertTrue(validator.feed(gzip.compress(make_csv(50).encode())[:-20]))
+        valid, msg = validator.close()
+        self.assertFalse(valid)
+        self.assertIn("Malformed file error", msg)
+
+    def test_stops_at_first_bad_chunk(self):
+        validator = StreamingValidator()
+        self.assertFalse(validator.feed(b"wrong,header\n"))
+        self.assertFalse(validator.feed(make_csv(1).encode()))
+        self.assertEqual(validator.bytes_received, len(b"wrong,header\n"))
+        self.assertIn("Incorrect or missing headers", validator.close()[1])
+
+
+@unittest.skipIf(ThreadedFTPServer is None, "pyftpdlib is not installed")
+class TestFTPClientStreaming(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalFTPServer()
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        self.client = self.server.client()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+        self.client.ftp.close()
+        self.server.stop()
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_default_output_store_keeps_its_manifest(self):
+        # Published files are recorded in the manifest on disk, which stays
+        # with VALID_DIR when the working directory changes
+        self.server.write("a.csv", make_csv(10))
+        self.assertEqual(FileProcessor(self.client, Logger()).process("a.csv").outcome, "saved")
+        os.chdir(self.cwd)
+        try:
+            [output] = self.client.outputs.find(batch_id="5")
+            self.assertTrue(os.path.isfile(self.client.outputs.path(output.path)))
+        finally:
+            os.chdir(self.workdir)
+        self.assertEqual(len(OutputStore().find(batch_id="5")), 1)
+
+    def drop_connection_once(self, after):
+        dropped = []
+
+        def progress(received):
+            if received >= after and not dropped:
+                dropped.append(received)
+                raise ConnectionResetError("connection reset by peer")
+        return progress
+
+    def test_download_validated_accepts_valid_file(self):
+        content = make_csv(50)
+        self.server.write("good.csv", content)
+        valid, msg, spool = self.client.download_validated("good.csv")
+        self.assertEqual((valid, msg), (True, "Valid"))
+        self.assertEqual(self.read(spool), content.encode())
+
+    def test_bad_header_aborts_transfer(self):
+        self.server.write("big.csv", "wrong," + make_csv(200000))
+        validator = StreamingValidator()
+        valid, msg, spool = self.client.download_validated("big.csv", validator)
+        self.assertFalse(valid)
+        self.assertIn("Incorrect or missing headers", msg)
+        self.assertIsNone(spool)
+        self.assertLess(validator.bytes_received, 1 << 20)
+        # The control channel is usable again after the ABOR.
+        self.assertIn("big.csv", self.client.list_files())
+
+    @patch("ftp_csv_validator.transport.RETRY_DELAY", 0)
+    def test_dropped_connection_resumes_with_rest(self):
+        content = make_csv(50000)
+        self.server.write("big.csv", content)
+        with patch.object(ftplib.FTP, "retrbinary", autospec=True, side_effect=ftplib.FTP.retrbinary) as retr:
+            valid, msg, spool = self.client.download_validated(
+                "big.csv", progress=self.drop_connection_once(len(content) // 2))
+        self.assertEqual((valid, msg), (True, "Valid"))
+        self.assertEqual(self.read(spool), content.encode())
+        rests = [call.kwargs["rest"] for call in retr.call_args_list]
+        self.assertIsNone(rests[0])
+        self.assertGreaterEqual(rests[1], len(content) // 2)
+        # Only the finished part file is left, for the caller to publish
+        self.assertEqual(os.listdir(os.path.join("state", "partial")), [os.path.basename(spool)])
+
+    @patch("ftp_csv_validator.transport.RETRY_DELAY", 0)
+    def test_failed_write_is_not_retried(self):
+        self.server.write("big.csv", make_csv(50000))
+        validator = StreamingValidator()
+        with patch.object(PartialDownload, "write", side_effect=OSError(errno.ENOSPC, "No space left on device")), \
+                patch.object(ftplib.FTP, "retrbinary", autospec=True, side_effect=ftplib.FTP.retrbinary) as retr:
+            with self.assertRaises(PartialWriteError):
+                self.client.download_validated("big.csv", validator)
+        self.assertEqual(retr.call_count, 1)
+        # Nothing that failed to reach the part file was validated
+        self.assertEqual(validator.bytes_received, 0)
+
+    def test_checkpoint_survives_failed_attempt(self):
+        content = make_csv(50000)
+        self.server.write("big.csv", content)
+        with self.assertRaises(ConnectionResetError):
+            self.client.download_validated("big.csv", progress=self.drop_connection_once(len(content) // 2),
+                                           retries=0)
+        self.assertEqual(len(os.listdir(os.path.join("state", "partial"))), 2)
+        # A fresh validator replays the part file before resuming
+        self.client.reconnect()
+        validator = StreamingValidator()
+        with patch.object(ftplib.FTP, "retrbinary", autospec=True, side_effect=ftplib.FTP.retrbinary) as retr:
+            valid, msg, spool = self.client.download_validated("big.csv", validator)
+        self.assertGreaterEqual(retr.call_args.kwargs["rest"], len(content) // 2)
+        self.assertEqual((valid, msg), (True, "Valid"))
+        self.assertEqual(self.read(spool), content.encode())
+        self.assertEqual(validator.bytes_received, len(content))
+
+    def test_checkpoint_resumes_when_modify_becomes_known(self):
+        partial = PartialDownload("ftp://h/a.csv", 100, None, "partial")
+        partial.open()
+        partial.write(b"x" * 40)
+        partial.checkpoint()
+        partial.file.close()
+        for size, offset in ((100, 40), (101, 0)):
+            partial = PartialDownload("ftp://h/a.csv", size, "20240101000000", "partial")
+            self.assertEqual(partial.open(), offset)
+            partial.file.close()
+
+    def test_mode_z_transfer(self):
+        server = LocalFTPServer(mode_z=True)
+        client = server.client()
+        try:
+            content = make_csv(20000)
+            server.write("big.csv", content)
+            server.write("bad.csv", "wrong," + make_csv(200000))
+            with patch.object(METRICS, "add") as add:
+                valid, msg, spool = client.download_validated("big.csv")
+            self.assertEqual((valid, msg), (True, "Valid"))
+            self.assertEqual(self.read(spool), content.encode())
+            wire = sum(call.args[1] for call in add.call_args_list if call.args[0] == "bytes_received")
+            self.assertLess(wire, len(content) // 5)
+            valid, msg, spool = client.download_validated("bad.csv")
+            self.assertIn("Incorrect or missing headers", msg)
+            self.assertEqual(server.deflated, ["big.csv", "bad.csv"])
+            # Back in MODE S, and the session still works
+            self.assertEqual(client.mode, "S")
+            self.assertEqual(sorted(client.list_files()), ["bad.csv", "big.csv"])
+        finally:
+            client.ftp.close()
+            server.stop()
+
+    def test_listing_reports_size_and_modify_time(self):
+        content = make_csv(3)
+        self.server.write("a.csv", content)
+        os.mkdir(os.path.join(self.server.root, "sub"))
+        self.assertEqual(self.client.list_files(), ["a.csv"])
+        entry = self.client.index.lookup("a.csv")
+        self.assertEqual(entry.size, len(content))
+        self.assertRegex(entry.modify, r"^\d{14}$")
+
+    def test_listing_falls_back_to_list(self):
+        self.server.write("a.csv", make_csv(3))
+        with patch.object(self.client.ftp, "mlsd", side_effect=ftplib.error_perm("500 Unknown command")):
+            self.assertEqual(self.client.list_files(), ["a.csv"])
+        self.assertEqual(self.client.index.lookup("a.csv").size, len(make_csv(3)))
+
+
+@unittest.skipIf(ThreadedFTPServer is None, "pyftpdlib is not installed")
+class TestDirectoryWatcher(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalFTPServer()
+        # Only lists, so it needs no manifest on disk
+        self.client = self.server.client(outputs=OutputStore(manifest=":memory:"))
+        self.watcher = DirectoryWatcher(self.client, interval=1, max_interval=4)
+
+    def tearDown(self):
+        self.client.ftp.close()
+        self.server.stop()
+
+    def test_reports_settled_csv_files_once(self):
+        self.server.write("a.csv", make_csv(3))
+        self.server.write("notes.txt", "ignored")
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.poll(), ["a.csv"])
+        self.assertEqual(self.watcher.poll(), [])
+        # Still growing: wait until it stops changing
+        with open(os.path.join(self.server.root, "a.csv"), "a") as f:
+            f.write(GOOD_ROW.format(4) + "\n")
+        self.assertEqual(self.watcher.poll(), [])
+        self.assertEqual(self.watcher.poll(), ["a.csv"])
+
+    def test_backs_off_while_idle(self):
+        delays = []
+        for _ in range(4):
+            self.watcher.poll()
+            delays.append(self.watcher.delay)
+        self.assertEqual(delays, [2, 4, 4, 4])
+        self.server.write("a.csv", make_csv(3))
+        self.watcher.poll()
+        self.assertEqual(self.watcher.delay, 1)
+        self.assertTrue(0.8 <= self.watcher.next_delay() <= 1.2)
+
+
+class TestRemoteIndex(unittest.TestCase):
+    def setUp(self):
+        self.client = FTPClient(outputs=OutputStore(manifest=":memory:"))
+        self.client.list_entries = MagicMock(return_value=[
+            RemoteEntry("b.csv", 10, "20240102030405"),
+            RemoteEntry("a.csv", 0, None),
+            RemoteEntry("ab.txt", 5, None),
+        ])
+        self.client.ftp = MagicMock()
+
+    def test_search_modes_use_the_cache(self):
+        self.assertEqual(self.client.list_files(), ["b.csv", "a.csv", "ab.txt"])
+        self.assertEqual(self.client.search_files("b"), ["b.csv", "ab.txt"])
+        self.assertEqual(self.client.search_files("*.csv", "glob"), ["b.csv", "a.csv"])
+        self.assertEqual(self.client.search_files("a", "prefix"), ["a.csv", "ab.txt"])
+        self.assertEqual(self.client.list_entries.call_count, 1)
+
+    def test_size_comes_from_fresh_index(self):
+        self.client.list_files()
+        self.assertEqual(self.client.size("b.csv"), 10)
+        self.client.ftp.size.assert_not_called()
+        self.client.index.loaded_at -= self.client.index.ttl + 1
+        self.client.size("b.csv")
+        self.client.ftp.size.assert_called_once_with("b.csv")
+
+    def test_parse_list_line(self):
+        now = datetime(2026, 3, 1)
+        parse = RemoteIndex.parse_list_line
+        self.assertEqual(parse("-rw-r--r--   1 owner group   12345 Feb 27 14:03 data file.csv", now),
+                         RemoteEntry("data file.csv", 12345, "20260227140300"))
+        self.assertEqual(parse("-rw-r--r--   1 owner   12 Dec 27 14:03 a.csv", now),
+                         RemoteEntry("a.csv", 12, "20251227140300"))
+        self.assertEqual(parse("-rw-r--r--   1 owner group   7 Jan  5  2020 old.csv", now),
+                         RemoteEntry("old.csv", 7, "20200105000000"))
+        self.assertEqual(parse("03-01-26  02:15PM       1234 dos.csv", now),
+                         RemoteEntry("dos.csv", 1234, "20260301141500"))
+        self.assertIsNone(parse("drwxr-xr-x   2 owner group   4096 Jan  5  2020 sub", now))
+        self.assertIsNone(parse("total 12", now))
+
+
+class TestSchedules(unittest.TestCase):
+    ENTRIES = [RemoteEntry("b.csv", 300, "20240103000000"), RemoteEntry("a.csv", 100, "20240102000000"),
+               RemoteEntry("d.csv", None, None), RemoteEntry("c.csv", 200, "20240101000000"),
+               RemoteEntry("e.csv", 400, "20240104000000")]
+
+    def order(self, schedule):
+        return [entry.name for entry in SCHEDULES[schedule](self.ENTRIES)]
+
+    def test_orders(self):
+        self.assertEqual(self.order("listing"), ["b.csv", "a.csv", "d.csv", "c.csv", "e.csv"])
+        self.assertEqual(self.order("smallest-first"), ["a.csv", "c.csv", "b.csv", "e.csv", "d.csv"])
+        self.assertEqual(self.order("oldest-first"), ["c.csv", "a.csv", "b.csv", "e.csv", "d.csv"])
+        # The smallest file, then largest first
+        self.assertEqual(self.order("size-balanced"), ["a.csv", "e.csv", "b.csv", "c.csv", "d.csv"])
+
+    def test_unknown_schedule(self):
+        with self.assertRaises(ValueError):
+            ParallelFileProcessor(MagicMock(size=1), Logger(), schedule="random")
+
+
+@unittest.skipIf(ThreadedFTPServer is None, "pyftpdlib is not installed")
+class TestFTPConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalFTPServer()
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        self.pool = FTPConnectionPool(self.server.host, "user", "pass", port=self.server.port, size=2)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+        self.pool.close()
+        self.server.stop()
+
+    def test_sessions_are_bounded_and_reused(self):
+        first, second = self.pool.acquire(), self.pool.acquire()
+        self.assertIsNot(first, second)
+        self.assertEqual(self.pool.opened, 2)
+        self.pool.release(first)
+        self.assertIs(self.pool.acquire(), first)
+        self.pool.release(first)
+        self.pool.release(second)
+
+    def test_dead_session_is_reconnected(self):
+        client = self.pool.acquire()
+        client.ftp.sock.close()
+        self.pool.release(client, healthy=False)
+        client = self.pool.acquire()
+        self.assertEqual(client.list_files(), [])
+        self.pool.release(client)
+
+    def test_parallel_run_processes_every_file(self):
+        os.makedirs(VALID_DIR, exist_ok=True)
+        names = [f"f{i}.csv" for i in range(6)]
+        for i, name in enumerate(names):
+            self.server.write(name, make_csv(20, bad_row=5 if name == "f3.csv" else None, first=100 * i))
+        processor = ParallelFileProcessor(self.pool, Logger())
+        outcomes = {result.filename: result.outcome for result in processor.run(names)}
+        self.assertEqual(outcomes, {name: "invalid" if name == "f3.csv" else "saved" for name in names})
+        recorded = self.pool.ledger.db.execute("SELECT path FROM processed").fetchall()
+        self.assertEqual(sorted(path.rsplit("/", 1)[1] for path, in recorded), names)
+        self.assertLessEqual(self.pool.opened, 2)
+
+    def test_batch_is_screened_from_one_listing(self):
+        self.server.write("empty.csv", "")
+        self.server.write("notes.txt", "ignored")
+        for i, rows in enumerate((30, 10, 20)):
+            self.server.write(f"f{i}.csv", make_csv(rows, first=100 * i))
+        names = ["empty.csv", "notes.txt", "f0.csv", "f1.csv", "f2.csv"]
+        processor = ParallelFileProcessor(self.pool, Logger(), workers=1, schedule="smallest-first")
+        with patch.object(FTPClient, "list_entries", autospec=True,
+                          side_effect=FTPClient.list_entries) as list_entries, \
+                patch.object(ftplib.FTP, "size") as size:
+            results = list(processor.run(names))
+        self.assertEqual(list_entries.call_count, 1)
+        size.assert_not_called()
+        self.assertEqual([(result.filename, result.outcome) for result in results],
+                         [("empty.csv", "empty"), ("notes.txt", "bad_extension"),
+                          ("f1.csv", "saved"), ("f2.csv", "saved"), ("f0.csv", "saved")])
+        # A fresh listing with every file is not fetched again
+        with patch.object(FTPClient, "list_entries") as list_entries:
+            self.assertEqual({result.outcome for result in processor.run(names)}, {"skipped"})
+        list_entries.assert_not_called()
+
+    def test_batch_keeps_its_listing_after_the_ttl(self):
+        os.makedirs(VALID_DIR, exist_ok=True)
+        names = [f"f{i}.csv" for i in range(4)]
+        for i, name in enumerate(names):
+            self.server.write(name, make_csv(10, first=100 * i))
+        # Stale as soon as it is loaded, long before the last download
+        self.pool.index.ttl = 0
+        processor = ParallelFileProcessor(self.pool, Logger(), workers=1)
+        with patch.object(FTPClient, "list_entries", autospec=True,
+                          side_effect=FTPClient.list_entries) as list_entries, \
+                patch.object(ftplib.FTP, "size") as size:
+            self.assertEqual({result.outcome for result in processor.run(names)}, {"saved"})
+        self.assertEqual(list_entries.call_count, 1)
+        size.assert_not_called()
+        recorded = self.pool.ledger.db.execute("SELECT modify FROM processed").fetchall()
+        self.assertEqual(len(recorded), 4)
+        self.assertTrue(all(modify for modify, in recorded))
+        self.assertEqual({result.outcome for result in processor.run(names)}, {"skipped"})
+
+
+@unittest.skipIf(ThreadedFTPServer is None, "pyftpdlib is not installed")
+class TestMultiServerPool(unittest.TestCase):
+    def setUp(self):
+        self.servers = [LocalFTPServer(), LocalFTPServer()]
+        self.endpoints = [Endpoint(f"site{i}", server.host, server.port, "user", "pass", workers=2)
+                          for i, server in enumerate(self.servers)]
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+        for server in self.servers:
+            server.stop()
+
+    def test_read_endpoints(self):
+        path = os.path.join(self.workdir, "endpoints.json")
+        with open(path, "w") as f:
+            json.dump([{"host": "a.example", "password_env": "SITE_A_PASS", "workers": 3},
+                       {"name": "b", "host": "b.example", "port": 2121, "directory": "/out"}], f)
+        with patch.dict(os.environ, {"SITE_A_PASS": "secret"}):
+            endpoints = MultiServerPool.read_endpoints(path)
+        self.assertEqual(endpoints, [Endpoint("a.example", "a.example", 21, "anonymous", "secret", None, 3),
+                                     Endpoint("b", "b.example", 2121, "anonymous", "", "/out", None)])
+        with open(path, "w") as f:
+            json.dump([{"host": "a.example"}, {"host": "a.example"}], f)
+        with self.assertRaises(ValueError):
+            MultiServerPool.read_endpoints(path)
+
+    def test_listing_is_merged_and_tagged_with_its_source(self):
+        self.servers[0].write("a.csv", make_csv(10))
+        self.servers[1].write("a.csv", make_csv(10, first=100))
+        self.servers[1].write("b.csv", make_csv(10, first=200))
+        unreachable = Endpoint("down", "127.0.0.1", 1)
+        fleet = MultiServerPool(self.endpoints + [unreachable])
+        self.assertEqual(sorted(fleet.list_files()), [("site0", "a.csv"), ("site1", "a.csv"), ("site1", "b.csv")])
+        self.assertEqual(list(fleet.errors), ["down"])
+        self.assertEqual(fleet.search("b", mode="prefix"), [("site1", "b.csv")])
+        fleet.close()
+
+    def test_collect_shares_state_and_limits_sessions_per_server(self):
+        for i in range(4):
+            self.servers[0].write(f"{i}.csv", make_csv(10, first=100 * i))
+        # Overlaps the batch_ids of site0's 0.csv
+        self.servers[1].write("late.csv", make_csv(10, first=5))
+        fleet = MultiServerPool(self.endpoints + [Endpoint("down", "127.0.0.1", 1)])
+        processor = MultiServerProcessor(fleet, Logger())
+        results = list(processor.collect(lambda name: name != "late.csv"))
+        self.assertEqual(sorted((result.source, result.outcome) for result in results),
+                         [("site0", "saved")] * 4)
+        self.assertIn("down", fleet.errors)
+        self.assertLessEqual(fleet.pools["site0"].opened, 2)
+        late, = processor.run([("site1", "late.csv")])
+        self.assertEqual((late.source, late.outcome), ("site1", "invalid"))
+        self.assertIn("accepted in an earlier file", late.message)
+        fleet.close()
+
+
+class TestFileProcessorProgress(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalFTPServer()
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        self.client = self.server.client()
+        self.processor = FileProcessor(self.client, Logger())
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+        self.client.ftp.close()
+        self.server.stop()
+
+    def test_progress_reports_bytes_against_size(self):
+        content = make_csv(5000)
+        self.server.write("a.csv", content)
+        calls = []
+        result = self.processor.process("a.csv", progress=lambda received, total: calls.append((received, total)))
+        self.assertEqual(result.outcome, "saved")
+        self.assertGreater(len(calls), 1)
+        self.assertEqual(calls[-1], (len(content), len(content)))
+        self.assertEqual([received for received, total in calls], sorted(received for received, total in calls))
+
+    def test_saved_file_is_byte_identical(self):
+        os.makedirs(VALID_DIR, exist_ok=True)
+        content = make_csv(1000).replace("\n", "\r\n").encode()
+        self.server.write("a.csv", content)
+        result = self.processor.process("a.csv")
+        self.assertEqual(result.outcome, "saved")
+        with open(os.path.join(VALID_DIR, result.message), "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(os.path.join("state", "partial")), [])
+
+    def test_compressed_file_is_saved_decompressed(self):
+        os.makedirs(VALID_DIR, exist_ok=True)
+        content = make_csv(1000).encode()
+        self.server.write("a.csv.gz", gzip.compress(content))
+        self.server.write("b.csv.gz", gzip.compress(make_csv(10, bad_row=4, first=2000).encode()))
+        self.server.write("c.txt.gz", gzip.compress(content))
+        result = self.processor.process("a.csv.gz")
+        self.assertEqual(result.outcome, "saved")
+        with open(os.path.join(VALID_DIR, result.message), "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(self.processor.process("b.csv.gz").message, "Row 5 has missing columns")
+        self.assertEqual(self.processor.process("c.txt.gz").outcome, "bad_extension")
+        self.assertEqual(os.listdir(os.path.join("state", "partial")), [])
+
+    def test_sidecar_matches_saved_file(self):
+        self.server.write("a.csv", make_csv(300))
+        result = FileProcessor(self.client, Logger(), sidecar=True).process("a.csv")
+        self.assertEqual(result.outcome, "saved")
+        path = os.path.join(VALID_DIR, result.message.replace(".csv", SIDECAR_EXTENSION))
+        with Sidecar(path) as sidecar:
+            self.assertEqual(len(sidecar), 300)
+            self.assertEqual((sidecar.batch_id(0), sidecar.batch_id(299)), ("1", "300"))
+            self.assertEqual(sidecar.timestamp(7), "2023-01-01")
+            self.assertAlmostEqual(sidecar.reading(299, 0), 1.234, places=6)
+            self.assertAlmostEqual(sidecar.reading(299, 9), 0.123, places=6)
+            self.assertEqual(sidecar.to_numpy().shape, (300, 10))
+
+    def test_metrics_record_stages_and_outcomes(self):
+        self.server.write("a.csv", make_csv(300))
+        self.server.write("b.csv", make_csv(300, bad_row=5, first=1000))
+        self.assertIs(Metrics().stage("retr"), Metrics.NO_OP)
+        with patch.multiple(METRICS, stages={}, counters={}):
+            METRICS.enable(os.path.join(self.workdir, "metrics.json"))
+            self.processor.process("a.csv")
+            self.processor.process("b.csv")
+            METRICS.close()
+        with open(os.path.join(self.workdir, "metrics.json")) as f:
+            snapshot = json.load(f)
+        for stage in ("size", "retr", "decode", "validate", "disk_write", "publish", "log", "process"):
+            self.assertGreater(snapshot["stages"][stage]["calls"], 0, stage)
+        counters = {(c["name"], tuple(sorted(c["labels"].items()))): c["value"] for c in snapshot["counters"]}
+        self.assertEqual(counters[("files", (("outcome", "saved"),))], 1)
+        self.assertEqual(counters[("files", (("outcome", "invalid"), ("reason", "missing_columns")))], 1)
+        # Rows parsed, headers included; b.csv stops at its sixth data row
+        self.assertEqual(counters[("rows", ())], 301 + 6)
+        self.assertGreater(counters[("bytes_received", ())], 0)
+
+    def test_diagnostics_report_next_to_error_log(self):
+        content = make_csv(2000, bad_row=3)
+        self.server.write("a.csv", content)
+        processor = FileProcessor(self.client, Logger(), diagnostics=10)
+        result = processor.process("a.csv")
+        self.assertEqual(result.outcome, "invalid")
+        self.assertEqual(result.bytes, len(content))
+        self.assertIn("1 violations in 1 rows", result.message)
+        [name] = [name for name in os.listdir(ERROR_LOG_DIR) if name.endswith("_report.json")]
+        with open(os.path.join(ERROR_LOG_DIR, name)) as f:
+            report = json.load(f)
+        self.assertEqual((report["file"], report["total"]), ("a.csv", 1))
+        self.assertEqual(report["violations"][0]["row"], 4)
+
+    def test_cancel_stops_transfer_and_allows_retry(self):
+        self.server.write("a.csv", make_csv(100000))
+
+        def cancel(received, total):
+            raise TransferCancelled("Download cancelled")
+
+        result = self.processor.process("a.csv", progress=cancel)
+        self.assertEqual(result.outcome, "cancelled")
+        self.assertIsNone(self.client.ledger.lookup(self.client.remote_path("a.csv"), result.bytes, None))
+        self.assertEqual(self.processor.process("a.csv").outcome, "saved")
+
+
+@unittest.skipIf(ThreadedFTPServer is None, "pyftpdlib is not installed")
+class TestHeadless(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalFTPServer()
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+        self.server.stop()
+
+    def run_headless(self, *patterns):
+        args = parse_args(["--headless", "--host", self.server.host, "--port", str(self.server.port),
+                           "--user", "user", "--password", "pass", *patterns])
+        return run_headless(args)
+
+    def test_all_valid(self):
+        self.server.write("a.csv", make_csv(10))
+        self.server.write("notes.txt", "ignored")
+        self.assertEqual(self.run_headless("*.csv"), EXIT_OK)
+        self.assertEqual(len(saved_files()), 1)
+
+    def test_parallel_workers(self):
+        for i in range(5):
+            self.server.write(f"{i}.csv", make_csv(10, first=100 * i))
+        self.assertEqual(self.run_headless("--workers", "3"), EXIT_OK)
+        self.assertEqual(len(saved_files()), 5)
+
+    def test_ledger_skips_unchanged_files_across_runs(self):
+        self.server.write("a.csv", make_csv(10))
+        self.server.write("b.csv", make_csv(10, bad_row=4))
+        self.assertEqual(self.run_headless(), EXIT_REJECTED)
+        self.assertEqual(self.run_headless(), EXIT_OK)
+        self.assertEqual(len(saved_files()), 1)
+        # A corrected file published under the same name is fetched again
+        self.server.write("b.csv", make_csv(12, first=100))
+        self.assertEqual(self.run_headless(), EXIT_OK)
+        self.assertEqual(len(saved_files()), 2)
+
+    def test_rejected_file_sets_exit_code(self):
+        self.server.write("a.csv", make_csv(10))
+        self.server.write("b.csv", make_csv(10, bad_row=4))
+        self.assertEqual(self.run_headless(), EXIT_REJECTED)
+
+    def test_batch_ids_are_unique_across_files_and_runs(self):
+        self.server.write("a.csv", make_csv(10))
+        self.assertEqual(self.run_headless(), EXIT_OK)
+        self.server.write("b.csv", make_csv(10, first=8))
+        self.assertEqual(self.run_headless(), EXIT_REJECTED)
+        self.assertEqual(len(saved_files()), 1)
+
+    def test_watch_processes_new_uploads(self):
+        args = parse_args(["--headless", "--watch", "--interval", "0.05", "--host", self.server.host,
+                           "--port", str(self.server.port), "--user", "user", "--password", "pass"])
+        stop = threading.Event()
+        watch = threading.Thread(target=run_watch, args=(args, stop))
+        watch.start()
+        try:
+            self.server.write("a.csv", make_csv(10))
+            for _ in range(100):
+                if saved_files():
+                    break
+                stop.wait(0.05)
+        finally:
+            stop.set()
+            watch.join()
+        self.assertEqual(len(saved_files()), 1)
+
+    def test_watch_retries_a_failed_download(self):
+        args = parse_args(["--headless", "--watch", "--interval", "0.05", "--host", self.server.host,
+                           "--port", str(self.server.port), "--user", "user", "--password", "pass"])
+        retrieved = []
+        original = ftplib.FTP.retrbinary
+
+        def retrbinary(ftp, *args, **kwargs):
+            retrieved.append(args[0])
+            if len(retrieved) == 1:
+                raise ftplib.error_perm("550 Temporarily unavailable")
+            return original(ftp, *args, **kwargs)
+
+        stop = threading.Event()
+        watch = threading.Thread(target=run_watch, args=(args, stop))
+        with patch.object(ftplib.FTP, "retrbinary", autospec=True, side_effect=retrbinary):
+            watch.start()
+            try:
+                self.server.write("a.csv", make_csv(10))
+                for _ in range(100):
+                    if saved_files():
+                        break
+                    stop.wait(0.05)
+            finally:
+                stop.set()
+                watch.join()
+        self.assertEqual(len(saved_files()), 1)
+        self.assertEqual(retrieved, ["RETR a.csv", "RETR a.csv"])
+
+    def test_schema_replaces_the_built_in_layout(self):
+        with open("sensor.json", "w") as f:
+            json.dump({"columns": [column._asdict() for column in TestSchema.SENSOR.columns]}, f)
+        self.server.write("good.csv", "serial,site,depth,temperature\nA1,north,10,-3.5\n")
+        self.server.write("bad.csv", "serial,site,depth,temperature\nA2,north,1000,-3.5\n")
+        self.assertEqual(self.run_headless("--schema", "sensor.json"), EXIT_REJECTED)
+        self.assertEqual(len(saved_files()), 1)
+
+    def test_unreachable_server(self):
+        args = parse_args(["--headless", "--host", "127.0.0.1", "--port", "1"])
+        self.assertEqual(run_headless(args), EXIT_FAILURE)
+
+    def test_configuration_errors_set_the_failure_exit_code(self):
+        with open("endpoints.json", "w") as f:
+            json.dump([{"name": "north", "port": self.server.port}], f)
+        with patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            self.assertEqual(run_headless(parse_args(["--headless", "--schema", "missing.json"])), EXIT_FAILURE)
+            self.assertEqual(run_headless(parse_args(["--headless", "--endpoints", "endpoints.json"])),
+                             EXIT_FAILURE)
+            self.assertEqual(run_watch(parse_args(["--headless", "--watch", "--schema", "missing.json"])),
+                             EXIT_FAILURE)
+            self.assertEqual(run_local(parse_args(["--validate", "a.csv", "--schema", "missing.json"])),
+                             EXIT_FAILURE)
+        self.assertIn("Endpoint without a host", stderr.getvalue())
+        self.assertEqual(saved_files(), [])
+
+    def test_endpoints_are_collected_together(self):
+        other = LocalFTPServer()
+        self.addCleanup(other.stop)
+        self.server.write("a.csv", make_csv(10))
+        other.write("a.csv", make_csv(10, first=100))
+        with open("endpoints.json", "w") as f:
+            json.dump([{"name": "north", "host": self.server.host, "port": self.server.port,
+                        "user": "user", "password": "pass"},
+                       {"name": "south", "host": other.host, "port": other.port,
+                        "user": "user", "password": "pass", "workers": 2}], f)
+        args = parse_args(["--headless", "--endpoints", "endpoints.json"])
+        with patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            self.assertEqual(run_headless(args), EXIT_OK)
+        self.assertIn("saved: north/a.csv", stdout.getvalue())
+        self.assertIn("saved: south/a.csv", stdout.getvalue())
+        self.assertEqual(len(saved_files()), 2)
+
+    def test_manifest_indexes_saved_files(self):
+        content = make_csv(10, first=5)
+        self.server.write("a.csv", content)
+        self.server.write("b.csv", make_csv(10, first=100))
+        self.assertEqual(self.run_headless(), EXIT_OK)
+        self.assertEqual(len(saved_files()), 2)
+        store = OutputStore(manifest=os.path.join("state", "outputs.sqlite3"))
+        self.addCleanup(store.close)
+        [output] = store.find(digest=hashlib.sha256(content.encode()).hexdigest())
+        self.assertEqual((output.source, output.rows, output.first_batch_id, output.last_batch_id),
+                         (f"ftp://user@{self.server.host}:{self.server.port}/a.csv", 10, "5", "14"))
+        self.assertEqual(store.find(batch_id="7"), [output])
+        # Compared as numbers, not as text
+        for batch_id in ("2", "50", "123456"):
+            self.assertEqual(store.find(batch_id=batch_id), [])
+        self.assertTrue(os.path.isfile(store.path(output.path)))
+
+
+class TestProcessedLedger(unittest.TestCase):
+    def test_only_final_outcomes_count_as_processed(self):
+        ledger = ProcessedLedger(":memory:")
+        ledger.record("ftp://h/a.csv", 10, "20240101000000", "saved", "MED_DATA_1.csv")
+        ledger.record("ftp://h/b.csv", 10, None, "download_error", "timed out")
+        self.assertTrue(ledger.is_processed("ftp://h/a.csv", 10, "20240101000000"))
+        self.assertFalse(ledger.is_processed("ftp://h/a.csv", 11, "20240101000000"))
+        self.assertFalse(ledger.is_processed("ftp://h/a.csv", 10, "20240102000000"))
+        self.assertFalse(ledger.is_processed("ftp://h/b.csv", 10, None))
+        self.assertEqual(ledger.lookup("ftp://h/b.csv", 10, None), ("download_error", "timed out"))
+
+    def test_unknown_modify_falls_back_to_path_and_size(self):
+        ledger = ProcessedLedger(":memory:")
+        ledger.record("ftp://h/a.csv", 10, None, "saved", "MED_DATA_1.csv")
+        ledger.record("ftp://h/b.csv", 10, "20240101000000", "invalid", "Row 2 has missing columns")
+        self.assertTrue(ledger.is_processed("ftp://h/a.csv", 10, "20240101000000"))
+        self.assertTrue(ledger.is_processed("ftp://h/b.csv", 10, None))
+        self.assertFalse(ledger.is_processed("ftp://h/a.csv", 11, "20240101000000"))
+        self.assertFalse(ledger.is_processed("ftp://h/b.csv", 11, None))
+        # The latest record of the path and size wins
+        ledger.record("ftp://h/b.csv", 10, None, "download_error", "timed out")
+        self.assertEqual(ledger.lookup("ftp://h/b.csv", 10, None), ("download_error", "timed out"))
+
+    def test_persists_across_instances(self):
+        workdir = tempfile.mkdtemp()
+        path = os.path.join(workdir, "state", "ledger.sqlite3")
+        ledger = ProcessedLedger(path)
+        ledger.record("ftp://h/a.csv", 10, None, "invalid", "Row 2 has missing columns")
+        ledger.close()
+        self.assertTrue(ProcessedLedger(path).is_processed("ftp://h/a.csv", 10, None))
+        shutil.rmtree(workdir)
+
+
+class TestBatchIdIndex(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "state", "batch_ids.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(str(i))
+        self.assertTrue(all(str(i) in bloom for i in range(1000)))
+        false_positives = sum(str(i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 300)
+        # The bulk forms agree with add and in
+        keys = [str(i) for i in range(11000)]
+        self.assertEqual(bloom.filter(keys), [key for key in keys if key in bloom])
+        bulk = BloomFilter(1000)
+        bulk.update(keys[:1000])
+        self.assertEqual(bulk.bits, bloom.bits)
+
+    def test_commit_rejects_files_with_accepted_ids(self):
+        index = BatchIdIndex(self.path)
+        self.assertIsNone(index.commit({"1", "2", "3"}, "ftp://h/a.csv"))
+        self.assertEqual(index.commit({"4", "3"}, "ftp://h/b.csv"), "3")
+        # Nothing from the rejected file was added
+        self.assertNotIn("4", index)
+        self.assertEqual(index.source("2"), "ftp://h/a.csv")
+        index.close()
+
+    def test_persists_and_reloads_filter(self):
+        index = BatchIdIndex(self.path, capacity=1000)
+        index.commit({"a", "b"}, "ftp://h/a.csv")
+        index.close()
+        self.assertTrue(os.path.exists(self.path + ".bloom"))
+        reopened = BatchIdIndex(self.path, capacity=1000)
+        self.assertIn("a", reopened)
+        self.assertNotIn("c", reopened)
+        reopened.commit({"c"}, "ftp://h/c.csv")
+        reopened.db.close()
+        # The saved filter misses "c", so it is rebuilt from the table
+        self.assertIn("c", BatchIdIndex(self.path, capacity=1000))
+
+    def test_filter_is_sized_to_the_workload_and_grows(self):
+        index = BatchIdIndex(":memory:")
+        self.assertLess(len(index.bloom.bits), len(BloomFilter(BATCH_INDEX_CAPACITY).bits) // 50)
+        index = BatchIdIndex(":memory:", capacity=100)
+        size = index.bloom.size
+        self.assertIsNone(index.commit({str(i) for i in range(80)}, "ftp://h/a.csv"))
+        self.assertIsNone(index.commit({str(i) for i in range(80, 160)}, "ftp://h/b.csv"))
+        self.assertGreater(index.bloom.size, size)
+        self.assertTrue(all(str(i) in index for i in range(160)))
+        self.assertEqual(index.commit({"200", "150"}, "ftp://h/c.csv"), "150")
+        index.close()
+
+    def test_validators_report_earlier_file_duplicates(self):
+        index = BatchIdIndex(":memory:", capacity=1000)
+        index.commit({"7"}, "ftp://h/a.csv")
+        content = make_csv(10)
+        message = "Duplicate batch_id 7 on row 8 (accepted in an earlier file)"
+        self.assertEqual(FileValidator.validate(content, batch_index=index), (False, message))
+        self.assertEqual(ColumnarValidator.validate(content, block_rows=4, batch_index=index), (False, message))
+        validator = StreamingValidator(batch_index=index)
+        validator.feed(content.encode())
+        self.assertEqual(validator.close(), (False, message))
+
+    def test_earlier_file_duplicate_comes_before_a_later_error(self):
+        # The ids are checked in bulk, but the lowest bad row still wins
+        index = BatchIdIndex(":memory:", capacity=1000)
+        index.commit({"2500"}, "ftp://h/a.csv")
+        content = make_csv(3000, bad_row=2900).encode()
+        message = "Duplicate batch_id 2500 on row 2501 (accepted in an earlier file)"
+        self.assertEqual(FileValidator.validate(content.decode(), batch_index=index), (False, message))
+        self.assertEqual(Schema.default().validate(content.decode(), index), (False, message))
+        for schema in (None, Schema.default()):
+            validator = StreamingValidator(batch_index=index, schema=schema)
+            for start in range(0, len(content), 4096):
+                validator.feed(content[start:start + 4096])
+            self.assertEqual(validator.close(), (False, message))
+            self.assertLess(validator.bytes_received, len(content))
+
+
+class TestVerdictCache(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, "state", "verdicts.sqlite3")
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_lookup_by_either_digest(self):
+        cache = VerdictCache(":memory:")
+        cache.record({"md5": "m1"}, 10, False, "Row 2 has missing columns")
+        self.assertIsNone(cache.lookup({"md5": "m1"}, 11))
+        self.assertIsNone(cache.lookup({"sha256": "s1"}, 10))
+        # A later full download adds the other digest to the same entry
+        cache.record({"sha256": "s1", "md5": "m1"}, 10, False, "Row 2 has missing columns")
+        self.assertEqual(cache.lookup({"sha256": "s1"}, 10), (False, "Row 2 has missing columns", None))
+        self.assertEqual(cache.count, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = VerdictCache(":memory:", capacity=2)
+        cache.record({"sha256": "a"}, 1, True, "ok", source="ftp://h/a.csv")
+        cache.record({"sha256": "b"}, 1, True, "ok", source="ftp://h/b.csv")
+        cache.lookup({"sha256": "a"}, 1)
+        cache.record({"sha256": "c"}, 1, True, "ok", source="ftp://h/c.csv")
+        self.assertIsNotNone(cache.lookup({"sha256": "a"}, 1))
+        self.assertIsNone(cache.lookup({"sha256": "b"}, 1))
+        self.assertIsNotNone(cache.lookup({"sha256": "c"}, 1))
+
+    def test_persists_across_instances(self):
+        cache = VerdictCache(self.path)
+        cache.record({"sha256": "a"}, 1, True, "ok", source="ftp://h/a.csv")
+        cache.close()
+        reopened = VerdictCache(self.path)
+        self.assertEqual(reopened.lookup({"sha256": "a"}, 1), (True, "ok", "ftp://h/a.csv"))
+        reopened.close()
+
+    def test_validate_answers_known_content_from_cache(self):
+        cache = VerdictCache(":memory:")
+        content = make_csv(10, bad_row=4)
+        verdict = FileValidator.validate(content, cache=cache)
+        self.assertFalse(verdict[0])
+        with patch.object(FileValidator, "validate_rows") as validate_rows:
+            self.assertEqual(FileValidator.validate(content, cache=cache), verdict)
+        validate_rows.assert_not_called()
+
+    @unittest.skipIf(ThreadedFTPServer is None, "pyftpdlib is not installed")
+    def test_known_content_is_not_downloaded(self):
+        for command in ("HASH", "XMD5"):
+            with self.subTest(command=command):
+                server = LocalFTPServer(hash_commands=(command,))
+                cwd = os.getcwd()
+                os.chdir(self.workdir)
+                client = server.client()
+                try:
+                    processor = FileProcessor(client, Logger())
+                    bad, good = make_csv(10, bad_row=4), make_csv(10)
+                    server.write("bad.csv", bad)
+                    server.write("good.csv", good)
+                    self.assertEqual(processor.process("bad.csv").outcome, "invalid")
+                    self.assertEqual(processor.process("good.csv").outcome, "saved")
+                    # The same bytes published again under other names
+                    server.write("bad_again.csv", bad)
+                    server.write("good_again.csv", good)
+                    rejected = processor.process("bad_again.csv")
+                    duplicate = processor.process("good_again.csv")
+                    self.assertEqual((rejected.outcome, rejected.bytes), ("invalid", 0))
+                    self.assertEqual(rejected.message, "Row 5 has missing columns")
+                    self.assertEqual((duplicate.outcome, duplicate.bytes), ("invalid", 0))
+                    self.assertEqual(duplicate.message, f"Same content as {client.remote_path('good.csv')} "
+                                                        "(accepted in an earlier file)")
+                    self.assertEqual(server.retrieved, ["bad.csv", "good.csv"])
+                finally:
+                    os.chdir(cwd)
+                    client.ftp.close()
+                    server.stop()
+
+
+
+class TestOutputStore(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.store = OutputStore(os.path.join(self.workdir, "valid"), ":memory:")
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.workdir)
+
+    def spool(self, content):
+        path = os.path.join(self.workdir, uuid.uuid4().hex)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_names_are_unique_within_a_date_shard(self):
+        names = [self.store.publish(self.spool(str(i)), "ab" * 32) for i in range(3)]
+        names.append(self.store.publish(self.spool("3")))
+        self.assertEqual(len(set(names)), 4)
+        for i, name in enumerate(names):
+            self.assertEqual(os.path.dirname(name), os.path.join(*datetime.now().strftime("%Y/%m/%d").split("/")))
+            with open(self.store.path(name)) as f:
+                self.assertEqual(f.read(), str(i))
+        self.assertTrue(os.path.basename(names[0]).endswith("_abababababababab.csv"))
+
+    def test_find_by_each_key(self):
+        a = self.store.publish(self.spool("a"))
+        b = self.store.publish(self.spool("b"))
+        self.store.record(a, "ftp://h/a.csv", 10, {"sha256": "s1", "md5": "m1"}, 3, {"B10", "B11", "B12"})
+        self.store.record(b, "ftp://h/b.csv", 20, {"md5": "m2"}, 2, {"B20", "B21"})
+        self.assertEqual([output.path for output in self.store.find(source="ftp://h/a.csv")], [a])
+        self.assertEqual([output.path for output in self.store.find(digest="s1")], [a])
+        self.assertEqual([output.path for output in self.store.find(digest="m2")], [b])
+        self.assertEqual([output.path for output in self.store.find(rows=2)], [b])
+        self.assertEqual([output.path for output in self.store.find(batch_id="B115")], [a])
+        self.assertEqual(self.store.find(batch_id="B3"), [])
+        c = self.store.publish(self.spool("c"))
+        self.store.record(c, "ftp://h/c.csv", 30, {}, 3, {"9", "10", "11"})
+        self.assertEqual([output.path for output in self.store.find(batch_id="9")], [c])
+        self.assertEqual(self.store.find(batch_id="100"), [])
+        self.assertEqual(self.store.find(batch_id="10a"), [])
+        self.assertEqual([output.path for output in self.store.find()], [c, b, a])
+        output = self.store.find(source="ftp://h/b.csv")[0]
+        self.assertEqual((output.size, output.sha256, output.first_batch_id, output.last_batch_id),
+                         (20, None, "B20", "B21"))
+
+    def test_manifest_is_append_only(self):
+        path = os.path.join(self.workdir, "state", "outputs.sqlite3")
+        store = OutputStore(self.store.root, path)
+        store.record("x.csv", "ftp://h/x.csv", 1, {}, 0, set())
+        with self.assertRaisesRegex(Exception, "append-only"):
+            with store.db:
+                store.db.execute("DELETE FROM outputs")
+        store.close()
+        reopened = OutputStore(self.store.root, path)
+        self.assertEqual([output.path for output in reopened.find(source="ftp://h/x.csv")], ["x.csv"])
+        reopened.close()
+
+    def test_manifest_without_numeric_ranges_is_upgraded(self):
+        path = os.path.join(self.workdir, "outputs.sqlite3")
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE outputs (path TEXT PRIMARY KEY, source TEXT NOT NULL, sha256 TEXT, md5 TEXT,"
+                   " size INTEGER, rows INTEGER NOT NULL, first_batch_id TEXT, last_batch_id TEXT,"
+                   " accepted_at TEXT NOT NULL)")
+        db.execute("INSERT INTO outputs VALUES ('x.csv', 'ftp://h/x.csv', NULL, NULL, 1, 2, 'B1', 'B2', '')")
+        db.commit()
+        db.close()
+        store = OutputStore(self.store.root, path)
+        self.addCleanup(store.close)
+        store.record("y.csv", "ftp://h/y.csv", 1, {}, 2, {"9", "10"})
+        self.assertEqual([output.path for output in store.find(batch_id="B15")], ["x.csv"])
+        self.assertEqual([output.path for output in store.find(batch_id="10")], ["y.csv"])
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_local_uuid(self):
+        logger = Logger(uuid_source="local")
+        first, second = logger.get_uuid(), logger.get_uuid()
+        self.assertEqual(str(uuid.UUID(first)), first)
+        self.assertNotEqual(first, second)
+
+    def test_remote_pool_is_refilled_in_background(self):
+        fetched = [str(uuid.uuid4()) for _ in range(5)]
+        requests = MagicMock()
+        requests.get.return_value.json.return_value = fetched
+        logger = Logger(uuid_source="remote")
+        with patch.dict(sys.modules, {"requests": requests}):
+            logger.get_uuid()
+            with logger.refilling:
+                pass
+            self.assertIn(logger.get_uuid(), fetched)
+            with logger.refilling:
+                pass
+        self.assertIn("timeout", requests.get.call_args.kwargs)
+
+    def test_remote_failure_falls_back_to_local(self):
+        requests = MagicMock()
+        requests.get.side_effect = Exception("Connection error")
+        logger = Logger(uuid_source="remote")
+        with patch.dict(sys.modules, {"requests": requests}):
+            first = logger.get_uuid()
+            with logger.refilling:
+                pass
+            logger.get_uuid()
+        self.assertEqual(str(uuid.UUID(first)), first)
+        self.assertEqual(requests.get.call_count, 1)
+
+    def test_log_is_written_by_background_thread(self):
+        logger = Logger()
+        logger.log("Test error message")
+        logger.flush()
+        with open(ERROR_LOG_FILE) as f:
+            self.assertIn("] Test error message", f.read())
+
+    def test_tail_returns_only_new_complete_lines(self):
+        tail = LogTail(ERROR_LOG_FILE)
+        self.assertEqual(tail.read_new_lines(), (False, []))
+        os.makedirs(ERROR_LOG_DIR, exist_ok=True)
+        with open(ERROR_LOG_FILE, "w") as f:
+            f.write("one\ntwo\nthr")
+        self.assertEqual(tail.read_new_lines(), (False, ["one", "two"]))
+        with open(ERROR_LOG_FILE, "a") as f:
+            f.write("ee\n")
+        self.assertEqual(tail.read_new_lines(), (False, ["three"]))
+        self.assertEqual(tail.read_new_lines(), (False, []))
+        with open(ERROR_LOG_FILE, "w") as f:
+            f.write("new\n")
+        self.assertEqual(tail.read_new_lines(), (True, ["new"]))
+
+
 class TestDownloadStatus(unittest.TestCase):
     def setUp(self):
         self.status = DownloadStatus()
@@ -54,6 +1536,8 @@ class TestDownloadStatus(unittest.TestCase):
             "success"), "Download Success")
         self.assertEqual(self.status.change_status(
             "error"), "Download Failed!")
+        self.assertEqual(self.status.change_status(
+            "cancelled"), "Download Cancelled")
 
 
 if __name__ == '__main__':